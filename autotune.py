@@ -0,0 +1,191 @@
+# autotune.py
+import os
+import time
+import argparse
+
+import yaml
+import torch
+from torch.utils.data import DataLoader
+
+from utils.model_factory import create_model
+from utils.config_utils import load_config, default_overlay_path
+from losses.loss_functions import get_loss_function
+from utils.resources import peak_rss_mb, doubling_counts, run_isolated
+from main import build_datasets, unpack_batch, compute_loss, get_amp_settings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pick batch size and DataLoader workers by measured throughput')
+    parser.add_argument('--config', type=str, default='configs/config.yaml', help='Config file path')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64],
+                        help='Batch sizes to probe (in increasing order; stops at the first failure)')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='num_workers values to probe (default: 0, 1, 2, 4, ... up to the core count)')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed steps per probe')
+    parser.add_argument('--steps', type=int, default=5, help='Timed steps per probe')
+    parser.add_argument('--max-memory-mb', type=float, default=None,
+                        help='Peak memory budget (default: 90%% of GPU memory or of physical RAM)')
+    parser.add_argument('--keep-effective-batch', action='store_true',
+                        help='Adjust accumulation_steps so batch_size * accumulation_steps stays as configured')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Overlay path (default: <config>.autotune.yaml, picked up by main.py)')
+    return parser.parse_args()
+
+
+def default_memory_budget_mb(device):
+    if device.type == 'cuda':
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory / (1024 * 1024)
+    return 0.9 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+
+
+def probe_batch_size(item):
+    """
+    Time full training steps at one batch size on a real batch, set up like main.py
+    (same dataset extras, loss, AMP dtype and gradient accumulation); runs in a fresh
+    process so peak RSS belongs to this probe only
+
+    peak_memory_mb is absolute (interpreter, dataset, model, optimizer state and
+    activations), since it is compared against the whole memory budget
+    """
+    config, batch_size, warmup, steps = item
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    result = {'batch_size': batch_size}
+    try:
+        # Data is loaded once up front so only compute is timed
+        train_dataset, _ = build_datasets(config)
+        loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+        images, masks, extras = unpack_batch(next(iter(loader)), device)
+
+        model = create_model(config).to(device)
+        model.train()
+        criterion = get_loss_function(config)
+        optimizer = torch.optim.Adam(
+            model.parameters(),
+            lr=config['training']['lr'],
+            weight_decay=config['training']['weight_decay']
+        )
+        use_amp, amp_dtype, use_scaler = get_amp_settings(config, device)
+        scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+        accumulation_steps = config['training'].get('accumulation_steps', 1)
+        clip_grad_norm = config['training'].get('clip_grad_norm', 0)
+
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for i in range(warmup + steps):
+            start = time.perf_counter()
+            # One optimizer step = accumulation_steps micro-batches, as in main.py
+            for _ in range(accumulation_steps):
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(images)
+                loss, _ = compute_loss(criterion, outputs.float(), masks, extras)
+                scaler.scale(loss / accumulation_steps).backward()
+            if clip_grad_norm > 0:
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=clip_grad_norm)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+
+        step_time = sorted(times)[len(times) // 2] / accumulation_steps  # per micro-batch
+        result['step_ms'] = step_time * 1000
+        result['samples_per_s'] = batch_size / step_time
+        if device.type == 'cuda':
+            result['peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / (1024 * 1024)
+        else:
+            result['peak_memory_mb'] = peak_rss_mb()
+    except StopIteration:
+        result['error'] = 'fewer samples than the batch size'
+    except Exception as e:
+        # Out of memory, or any other failure of the configured training step
+        result['error'] = f'{type(e).__name__}: {str(e).splitlines()[0]}' if str(e) else type(e).__name__
+    return result
+
+
+def probe_workers(config, batch_size, num_workers, warmup, steps):
+    """Samples/s the DataLoader alone delivers with `num_workers` workers"""
+    train_dataset, _ = build_datasets(config)
+    loader = DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        drop_last=True
+    )
+    iterator = iter(loader)
+    try:
+        # Untimed batches include worker start-up
+        for _ in range(max(warmup, 1)):
+            next(iterator)
+        samples = 0
+        start = time.perf_counter()
+        for _ in range(steps):
+            samples += next(iterator)[0].size(0)
+    except StopIteration:
+        return 0.0  # dataset too small for this many probe batches
+    return samples / (time.perf_counter() - start)
+
+
+def main():
+    args = parse_args()
+    config, _ = load_config(args.config, overlay_path='')  # tune from the base config
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    memory_budget = args.max_memory_mb or default_memory_budget_mb(device)
+
+    # 1. Batch size: compute throughput and peak memory, one process per probe
+    #    (a probe killed by the OOM killer counts as a failure instead of hanging)
+    use_amp, amp_dtype, _ = get_amp_settings(config, device)
+    print(f'Probing batch sizes (memory budget {memory_budget:.0f} MB, amp={amp_dtype if use_amp else "off"}, '
+          f'accumulation={config["training"].get("accumulation_steps", 1)})')
+    print(f'{"batch":>6}{"ms/step":>10}{"samples/s":>12}{"peak MB":>10}')
+    batch_results = []
+    for batch_size in args.batch_sizes:
+        result, error = run_isolated(probe_batch_size, (config, batch_size, args.warmup, args.steps))
+        if error is not None:
+            result = {'batch_size': batch_size, 'error': error}
+        batch_results.append(result)
+        if 'error' in result:
+            print(f'{batch_size:>6}  error: {result["error"]}')
+            break
+        print(f'{batch_size:>6}{result["step_ms"]:>10.1f}{result["samples_per_s"]:>12.2f}{result["peak_memory_mb"]:>10.0f}')
+        if result['peak_memory_mb'] > memory_budget:
+            break
+
+    feasible = [r for r in batch_results if 'error' not in r and r['peak_memory_mb'] <= memory_budget]
+    if not feasible:
+        raise RuntimeError('No batch size fits the memory budget')
+    best_batch = max(feasible, key=lambda r: r['samples_per_s'])
+
+    # 2. Workers: the fewest that keep the loader ahead of the model
+    print(f'Probing num_workers at batch size {best_batch["batch_size"]} '
+          f'(model consumes {best_batch["samples_per_s"]:.2f} samples/s)')
+    worker_results = []
+    for num_workers in args.workers or doubling_counts(include_zero=True):
+        throughput = probe_workers(config, best_batch['batch_size'], num_workers, args.warmup, args.steps)
+        worker_results.append((num_workers, throughput))
+        print(f'{num_workers:>6} workers {throughput:>10.2f} samples/s')
+
+    sufficient = [w for w, t in worker_results if t >= 1.1 * best_batch['samples_per_s']]
+    best_workers = min(sufficient) if sufficient else max(worker_results, key=lambda wt: wt[1])[0]
+
+    overlay = {'data': {'batch_size': best_batch['batch_size'], 'num_workers': best_workers}}
+    if args.keep_effective_batch:
+        effective = config['data']['batch_size'] * config['training'].get('accumulation_steps', 1)
+        overlay['training'] = {'accumulation_steps': max(1, round(effective / best_batch['batch_size']))}
+
+    output = args.output or default_overlay_path(args.config)
+    with open(output, 'w') as f:
+        f.write(f'# Written by autotune.py on {time.strftime("%Y-%m-%d %H:%M")} ({device}, {os.cpu_count()} cores)\n')
+        f.write(f'# batch_size {best_batch["batch_size"]}: {best_batch["samples_per_s"]:.2f} samples/s, '
+                f'peak {best_batch["peak_memory_mb"]:.0f} MB\n')
+        yaml.safe_dump(overlay, f, default_flow_style=False)
+    print(f'Selected batch_size={best_batch["batch_size"]}, num_workers={best_workers}; overlay written to {output}')
+
+
+if __name__ == '__main__':
+    main()
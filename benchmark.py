@@ -0,0 +1,208 @@
+# benchmark.py
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+
+import numpy as np
+import torch
+
+from utils.resources import peak_rss_mb, run_isolated
+from models.unet import (
+    create_backbone_model,
+    create_sa_unet_model,
+    create_sa_unet_model_for_single_channel,
+    create_lite_unet_model
+)
+
+# Factory functions under benchmark, keyed by the names used on the command line
+FACTORIES = {
+    'backbone': create_backbone_model,
+    'sa_unet': create_sa_unet_model,
+    'sa_unet_single_channel': create_sa_unet_model_for_single_channel,
+    'lite': create_lite_unet_model,
+}
+
+# Metrics checked against the baseline (all lower-is-better)
+REGRESSION_METRICS = ('forward_ms', 'backward_ms', 'peak_memory_mb')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark U-Net variants across input sizes, batch sizes and threads')
+    parser.add_argument('--variants', type=str, nargs='+', default=list(FACTORIES), help='Factory functions to benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 1500], help='Square input sizes')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2], help='Batch sizes')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4], help='torch.set_num_threads values')
+    parser.add_argument('--in-channels', type=int, default=1, help='Input channels (single-channel variant is always 1)')
+    parser.add_argument('--start-neurons', type=int, default=16, help='start_neurons passed to the factories')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed iterations per case')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed iterations per case')
+    parser.add_argument('--no-backward', action='store_true', help='Only measure the forward pass')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run on')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Where to write results')
+    parser.add_argument('--baseline', type=str, default=None, help='Baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative slowdown before flagging')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results to --baseline as well')
+    return parser.parse_args()
+
+
+def case_key(case):
+    return (f'{case["variant"]}/c{case["in_channels"]}/n{case["start_neurons"]}/s{case["size"]}'
+            f'/b{case["batch_size"]}/t{case["threads"]}/{case["device"]}')
+
+
+def build_model(case):
+    factory = FACTORIES[case['variant']]
+    kwargs = {'start_neurons': case['start_neurons'], 'use_output_activation': False}
+    if case['variant'] != 'sa_unet_single_channel':
+        kwargs['input_size'] = (case['size'], case['size'], case['in_channels'])
+    return factory(**kwargs)
+
+
+def run_case(case):
+    """Run one benchmark case; executed in a fresh process so peak RSS is per case"""
+    torch.set_num_threads(case['threads'])
+    torch.manual_seed(0)
+    device = torch.device(case['device'])
+    in_channels = 1 if case['variant'] == 'sa_unet_single_channel' else case['in_channels']
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    result = dict(case)
+    try:
+        base_rss = peak_rss_mb()
+        model = build_model(case).to(device)
+        x = torch.randn(case['batch_size'], in_channels, case['size'], case['size'], device=device)
+
+        # Forward latency in inference mode
+        model.eval()
+        forward_times = []
+        with torch.no_grad():
+            for i in range(case['warmup'] + case['repeats']):
+                sync()
+                start = time.perf_counter()
+                model(x, training=False)
+                sync()
+                if i >= case['warmup']:
+                    forward_times.append(time.perf_counter() - start)
+
+        # Training step latency, split into forward and backward
+        train_forward_times, backward_times = [], []
+        if case['backward']:
+            model.train()
+            for i in range(case['warmup'] + case['repeats']):
+                model.zero_grad(set_to_none=True)
+                sync()
+                start = time.perf_counter()
+                loss = model(x, training=True).float().mean()
+                sync()
+                mid = time.perf_counter()
+                loss.backward()
+                sync()
+                if i >= case['warmup']:
+                    train_forward_times.append(mid - start)
+                    backward_times.append(time.perf_counter() - mid)
+
+        forward_ms = float(np.median(forward_times) * 1000)
+        result.update({
+            'forward_ms': forward_ms,
+            'forward_ms_std': float(np.std(forward_times) * 1000),
+            'throughput_samples_per_s': case['batch_size'] / (forward_ms / 1000),
+            'params': sum(p.numel() for p in model.parameters()),
+        })
+        if case['backward']:
+            result['train_forward_ms'] = float(np.median(train_forward_times) * 1000)
+            result['backward_ms'] = float(np.median(backward_times) * 1000)
+        if device.type == 'cuda':
+            result['peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / (1024 * 1024)
+        else:
+            result['peak_memory_mb'] = peak_rss_mb() - base_rss
+    except RuntimeError as e:
+        # Typically out-of-memory for the largest sizes; keep the sweep going
+        result['error'] = str(e).splitlines()[0]
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a list of human-readable regressions"""
+    regressions = []
+    baseline_cases = {case_key(r): r for r in baseline['results']}
+    for result in results:
+        reference = baseline_cases.get(case_key(result))
+        if reference is None or 'error' in result or 'error' in reference:
+            continue
+        for metric in REGRESSION_METRICS:
+            if metric not in result or metric not in reference or reference[metric] <= 0:
+                continue
+            ratio = result[metric] / reference[metric]
+            if ratio > 1 + tolerance:
+                regressions.append(f'{case_key(result)} {metric}: {reference[metric]:.1f} -> {result[metric]:.1f} ({ratio:.2f}x)')
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    for variant in args.variants:
+        if variant not in FACTORIES:
+            raise ValueError(f'Unknown variant: {variant}. Supported variants: {list(FACTORIES)}')
+
+    cases = [
+        {
+            'variant': variant, 'size': size, 'batch_size': batch_size, 'threads': threads,
+            'in_channels': args.in_channels, 'start_neurons': args.start_neurons,
+            'warmup': args.warmup, 'repeats': args.repeats,
+            'backward': not args.no_backward, 'device': args.device,
+        }
+        for variant, size, batch_size, threads in itertools.product(
+            args.variants, args.sizes, args.batch_sizes, args.threads)
+    ]
+
+    # One process per case so ru_maxrss reflects only that case; a case killed
+    # by the OOM killer is recorded as an error and the sweep continues
+    results = []
+    for case in cases:
+        result, error = run_isolated(run_case, case)
+        if error is not None:
+            result = dict(case, error=error)
+        results.append(result)
+        if 'error' in result:
+            print(f'{case_key(result):<56} error: {result["error"]}')
+        else:
+            backward = f'{result["backward_ms"]:>10.1f}' if 'backward_ms' in result else f'{"-":>10}'
+            print(f'{case_key(result):<56}{result["forward_ms"]:>10.1f}{backward}'
+                  f'{result["throughput_samples_per_s"]:>10.2f}/s{result["peak_memory_mb"]:>10.0f}MB')
+
+    report = {
+        'torch_version': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline updated: {args.baseline}')
+    elif args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) beyond {args.tolerance:.0%}:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('No regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
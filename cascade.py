@@ -0,0 +1,109 @@
+# utils/cascade.py
+import math
+import torch
+import torch.nn.functional as F
+
+
+class CascadeSegmenter:
+    """
+    Two-stage cascade inference.
+
+    Stage 1 runs a small screening model on a downsampled map and produces a
+    wafer-level score (max probability) plus a coarse heatmap. Only wafers whose
+    score reaches `screen_threshold` go to stage 2, where the full model is run
+    on the full-resolution tiles flagged by the heatmap. Everything else in the
+    output is left at probability 0.
+    """
+    def __init__(self, screen_model, full_model, screen_size=(375, 375), screen_threshold=0.5,
+                 region_threshold=0.3, tile_size=256, halo=32, tile_batch_size=8,
+                 screen_activation=True, full_activation=True):
+        """
+        Args:
+            screen_model (nn.Module): Small model run on the downsampled map
+            full_model (nn.Module): Full-resolution model
+            screen_size (tuple): (H, W) of the downsampled map
+            screen_threshold (float): Wafer score needed to run stage 2
+            region_threshold (float): Heatmap probability that flags a tile
+            tile_size (int): Side of the full-resolution tiles in pixels
+            halo (int): Context margin added around each tile
+            tile_batch_size (int): Number of tiles per full-model forward pass
+            screen_activation (bool): Whether the screening model already applies sigmoid
+            full_activation (bool): Whether the full model already applies sigmoid
+        """
+        self.screen_model = screen_model
+        self.full_model = full_model
+        self.screen_size = tuple(screen_size)
+        self.screen_threshold = screen_threshold
+        self.region_threshold = region_threshold
+        self.tile_size = tile_size
+        self.halo = halo
+        self.tile_batch_size = tile_batch_size
+        self.screen_activation = screen_activation
+        self.full_activation = full_activation
+
+    @torch.no_grad()
+    def screen(self, images):
+        """
+        Run the screening model on downsampled maps
+
+        Returns:
+            scores: [B] wafer-level scores
+            heatmap: [B,1,h,w] coarse probability map
+        """
+        low = F.interpolate(images, size=self.screen_size, mode='area')
+        heatmap = self.screen_model(low, training=False)
+        if not self.screen_activation:
+            heatmap = torch.sigmoid(heatmap)
+        scores = heatmap.flatten(1).amax(dim=1)
+        return scores, heatmap
+
+    def flag_tiles(self, heatmap, full_size):
+        """Boolean [B, tiles_y, tiles_x] grid of tiles that the heatmap flags"""
+        grid = (math.ceil(full_size[0] / self.tile_size), math.ceil(full_size[1] / self.tile_size))
+        tile_max = F.adaptive_max_pool2d(heatmap, grid)
+        # Grow by one tile so arms leaving a flagged tile are still segmented
+        tile_max = F.max_pool2d(tile_max, kernel_size=3, stride=1, padding=1)
+        return tile_max[:, 0] >= self.region_threshold
+
+    @torch.no_grad()
+    def refine(self, images, tile_flags):
+        """Run the full model on the flagged tiles and stitch a full-resolution probability map"""
+        b, c, h, w = images.shape
+        t, halo = self.tile_size, self.halo
+        grid_h, grid_w = tile_flags.shape[1:]
+
+        # Pad once so every tile (including border tiles) has the same size with its halo
+        padded = F.pad(images, [halo, grid_w * t - w + halo, halo, grid_h * t - h + halo])
+        output = images.new_zeros(b, 1, grid_h * t, grid_w * t)
+
+        tiles = tile_flags.nonzero(as_tuple=False).tolist()
+        for start in range(0, len(tiles), self.tile_batch_size):
+            chunk = tiles[start:start + self.tile_batch_size]
+            crops = torch.stack([
+                padded[i, :, ty * t:(ty + 1) * t + 2 * halo, tx * t:(tx + 1) * t + 2 * halo]
+                for i, ty, tx in chunk
+            ])
+            pred = self.full_model(crops, training=False)
+            if not self.full_activation:
+                pred = torch.sigmoid(pred)
+            pred = pred[:, :, halo:halo + t, halo:halo + t]
+            for k, (i, ty, tx) in enumerate(chunk):
+                output[i, :, ty * t:(ty + 1) * t, tx * t:(tx + 1) * t] = pred[k]
+
+        return output[:, :, :h, :w]
+
+    @torch.no_grad()
+    def __call__(self, images):
+        """
+        Segment a batch of full-resolution maps
+
+        Returns:
+            probs: [B,1,H,W] probability map (0 outside the refined tiles)
+            scores: [B] wafer-level screening scores
+            tile_flags: [B, tiles_y, tiles_x] tiles sent to the full model
+        """
+        scores, heatmap = self.screen(images)
+        tile_flags = self.flag_tiles(heatmap, images.shape[2:])
+        tile_flags &= (scores >= self.screen_threshold).view(-1, 1, 1)
+        probs = self.refine(images, tile_flags)
+        return probs, scores, tile_flags
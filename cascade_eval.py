@@ -0,0 +1,140 @@
+# cascade_eval.py
+import os
+import time
+import json
+import argparse
+import yaml
+import numpy as np
+import torch
+
+from utils.dataset import SegmentationDataset
+from utils.transforms import get_validation_augmentation
+from utils.model_factory import create_model
+from utils.cascade import CascadeSegmenter
+from utils.checkpoint import export_state_dict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Throughput and recall of cascade inference at several thresholds')
+    parser.add_argument('--config', type=str, default='configs/config.yaml', help='Config file path')
+    parser.add_argument('--checkpoint', type=str, required=True, help='Full model checkpoint')
+    parser.add_argument('--screen-checkpoint', type=str, required=True, help='Screening model checkpoint')
+    parser.add_argument('--split', type=str, default='val', choices=['train', 'val'], help='Labelled split to evaluate')
+    parser.add_argument('--screen-size', type=int, nargs=2, default=[375, 375], help='Screening resolution H W')
+    parser.add_argument('--region-threshold', type=float, default=0.3, help='Heatmap threshold for flagging tiles')
+    parser.add_argument('--tile-size', type=int, default=256, help='Full-resolution tile size')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7],
+                        help='Wafer-level screening thresholds to report')
+    parser.add_argument('--pixel-threshold', type=float, default=0.5, help='Threshold for the final mask')
+    parser.add_argument('--max-samples', type=int, default=None, help='Limit the number of wafers')
+    parser.add_argument('--num-threads', type=int, default=None, help='torch.set_num_threads value')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON output path')
+    return parser.parse_args()
+
+
+def load_model(checkpoint_path, config, device):
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model_config = checkpoint.get('config', config)
+    model = create_model(model_config).to(device)
+    model.load_state_dict(export_state_dict(checkpoint))
+    model.eval()
+    return model, model_config['model']['use_output_activation']
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cpu')
+
+    full_model, full_activation = load_model(args.checkpoint, config, device)
+    screen_model, screen_activation = load_model(args.screen_checkpoint, config, device)
+    cascade = CascadeSegmenter(
+        screen_model,
+        full_model,
+        screen_size=args.screen_size,
+        region_threshold=args.region_threshold,
+        tile_size=args.tile_size,
+        screen_activation=screen_activation,
+        full_activation=full_activation
+    )
+
+    split_path = config['data'][f'{args.split}_path']
+    dataset = SegmentationDataset(
+        img_dir=os.path.join(split_path, 'images'),
+        mask_dir=os.path.join(split_path, 'masks'),
+        transform=get_validation_augmentation(config)
+    )
+    num_samples = len(dataset) if args.max_samples is None else min(args.max_samples, len(dataset))
+
+    # One pass per wafer: the screen score, the stage-2 cost and the stage-2 result do not
+    # depend on the wafer threshold, so every operating point is derived from these records
+    scores, screen_times, refine_times, full_times = [], [], [], []
+    tp_pixels, gt_pixels = [], []
+    with torch.no_grad():
+        for idx in range(num_samples):
+            image, mask = dataset[idx]
+            image = image.unsqueeze(0).to(device)
+            mask = mask.unsqueeze(0).to(device) > 0.5
+
+            (score, heatmap), screen_time = timed(cascade.screen, image)
+            tile_flags = cascade.flag_tiles(heatmap, image.shape[2:])
+            probs, refine_time = timed(cascade.refine, image, tile_flags)
+            _, full_time = timed(full_model, image, False)
+
+            pred = probs > args.pixel_threshold
+            scores.append(score.item())
+            screen_times.append(screen_time)
+            refine_times.append(refine_time)
+            full_times.append(full_time)
+            tp_pixels.append((pred & mask).sum().item())
+            gt_pixels.append(mask.sum().item())
+
+    scores = np.array(scores)
+    screen_times = np.array(screen_times)
+    refine_times = np.array(refine_times)
+    tp_pixels = np.array(tp_pixels)
+    gt_pixels = np.array(gt_pixels)
+    positives = gt_pixels > 0
+
+    full_throughput = num_samples / np.sum(full_times)
+    print(f'{num_samples} wafers, {positives.sum()} with PL star; full model: {full_throughput:.2f} wafers/s')
+    print(f'{"threshold":>10}{"pass rate":>12}{"wafer recall":>14}{"pixel recall":>14}{"wafers/s":>12}{"speedup":>10}')
+
+    results = {'num_wafers': num_samples, 'num_positive': int(positives.sum()),
+               'full_model_wafers_per_s': full_throughput, 'operating_points': []}
+    for threshold in args.thresholds:
+        passed = scores >= threshold
+        total_time = screen_times.sum() + refine_times[passed].sum()
+        throughput = num_samples / total_time
+        wafer_recall = (passed & positives).sum() / max(positives.sum(), 1)
+        pixel_recall = tp_pixels[passed].sum() / max(gt_pixels.sum(), 1)
+        point = {
+            'threshold': threshold,
+            'pass_rate': float(passed.mean()),
+            'wafer_recall': float(wafer_recall),
+            'pixel_recall': float(pixel_recall),
+            'wafers_per_s': float(throughput),
+            'speedup': float(throughput / full_throughput),
+        }
+        results['operating_points'].append(point)
+        print(f'{threshold:>10.2f}{point["pass_rate"]:>12.3f}{point["wafer_recall"]:>14.3f}'
+              f'{point["pixel_recall"]:>14.3f}{throughput:>12.2f}{point["speedup"]:>9.2f}x')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
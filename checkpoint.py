@@ -0,0 +1,159 @@
+# utils/checkpoint.py
+import os
+import queue
+import threading
+import torch
+
+
+def snapshot_state(obj):
+    """
+    Copy every tensor in a (nested) checkpoint dict to CPU so training can keep
+    updating the originals while the copy is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return {k: snapshot_state(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+
+def atomic_save(state, path):
+    """Write to a temporary file, fsync, then rename so a crash never leaves a partial checkpoint"""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Persist the rename itself
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def export_state_dict(checkpoint):
+    """Weights to use for inference: the EMA copy when the run kept one, else the trained model"""
+    if checkpoint.get('ema_state_dict') is not None:
+        return checkpoint['ema_state_dict']
+    return checkpoint['model_state_dict']
+
+
+class AsyncCheckpointWriter:
+    """
+    Background checkpoint writer
+
+    save() snapshots the state on the calling thread (a device-to-host copy) and
+    returns; a worker thread then writes each file atomically. Periodic checkpoints
+    (file names starting with `periodic_prefix`) are pruned to the newest `keep_last`;
+    retention therefore only has an effect when the caller writes periodic files
+    (checkpoints.save_every > 0 in training). Other names such as latest_model.pth or
+    the in-epoch latest_step.pth are overwritten in place and never accumulate.
+    At most `max_pending` snapshots exist at any time, counting the one being written.
+    """
+    def __init__(self, save_dir, keep_last=3, periodic_prefix='checkpoint_epoch_', max_pending=1):
+        """
+        Args:
+            save_dir (str): Checkpoint directory
+            keep_last (int): Number of periodic checkpoints to keep (0 keeps all)
+            periodic_prefix (str): File name prefix identifying periodic checkpoints
+            max_pending (int): Host snapshots alive at once (queued or being written);
+                save() blocks before taking a new snapshot until one is on disk, so the
+                extra host memory is at most max_pending copies of the state
+        """
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.periodic_prefix = periodic_prefix
+        os.makedirs(save_dir, exist_ok=True)
+
+        # Pick up periodic checkpoints from earlier runs so retention spans restarts
+        self.periodic_files = sorted(
+            f for f in os.listdir(save_dir)
+            if f.startswith(periodic_prefix) and f.endswith('.pth')
+        )
+
+        # A slot is taken before the snapshot and returned once it is written
+        self.slots = threading.Semaphore(max_pending)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, filenames, remove = item
+                try:
+                    for filename in filenames:
+                        atomic_save(state, os.path.join(self.save_dir, filename))
+                        if filename.startswith(self.periodic_prefix):
+                            self._prune(filename)
+                    # Only after the new files are on disk
+                    for filename in remove:
+                        path = os.path.join(self.save_dir, filename)
+                        if os.path.exists(path):
+                            os.remove(path)
+                finally:
+                    # Drop the snapshot before freeing its slot
+                    state = item = None
+                    self.slots.release()
+            except Exception as e:  # surfaced on the next save()/close()
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _prune(self, filename):
+        if filename not in self.periodic_files:
+            self.periodic_files.append(filename)
+        if self.keep_last <= 0:
+            return
+        while len(self.periodic_files) > self.keep_last:
+            old = self.periodic_files.pop(0)
+            path = os.path.join(self.save_dir, old)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background checkpoint write failed') from error
+
+    def save(self, state, filenames, remove=()):
+        """
+        Queue a checkpoint for writing
+
+        Args:
+            state (dict): Checkpoint dict (tensors may live on any device)
+            filenames (str or list): File name(s) inside save_dir to write the same state to
+            remove (list): File name(s) to delete once this checkpoint is written (e.g. a
+                snapshot it supersedes); removal follows every earlier queued write
+        """
+        self._raise_pending_error()
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self.slots.acquire()
+        try:
+            snapshot = snapshot_state(state)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.queue.put((snapshot, list(filenames), list(remove)))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self.queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
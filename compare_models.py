@@ -0,0 +1,141 @@
+# compare_models.py
+import os
+import sys
+import time
+import json
+import argparse
+import yaml
+import numpy as np
+import torch
+
+from utils.dataset import SegmentationDataset
+from utils.transforms import get_validation_augmentation
+from utils.metrics import dice_coefficient
+from utils.model_factory import create_model, MODEL_TYPES
+from utils.checkpoint import export_state_dict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare model variants for latency and Dice on one split')
+    parser.add_argument('--config', type=str, default='configs/config.yaml', help='Config file path')
+    parser.add_argument('--split', type=str, default='val', choices=['train', 'val', 'test'], help='Dataset split')
+    parser.add_argument('--variants', type=str, nargs='+', default=['sa_unet', 'lite'],
+                        help=f'Model types to compare, one of {list(MODEL_TYPES)}')
+    parser.add_argument('--checkpoints', type=str, nargs='*', default=[],
+                        help='Checkpoints as variant=path; variants without one use random weights (latency only)')
+    parser.add_argument('--num-threads', type=int, default=None, help='torch.set_num_threads value')
+    parser.add_argument('--max-samples', type=int, default=None, help='Limit the number of samples')
+    parser.add_argument('--warmup', type=int, default=2, help='Warmup forward passes before timing')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run on')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON output path')
+    parser.add_argument('--target-speedup', type=float, default=None,
+                        help='Fail (exit code 1) unless every other variant is at least this much faster than the first')
+    return parser.parse_args()
+
+
+def get_split_path(config, split):
+    if split == 'test':
+        return config['data'].get('test_path', config['data']['val_path'].replace('val', 'test'))
+    return config['data'][f'{split}_path']
+
+
+def evaluate_variant(model, dataset, indices, device, use_output_activation, warmup=2):
+    """Time single-sample forward passes and compute Dice over the given samples"""
+    model.eval()
+    latencies = []
+    dice_scores = []
+
+    with torch.no_grad():
+        # Warm up allocator and kernels on the first sample
+        image, _ = dataset[indices[0]]
+        for _ in range(warmup):
+            model(image.unsqueeze(0).to(device), training=False)
+
+        for idx in indices:
+            image, mask = dataset[idx]
+            image = image.unsqueeze(0).to(device)
+            mask = mask.unsqueeze(0).to(device)
+
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            output = model(image, training=False)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+
+            pred = output if use_output_activation else torch.sigmoid(output)
+            dice_scores.append(dice_coefficient(pred, mask).item())
+
+    latencies = np.array(latencies) * 1000.0
+    return {
+        'latency_mean_ms': float(latencies.mean()),
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'dice': float(np.mean(dice_scores)),
+    }
+
+
+def main():
+    args = parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+
+    checkpoints = dict(item.split('=', 1) for item in args.checkpoints)
+
+    split_path = get_split_path(config, args.split)
+    dataset = SegmentationDataset(
+        img_dir=os.path.join(split_path, 'images'),
+        mask_dir=os.path.join(split_path, 'masks'),
+        transform=get_validation_augmentation(config)
+    )
+    indices = list(range(len(dataset)))
+    if args.max_samples is not None:
+        indices = indices[:args.max_samples]
+
+    results = {}
+    for variant in args.variants:
+        model = create_model(config, model_type=variant).to(device)
+        if variant in checkpoints:
+            checkpoint = torch.load(checkpoints[variant], map_location=device)
+            model.load_state_dict(export_state_dict(checkpoint))
+
+        result = evaluate_variant(
+            model, dataset, indices, device,
+            use_output_activation=config['model'].get('use_output_activation', True),
+            warmup=args.warmup
+        )
+        result['params'] = sum(p.numel() for p in model.parameters())
+        result['trained'] = variant in checkpoints
+        results[variant] = result
+
+    # Speedup is reported relative to the first variant
+    reference = results[args.variants[0]]['latency_mean_ms']
+    print(f'Split: {args.split} ({len(indices)} samples), threads: {torch.get_num_threads()}')
+    print(f'{"variant":<24}{"params":>12}{"mean ms":>12}{"p95 ms":>12}{"speedup":>10}{"dice":>10}')
+    for variant, result in results.items():
+        result['speedup'] = reference / result['latency_mean_ms']
+        dice = f'{result["dice"]:.4f}' if result['trained'] else 'n/a'
+        print(f'{variant:<24}{result["params"]:>12,}{result["latency_mean_ms"]:>12.1f}'
+              f'{result["latency_p95_ms"]:>12.1f}{result["speedup"]:>9.2f}x{dice:>10}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.target_speedup is not None:
+        missed = [v for v in args.variants[1:] if results[v]['speedup'] < args.target_speedup]
+        for variant in args.variants[1:]:
+            status = 'MISSED' if variant in missed else 'ok'
+            print(f'{variant}: {results[variant]["speedup"]:.2f}x vs target {args.target_speedup:.2f}x ({status})')
+        if missed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# compare_runs.py
+import json
+import argparse
+
+from utils.run_logger import load_events, summarize_events
+
+# Lower is better for timings and memory, higher for throughput
+ROW_ORDER = ['samples_per_s', 'data_ms', 'forward_ms', 'backward_ms', 'optimizer_ms', 'other_ms',
+             'peak_rss_mb', 'epoch_time_s', 'epochs', 'best_val_metric', 'stopped_early']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Summarize one run or compare several from their events.jsonl')
+    parser.add_argument('runs', type=str, nargs='+', help='Run directories (the first is the reference)')
+    parser.add_argument('--json', action='store_true', help='Print the summaries as JSON')
+    return parser.parse_args()
+
+
+def fmt(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return '-' if value is None else str(value)
+
+
+def main():
+    args = parse_args()
+    summaries = [summarize_events(load_events(run)) for run in args.runs]
+
+    if args.json:
+        print(json.dumps(dict(zip(args.runs, summaries)), indent=2))
+        return
+
+    keys = [k for k in ROW_ORDER if any(k in s for s in summaries)]
+    keys += sorted({k for s in summaries for k in s} - set(keys))
+    names = [run.rstrip('/').split('/')[-1] for run in args.runs]
+
+    width = max(len(k) for k in keys) + 2
+    col = max(12, *(len(n) for n in names)) + 2
+    print(''.join([''.ljust(width)] + [n.rjust(col) for n in names]))
+    for key in keys:
+        cells = []
+        reference = summaries[0].get(key)
+        for i, summary in enumerate(summaries):
+            value = summary.get(key)
+            cell = fmt(value)
+            # Ratio to the reference run for numeric rows
+            if (i > 0 and isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and isinstance(reference, (int, float)) and reference):
+                cell += f' ({value / reference:.2f}x)'
+            cells.append(cell.rjust(col))
+        print(key.ljust(width) + ''.join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# utils/config_utils.py
+import os
+import copy
+import yaml
+
+
+def default_overlay_path(config_path):
+    """Overlay written by autotune.py next to the config: configs/config.yaml -> configs/config.autotune.yaml"""
+    return os.path.splitext(config_path)[0] + '.autotune.yaml'
+
+
+def merge_config(base, overlay):
+    """Recursively merge `overlay` into a copy of `base` (overlay values win)"""
+    merged = copy.deepcopy(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(config_path, overlay_path=None):
+    """
+    Load a YAML config and apply an overlay on top of it
+
+    Args:
+        config_path (str): Base config
+        overlay_path (str): Overlay config; None uses default_overlay_path() if that
+            file exists, '' disables overlays
+
+    Returns:
+        tuple: (config, path of the applied overlay or None)
+    """
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+
+    if overlay_path is None:
+        overlay_path = default_overlay_path(config_path)
+        if not os.path.exists(overlay_path):
+            return config, None
+    elif not overlay_path:
+        return config, None
+
+    with open(overlay_path, 'r') as f:
+        overlay = yaml.safe_load(f) or {}
+    return merge_config(config, overlay), overlay_path
@@ -0,0 +1,215 @@
+# utils/detection_metrics.py
+import io
+import os
+import json
+import argparse
+import contextlib
+import multiprocessing as mp
+
+import cv2
+import numpy as np
+from scipy.io import loadmat
+
+# Pixel pitch of the haze maps (PixelSizeMm default in the simulators)
+PIXEL_SIZE_MM = 0.1
+
+
+def centers_from_plstar_info(mask_path):
+    """
+    Ground-truth centers from the simulator's placement info (plStarInfo saved in *_Mask.mat)
+
+    Returns:
+        list of (x, y) in 0-based pixel coordinates, or None if the file has no plStarInfo
+    """
+    data = loadmat(mask_path, squeeze_me=True, struct_as_record=False)
+    if 'plStarInfo' not in data:
+        return None
+    details = getattr(data['plStarInfo'], 'Details', [])
+    details = np.atleast_1d(details)
+    # MATLAB indices are 1-based
+    return [(float(d.CenterX) - 1, float(d.CenterY) - 1) for d in details]
+
+
+def centers_from_mask(mask, min_area=50):
+    """
+    Ground-truth centers from mask analysis: centroid of each connected PL-star component
+    (the six arms are symmetric about the center, so the centroid is the center unless
+    the star is clipped by the wafer edge)
+    """
+    binary = (mask > (127 if mask.max() > 1 else 0.5)).astype(np.uint8)
+    num, _, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    return [tuple(centroids[i]) for i in range(1, num) if stats[i, cv2.CC_STAT_AREA] >= min_area]
+
+
+def pad_centers(center_lists):
+    """Stack per-wafer center lists into a [B, K, 2] array padded with NaN, plus counts [B]"""
+    counts = np.array([len(c) for c in center_lists], dtype=np.int64)
+    padded = np.full((len(center_lists), max(counts.max(initial=0), 1), 2), np.nan)
+    for i, centers in enumerate(center_lists):
+        if len(centers):
+            padded[i, :len(centers)] = np.asarray(centers, dtype=np.float64)
+    return padded, counts
+
+
+def match_centers_batch(pred, gt, max_distance):
+    """
+    Greedy nearest-first matching of predicted to ground-truth centers, vectorized over wafers
+
+    Args:
+        pred: [B, P, 2] predicted centers (NaN padded)
+        gt: [B, G, 2] ground-truth centers (NaN padded)
+        max_distance: Maximum center distance (pixels) for a match
+
+    Returns:
+        matched: [B, min(P, G)] distances of the matched pairs (NaN where unmatched)
+    """
+    dist = np.linalg.norm(pred[:, :, None, :] - gt[:, None, :, :], axis=-1)
+    dist[~np.isfinite(dist) | (dist > max_distance)] = np.inf
+
+    b, p, g = dist.shape
+    matched = np.full((b, min(p, g)), np.nan)
+    rows = np.arange(b)
+    # Each step takes the closest remaining pair on every wafer at once
+    for k in range(min(p, g)):
+        flat = dist.reshape(b, -1)
+        idx = flat.argmin(axis=1)
+        best = flat[rows, idx]
+        ok = np.isfinite(best)
+        if not ok.any():
+            break
+        pi, gi = np.divmod(idx[ok], g)
+        matched[ok, k] = best[ok]
+        dist[rows[ok], pi, :] = np.inf
+        dist[rows[ok], :, gi] = np.inf
+    return matched
+
+
+def detection_metrics(pred_centers, gt_centers, max_distance_mm=2.0, pixel_size_mm=PIXEL_SIZE_MM):
+    """
+    Object-level detection metrics over many wafers
+
+    Args:
+        pred_centers: list (one per wafer) of predicted (x, y) centers
+        gt_centers: list (one per wafer) of ground-truth (x, y) centers
+        max_distance_mm: Match radius in mm
+        pixel_size_mm: Pixel pitch in mm
+
+    Returns:
+        dict: detection precision/recall/F1, wafer-level recall and center error in mm
+    """
+    pred, num_pred = pad_centers(pred_centers)
+    gt, num_gt = pad_centers(gt_centers)
+    matched = match_centers_batch(pred, gt, max_distance_mm / pixel_size_mm)
+
+    tp = np.isfinite(matched).sum(axis=1)
+    errors_mm = matched[np.isfinite(matched)] * pixel_size_mm
+    total_tp, total_pred, total_gt = int(tp.sum()), int(num_pred.sum()), int(num_gt.sum())
+    precision = total_tp / total_pred if total_pred > 0 else 1.0
+    recall = total_tp / total_gt if total_gt > 0 else 1.0
+    positive_wafers = num_gt > 0
+
+    return {
+        'num_wafers': len(pred_centers),
+        'num_pred': total_pred,
+        'num_gt': total_gt,
+        'true_positives': total_tp,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+        'wafer_recall': float((tp[positive_wafers] > 0).mean()) if positive_wafers.any() else 1.0,
+        'false_alarm_wafers': int(((num_pred > 0) & ~positive_wafers).sum()),
+        'center_error_mean_mm': float(errors_mm.mean()) if errors_mm.size else float('nan'),
+        'center_error_median_mm': float(np.median(errors_mm)) if errors_mm.size else float('nan'),
+        'center_error_p95_mm': float(np.percentile(errors_mm, 95)) if errors_mm.size else float('nan'),
+    }
+
+
+def detect_centers(binary_mask, detector='hough'):
+    """Run one of the PL-star detectors on a binary (0/1) mask and return its centers"""
+    if detector == 'hough':
+        from utils.post import detect_pl_stars_debug
+        # The Hough detector prints a summary on every call; keep batch runs quiet
+        with contextlib.redirect_stdout(io.StringIO()):
+            centers, _, _, _ = detect_pl_stars_debug(binary_mask)
+        return [(float(x), float(y)) for x, y in centers]
+    elif detector == 'plstar':
+        from utils.post_process import PLstarDetector
+        center, _, _ = PLstarDetector().detect_plstar(binary_mask * 255)
+        return [] if center is None else [(float(center[0]), float(center[1]))]
+    else:
+        raise ValueError(f"Unsupported detector: {detector}")
+
+
+def _process_wafer(item):
+    """Worker: detect predicted centers and extract ground-truth centers for one wafer"""
+    pred_path, gt_path, detector, gt_source = item
+    pred_mask = (cv2.imread(pred_path, cv2.IMREAD_GRAYSCALE) > 127).astype(np.uint8)
+    pred = detect_centers(pred_mask, detector)
+
+    gt = centers_from_plstar_info(gt_path) if gt_source == 'info' and gt_path.endswith('.mat') else None
+    if gt is None:
+        if gt_path.endswith('.mat'):
+            gt_mask = loadmat(gt_path)['maskMap']
+        else:
+            gt_mask = cv2.imread(gt_path, cv2.IMREAD_GRAYSCALE)
+        gt = centers_from_mask(gt_mask)
+    return pred, gt
+
+
+def find_gt_path(gt_dir, base_name):
+    """Ground-truth mask for a prediction written by test.py as <base>_mask.png"""
+    if base_name.endswith('_PLStar'):
+        return os.path.join(gt_dir, base_name[:-len('_PLStar')] + '_Mask.mat')
+    for ext in ['.mat', '.png', '.jpg', '.jpeg', '.tif']:
+        candidate = os.path.join(gt_dir, base_name + ext)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Object-level PL-star detection metrics')
+    parser.add_argument('--pred-dir', type=str, required=True, help='Directory of predicted masks (<base>_mask.png)')
+    parser.add_argument('--gt-dir', type=str, required=True, help='Directory of ground-truth masks')
+    parser.add_argument('--detector', type=str, default='hough', choices=['hough', 'plstar'],
+                        help='hough: detect_pl_stars_debug, plstar: PLstarDetector.detect_plstar')
+    parser.add_argument('--gt-source', type=str, default='info', choices=['info', 'mask'],
+                        help='Ground-truth centers from simulator placement info or from mask analysis')
+    parser.add_argument('--max-distance-mm', type=float, default=2.0, help='Match radius in mm')
+    parser.add_argument('--pixel-size-mm', type=float, default=PIXEL_SIZE_MM, help='Pixel pitch in mm')
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count(), help='Parallel worker processes')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON output path')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    items = []
+    for file_name in sorted(os.listdir(args.pred_dir)):
+        if not file_name.endswith('_mask.png'):
+            continue
+        gt_path = find_gt_path(args.gt_dir, file_name[:-len('_mask.png')])
+        if gt_path is None:
+            print(f'No ground truth for {file_name}, skipped')
+            continue
+        items.append((os.path.join(args.pred_dir, file_name), gt_path, args.detector, args.gt_source))
+
+    # Detection is per-wafer CPU work, so wafers are spread over processes;
+    # matching then runs once over all wafers
+    with mp.Pool(processes=args.num_workers) as pool:
+        results = pool.map(_process_wafer, items, chunksize=max(1, len(items) // (4 * args.num_workers)))
+    pred_centers = [r[0] for r in results]
+    gt_centers = [r[1] for r in results]
+
+    metrics = detection_metrics(pred_centers, gt_centers, args.max_distance_mm, args.pixel_size_mm)
+    for k, v in metrics.items():
+        print(f'{k}: {v:.4f}' if isinstance(v, float) else f'{k}: {v}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# utils/distributed.py
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initialize the default process group from the torchrun environment
+    (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT)
+
+    Returns:
+        tuple: (rank, world_size, local_rank); (0, 1, 0) when not launched by torchrun
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1, 0
+
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    return rank, world_size, local_rank
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Only rank 0 writes checkpoints, visualizations and TensorBoard logs"""
+    return get_rank() == 0
+
+
+def local_world_size():
+    """Number of processes on this node (LOCAL_WORLD_SIZE is set by torchrun)"""
+    return int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+def threads_per_process():
+    """Split the node's cores evenly between the local processes"""
+    return max(1, (os.cpu_count() or 1) // local_world_size())
+
+
+def all_reduce_sum(tensor):
+    """In-place sum over all processes (no-op without a process group)"""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_gather_object(obj):
+    """List of `obj` from every rank, indexed by rank ([obj] without a process group)"""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def unwrap_model(model):
+    """Underlying module of a DistributedDataParallel wrapper"""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
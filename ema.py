@@ -0,0 +1,92 @@
+# utils/ema.py
+import copy
+import time
+import torch
+
+
+class ModelEMA:
+    """
+    Exponential moving average of a model's weights
+
+    All floating-point parameters and buffers are updated with two multi-tensor
+    (foreach) ops per step instead of a Python loop over tensors; integer buffers
+    such as BatchNorm's num_batches_tracked are copied. The averaged copy is a
+    regular module, so it can be evaluated and saved like the model itself.
+    """
+    def __init__(self, model, decay=0.999, warmup=True):
+        """
+        Args:
+            model: Model being trained (unwrapped from DDP)
+            decay (float): EMA decay per optimizer step
+            warmup (bool): Ramp the decay as min(decay, (1 + n) / (10 + n)) so early
+                averages are not dominated by the random initialization
+        """
+        self.module = copy.deepcopy(model).eval()
+        self.module.requires_grad_(False)
+        self.decay = decay
+        self.warmup = warmup
+        self.num_updates = 0
+        self._bind(model)
+
+        # Update cost; CUDA events avoid a synchronize on every step
+        self.update_time = 0.0
+        self.timed_updates = 0
+        self._events = []
+
+    def _bind(self, model):
+        ema_tensors = list(self.module.parameters()) + list(self.module.buffers())
+        model_tensors = list(model.parameters()) + list(model.buffers())
+        self.ema_floats, self.model_floats, self.ema_other, self.model_other = [], [], [], []
+        for ema_t, model_t in zip(ema_tensors, model_tensors):
+            if ema_t.dtype.is_floating_point:
+                self.ema_floats.append(ema_t)
+                self.model_floats.append(model_t)
+            else:
+                self.ema_other.append(ema_t)
+                self.model_other.append(model_t)
+
+    def current_decay(self):
+        if self.warmup:
+            return min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+        return self.decay
+
+    @torch.no_grad()
+    def update(self):
+        """ema = decay * ema + (1 - decay) * model, for every tensor at once"""
+        use_events = self.ema_floats and self.ema_floats[0].is_cuda
+        if use_events:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start_time = time.perf_counter()
+
+        self.num_updates += 1
+        decay = self.current_decay()
+        torch._foreach_mul_(self.ema_floats, decay)
+        torch._foreach_add_(self.ema_floats, self.model_floats, alpha=1 - decay)
+        for ema_t, model_t in zip(self.ema_other, self.model_other):
+            ema_t.copy_(model_t)
+
+        if use_events:
+            end.record()
+            self._events.append((start, end))
+        else:
+            self.update_time += time.perf_counter() - start_time
+        self.timed_updates += 1
+
+    def pop_update_ms(self):
+        """Mean update time in ms since the last call (one host sync on CUDA)"""
+        if self._events:
+            self._events[-1][1].synchronize()
+            self.update_time += sum(s.elapsed_time(e) for s, e in self._events) / 1000
+            self._events = []
+        mean_ms = self.update_time / self.timed_updates * 1000 if self.timed_updates else 0.0
+        self.update_time, self.timed_updates = 0.0, 0
+        return mean_ms
+
+    def state_dict(self):
+        return self.module.state_dict()
+
+    def load_state_dict(self, state_dict, num_updates=0):
+        self.module.load_state_dict(state_dict)
+        self.num_updates = num_updates
@@ -0,0 +1,136 @@
+# evaluate.py
+import os
+import csv
+import argparse
+import yaml
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from utils.dataset import SegmentationDataset
+from utils.transforms import get_validation_augmentation
+from utils.metrics import ProbabilityHistogram
+from utils.model_factory import create_model
+from utils.checkpoint import export_state_dict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Single-pass multi-threshold evaluation from probability histograms')
+    parser.add_argument('--config', type=str, default='configs/config.yaml', help='Config file path')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Model checkpoint (not needed with --merge)')
+    parser.add_argument('--split', type=str, default='val', choices=['train', 'val', 'test'], help='Dataset split')
+    parser.add_argument('--num-bins', type=int, default=1024, help='Number of probability bins')
+    parser.add_argument('--batch-size', type=int, default=None, help='Inference batch size (default: config)')
+    parser.add_argument('--num-shards', type=int, default=1, help='Split the dataset across this many processes')
+    parser.add_argument('--shard-index', type=int, default=0, help='Shard evaluated by this process')
+    parser.add_argument('--save-hist', type=str, default=None, help='Save the histogram (.npy) for merging later')
+    parser.add_argument('--merge', type=str, nargs='+', default=None, help='Merge saved histograms instead of running inference')
+    parser.add_argument('--metric', type=str, default='dice', choices=['dice', 'iou', 'precision', 'recall'],
+                        help='Metric maximized to pick the best threshold')
+    parser.add_argument('--report-thresholds', type=float, nargs='+', default=[0.3, 0.4, 0.5, 0.6, 0.7],
+                        help='Thresholds printed in the summary table')
+    parser.add_argument('--output-dir', type=str, default='results/evaluation', help='Where curves and PR plot are written')
+    return parser.parse_args()
+
+
+def get_split_path(config, split):
+    if split == 'test':
+        return config['data'].get('test_path', config['data']['val_path'].replace('val', 'test'))
+    return config['data'][f'{split}_path']
+
+
+def collect_histogram(args, config, device):
+    """Run inference over (a shard of) the split and accumulate the probability histogram"""
+    model = create_model(config).to(device)
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+    model.load_state_dict(export_state_dict(checkpoint))
+    model.eval()
+
+    split_path = get_split_path(config, args.split)
+    dataset = SegmentationDataset(
+        img_dir=os.path.join(split_path, 'images'),
+        mask_dir=os.path.join(split_path, 'masks'),
+        transform=get_validation_augmentation(config)
+    )
+    if args.num_shards > 1:
+        dataset = Subset(dataset, list(range(args.shard_index, len(dataset), args.num_shards)))
+
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size or config['data']['batch_size'],
+        shuffle=False,
+        num_workers=config['data'].get('num_workers', 4)
+    )
+
+    histogram = ProbabilityHistogram(num_bins=args.num_bins, device=device)
+    with torch.inference_mode():
+        for batch in tqdm(loader, desc='Evaluating'):
+            images, masks = batch[0].to(device), batch[1].to(device)
+            outputs = model(images, training=False)
+            if not config['model']['use_output_activation']:
+                outputs = torch.sigmoid(outputs)
+            histogram.update(outputs, masks)
+    return histogram
+
+
+def write_curves(curves, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    keys = ['thresholds', 'precision', 'recall', 'dice', 'iou', 'tp', 'fp', 'fn', 'tn']
+    with open(os.path.join(output_dir, 'threshold_curves.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(keys)
+        for row in zip(*(curves[k] for k in keys)):
+            writer.writerow([f'{v:.6g}' for v in row])
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(6, 6))
+    plt.plot(curves['recall'], curves['precision'])
+    plt.xlabel('Recall')
+    plt.ylabel('Precision')
+    plt.title('Pixel-level PR curve')
+    plt.grid(True)
+    plt.savefig(os.path.join(output_dir, 'pr_curve.png'))
+    plt.close()
+
+
+def main():
+    args = parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    if args.merge:
+        histogram = ProbabilityHistogram.load(args.merge[0])
+        for path in args.merge[1:]:
+            histogram.merge(ProbabilityHistogram.load(path))
+    else:
+        if args.checkpoint is None:
+            raise ValueError('--checkpoint is required unless --merge is given')
+        histogram = collect_histogram(args, config, device)
+
+    if args.save_hist:
+        histogram.save(args.save_hist)
+        print(f'Histogram saved to {args.save_hist}')
+    # A shard on its own is only part of the split, so leave reporting to the merge step
+    if args.num_shards > 1 and not args.merge:
+        return
+
+    curves = histogram.curves()
+    print(f'{"threshold":>10}{"precision":>12}{"recall":>10}{"dice":>10}{"iou":>10}')
+    for threshold in args.report_thresholds:
+        k = min(int(round(threshold * histogram.num_bins)), histogram.num_bins - 1)
+        print(f'{curves["thresholds"][k]:>10.3f}{curves["precision"][k]:>12.4f}{curves["recall"][k]:>10.4f}'
+              f'{curves["dice"][k]:>10.4f}{curves["iou"][k]:>10.4f}')
+
+    best_threshold, best_value = histogram.best_threshold(args.metric)
+    print(f'Best threshold by {args.metric}: {best_threshold:.4f} ({args.metric} = {best_value:.4f})')
+
+    write_curves(curves, args.output_dir)
+    print(f'Curves written to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,76 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def _zero_invalid(pred, target, valid_mask=None):
+    """
+    Zero off-wafer predictions and targets before the activation and BCE
+
+    Masking only the loss terms is not enough: the backward pass multiplies the
+    zero upstream gradient by the sigmoid/BCE derivative, which is NaN at a NaN
+    input, so NaN would still reach the model. masked_fill on the inputs passes
+    an exact zero gradient to those pixels instead.
+    """
+    if valid_mask is None:
+        return pred, target
+    return pred.masked_fill(~valid_mask, 0), target.masked_fill(~valid_mask, 0)
+
+def _overlap_sums(prob, target, valid_mask=None, reduction='batch'):
+    """
+    Compute TP, prediction sum and target sum in one pass
+    
+    Args:
+        prob: Probabilities [B,1,H,W]
+        target: Binary targets [B,1,H,W]
+        valid_mask: Optional boolean mask [B,1,H,W]; False pixels (off-wafer) are excluded
+        reduction: 'batch' sums over the whole batch (scalars),
+                   'sample' sums per sample (tensors of shape [B])
+    """
+    if valid_mask is not None:
+        # Off-wafer pixels still hold sigmoid(0) = 0.5 after _zero_invalid, so they
+        # are removed from the sums here
+        prob = prob.masked_fill(~valid_mask, 0)
+        target = target.masked_fill(~valid_mask, 0)
+    
+    if reduction == 'sample':
+        prob = prob.flatten(1)
+        target = target.flatten(1)
+        return (prob * target).sum(1), prob.sum(1), target.sum(1)
+    elif reduction == 'batch':
+        prob = prob.reshape(-1)
+        target = target.reshape(-1)
+        return (prob * target).sum(), prob.sum(), target.sum()
+    else:
+        raise ValueError(f"Unsupported reduction: {reduction}")
+
+def _masked_mean(loss, valid_mask=None, reduction='batch'):
+    """Mean of an element-wise loss over valid pixels, over the whole batch or per sample"""
+    if valid_mask is None:
+        if reduction == 'sample':
+            return loss.flatten(1).mean(1).mean()
+        return loss.mean()
+    
+    loss = loss.masked_fill(~valid_mask, 0)
+    if reduction == 'sample':
+        count = valid_mask.flatten(1).sum(1).clamp_min(1)
+        return (loss.flatten(1).sum(1) / count).mean()
+    return loss.sum() / valid_mask.sum().clamp_min(1)
+
 class DiceLoss(nn.Module):
-    def __init__(self, smooth=1.0, activation='sigmoid'):
+    def __init__(self, smooth=1.0, activation='sigmoid', reduction='batch'):
         super(DiceLoss, self).__init__()
         self.smooth = smooth
         self.activation = activation
+        self.reduction = reduction
         
-    def forward(self, pred, target):
+    def forward(self, pred, target, valid_mask=None):
+        pred, target = _zero_invalid(pred, target, valid_mask)
         if self.activation == 'sigmoid':
             pred = torch.sigmoid(pred)
         
-        # Flatten predictions and targets
-        pred = pred.view(-1)
-        target = target.view(-1)
-        
-        intersection = (pred * target).sum()
-        dice = (2.0 * intersection + self.smooth) / (pred.sum() + target.sum() + self.smooth)
-        return 1.0 - dice
+        # Per-sample reduction makes the loss independent of batch composition
+        intersection, pred_sum, target_sum = _overlap_sums(pred, target, valid_mask, self.reduction)
+        dice = (2.0 * intersection + self.smooth) / (pred_sum + target_sum + self.smooth)
+        return (1.0 - dice).mean()
 
 class FocalLoss(nn.Module):
     def __init__(self, alpha=0.25, gamma=2.0, reduction='mean', activation='sigmoid'):
@@ -55,88 +108,165 @@ class FocalLoss(nn.Module):
             return loss
 
 class TverskyLoss(nn.Module):
-    def __init__(self, alpha=0.5, beta=0.5, smooth=1.0, activation='sigmoid'):
+    def __init__(self, alpha=0.5, beta=0.5, smooth=1.0, activation='sigmoid', reduction='batch'):
         super(TverskyLoss, self).__init__()
         self.alpha = alpha
         self.beta = beta
         self.smooth = smooth
         self.activation = activation
+        self.reduction = reduction
         
-    def forward(self, pred, target):
+    def forward(self, pred, target, valid_mask=None):
+        pred, target = _zero_invalid(pred, target, valid_mask)
         if self.activation == 'sigmoid':
             pred = torch.sigmoid(pred)
         
-        # Flatten predictions and targets
-        pred = pred.view(-1)
-        target = target.view(-1)
-        
-        # True Positive, False Positive, False Negative
-        TP = (pred * target).sum()
-        FP = (pred * (1 - target)).sum()
-        FN = ((1 - pred) * target).sum()
+        # True Positive, False Positive, False Negative (FP and FN follow from the sums)
+        TP, pred_sum, target_sum = _overlap_sums(pred, target, valid_mask, self.reduction)
+        FP = pred_sum - TP
+        FN = target_sum - TP
         
         # Tversky index
         tversky = (TP + self.smooth) / (TP + self.alpha * FP + self.beta * FN + self.smooth)
-        return 1 - tversky
+        return (1 - tversky).mean()
 
 class CombinedLoss(nn.Module):
+    """
+    Weighted sum of BCE, Dice, Focal and Tversky losses computed in a single fused pass.
+    Probabilities and the element-wise BCE are computed once and shared by all
+    components, and components with zero weight are skipped entirely.
+    """
     def __init__(self, config):
         super(CombinedLoss, self).__init__()
         # Load configuration
         self.dice_weight = config['loss']['dice_weight']
         self.bce_weight = config['loss']['bce_weight']
         self.focal_weight = config['loss']['focal_weight']
+        self.tversky_weight = 1 - self.bce_weight - self.dice_weight - self.focal_weight
+        # Optional boundary term on signed distance maps (https://arxiv.org/abs/1812.07032),
+        # added on top of the weights above
+        self.boundary_weight = config['loss'].get('boundary_weight', 0)
         
         # Get activation type, default to 'sigmoid' if not specified
-        activation = config['loss'].get('activation', 'sigmoid')
+        self.activation = config['loss'].get('activation', 'sigmoid')
         
-        # Initialize loss components
-        if activation == 'sigmoid':
-            self.bce = nn.BCEWithLogitsLoss()
-        else:
-            self.bce = nn.BCELoss()
+        # 'batch' pools pixels over the whole batch, 'sample' averages per-sample losses
+        self.reduction = config['loss'].get('reduction', 'batch')
         
-        self.dice = DiceLoss(activation=activation)
-        self.focal = FocalLoss(
-            alpha=config['loss']['focal_alpha'],
-            gamma=config['loss']['focal_gamma'],
-            activation=activation
-        )
-        self.tversky = TverskyLoss(
-            alpha=config['loss']['tversky_alpha'],
-            beta=config['loss']['tversky_beta'],
-            activation=activation
-        )
+        # Component parameters (same defaults as the standalone losses)
+        self.smooth = 1.0
+        self.focal_alpha = config['loss']['focal_alpha']
+        self.focal_gamma = config['loss']['focal_gamma']
+        self.tversky_alpha = config['loss']['tversky_alpha']
+        self.tversky_beta = config['loss']['tversky_beta']
+        self.boundary_max_distance = config['loss'].get('boundary_max_distance', 20.0)
     
-    def forward(self, pred, target):
-        # Calculate component losses
-        bce_loss = self.bce(pred, target)
-        dice_loss = self.dice(pred, target)
-        focal_loss = self.focal(pred, target)
-        tversky_loss = self.tversky(pred, target)
-        
-        # Combined loss
-        loss = (self.bce_weight * bce_loss + 
-                self.dice_weight * dice_loss + 
-                self.focal_weight * focal_loss +
-                (1 - self.bce_weight - self.dice_weight - self.focal_weight) * tversky_loss)
-        
-        return loss, {
-            'bce': bce_loss.item(),
-            'dice': dice_loss.item(),
-            'focal': focal_loss.item(),
-            'tversky': tversky_loss.item()
+    def forward(self, pred, target, valid_mask=None, dist_map=None):
+        """
+        Args:
+            pred: Model output [B,1,H,W]
+            target: Binary targets [B,1,H,W]
+            valid_mask: Optional boolean mask [B,1,H,W]; off-wafer pixels (False)
+                are excluded from every component
+            dist_map: Signed distance maps of the targets [B,1,H,W]; required
+                when boundary_weight is non-zero
+        
+        Returns:
+            loss: Combined loss
+            components: Dict of detached component tensors; only non-zero-weighted
+                components are present. No host sync happens here, so callers can
+                accumulate them on device and convert once per epoch.
+        """
+        pred, target = _zero_invalid(pred, target, valid_mask)
+        prob = torch.sigmoid(pred) if self.activation == 'sigmoid' else pred
+        components = {}
+        
+        # Element-wise BCE is shared by the BCE and Focal terms
+        if self.bce_weight != 0 or self.focal_weight != 0:
+            if self.activation == 'sigmoid':
+                bce = F.binary_cross_entropy_with_logits(pred, target, reduction='none')
+            else:
+                bce = F.binary_cross_entropy(pred, target, reduction='none')
+            
+            if self.bce_weight != 0:
+                components['bce'] = _masked_mean(bce, valid_mask, self.reduction)
+            
+            if self.focal_weight != 0:
+                pt = target * prob + (1 - target) * (1 - prob)
+                focal_weight = (1 - pt) ** self.focal_gamma
+                alpha_weight = target * self.focal_alpha + (1 - target) * (1 - self.focal_alpha)
+                components['focal'] = _masked_mean(alpha_weight * focal_weight * bce, valid_mask, self.reduction)
+        
+        # Overlap sums are shared by the Dice and Tversky terms (FP and FN follow from TP)
+        if self.dice_weight != 0 or self.tversky_weight != 0:
+            tp, prob_sum, target_sum = _overlap_sums(prob, target, valid_mask, self.reduction)
+            
+            if self.dice_weight != 0:
+                dice = (2.0 * tp + self.smooth) / (prob_sum + target_sum + self.smooth)
+                components['dice'] = (1.0 - dice).mean()
+            
+            if self.tversky_weight != 0:
+                fp = prob_sum - tp
+                fn = target_sum - tp
+                tversky = (tp + self.smooth) / (tp + self.tversky_alpha * fp + self.tversky_beta * fn + self.smooth)
+                components['tversky'] = (1 - tversky).mean()
+        
+        if self.boundary_weight != 0:
+            if dist_map is None:
+                raise ValueError("boundary_weight is non-zero but no distance map was given")
+            # Clip far-away distances so the term stays on the scale of the other losses
+            dist_map = dist_map.clamp(-self.boundary_max_distance, self.boundary_max_distance) / self.boundary_max_distance
+            components['boundary'] = _masked_mean(prob * dist_map, valid_mask, self.reduction)
+        
+        # Combined loss (same summation order as the individual terms)
+        weights = {
+            'bce': self.bce_weight,
+            'dice': self.dice_weight,
+            'focal': self.focal_weight,
+            'tversky': self.tversky_weight,
+            'boundary': self.boundary_weight
         }
+        loss = sum(weights[k] * components[k] for k in weights if k in components)
+        
+        return loss, {k: v.detach() for k, v in components.items()}
+
+@torch.no_grad()
+def per_sample_loss(pred, target, valid_mask=None, activation='sigmoid', smooth=1.0):
+    """
+    Per-sample BCE + soft Dice loss, used to rank samples by difficulty
+    
+    Computed without gradients from the same forward pass as the training loss,
+    with one reduction per term for the whole batch.
+    
+    Returns:
+        Tensor of shape [B] (on the device of pred)
+    """
+    pred, target = _zero_invalid(pred.float(), target, valid_mask)
+    if activation == 'sigmoid':
+        prob = torch.sigmoid(pred)
+        bce = F.binary_cross_entropy_with_logits(pred, target, reduction='none')
+    else:
+        prob = pred
+        bce = F.binary_cross_entropy(pred, target, reduction='none')
+    
+    if valid_mask is None:
+        bce = bce.flatten(1).mean(1)
+    else:
+        bce = bce.masked_fill(~valid_mask, 0).flatten(1).sum(1) / valid_mask.flatten(1).sum(1).clamp_min(1)
+    tp, prob_sum, target_sum = _overlap_sums(prob, target, valid_mask, reduction='sample')
+    dice = (2.0 * tp + smooth) / (prob_sum + target_sum + smooth)
+    return bce + (1.0 - dice)
 
 def get_loss_function(config):
     """Get loss function based on configuration"""
     loss_type = config['loss']['type'].lower()
     activation = config['loss'].get('activation', 'sigmoid')
+    reduction = config['loss'].get('reduction', 'batch')
     
     if loss_type == 'bce':
         return nn.BCEWithLogitsLoss() if activation == 'sigmoid' else nn.BCELoss()
     elif loss_type == 'dice':
-        return DiceLoss(activation=activation)
+        return DiceLoss(activation=activation, reduction=reduction)
     elif loss_type == 'focal':
         return FocalLoss(
             alpha=config['loss']['focal_alpha'],
@@ -147,7 +277,8 @@ def get_loss_function(config):
         return TverskyLoss(
             alpha=config['loss']['tversky_alpha'],
             beta=config['loss']['tversky_beta'],
-            activation=activation
+            activation=activation,
+            reduction=reduction
         )
     elif loss_type == 'combined':
         return CombinedLoss(config)
@@ -1,33 +1,47 @@
 # train.py
 import os
 import time
-import yaml
+import json
 import argparse
-import numpy as np
+import contextlib
 from tqdm import tqdm
 import torch
-import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
-from models.unet import UNet
 from utils.dataset import SegmentationDataset
 from utils.transforms import get_training_augmentation, get_validation_augmentation
-from utils.metrics import calculate_metrics
-from losses.loss_functions import get_loss_function
-from utils.visualization import visualize_predictions
+from utils.metrics import MetricAccumulator
+from losses.loss_functions import get_loss_function, per_sample_loss, CombinedLoss, DiceLoss, TverskyLoss
+from utils.visualization import VisualizationWorker
+from utils.model_factory import create_model
+from utils.config_utils import load_config
+from utils.checkpoint import AsyncCheckpointWriter
+from utils.seed_utils import set_rank_seed, worker_init_fn, get_rng_state, set_rng_state
+from utils.distributed import (
+    init_distributed, cleanup_distributed, is_main_process,
+    threads_per_process, all_reduce_sum, all_gather_object
+)
+from utils.samplers import ResumableSampler, LossWeightedSampler
+from utils.profiling import add_profiler_args, create_profiler, StepProfiler
+from utils.val_cache import CachedValidationSet
+from utils.ema import ModelEMA
+from utils.run_logger import RunLogger, StepTimer, make_run_dir, run_start_fields
+from utils.resources import peak_rss_mb
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train U-Net model for segmentation')
     parser.add_argument('--config', type=str, default='configs/config.yaml', help='配置文件路径')
     parser.add_argument('--resume', type=str, default=None, help='恢复训练的检查点路径')
+    parser.add_argument('--overlay', type=str, default=None,
+                        help='覆盖配置 (默认使用autotune.py生成的<config>.autotune.yaml, 传空字符串则不使用)')
+    parser.add_argument('--log-interval', type=int, default=None,
+                        help='每K步刷新一次进度条 (会同步一次); 设为1即逐步同步, 用于对比步耗时')
+    add_profiler_args(parser)
     return parser.parse_args()
 
-def load_config(config_path):
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f)
-    return config
-
 def get_lr_scheduler(optimizer, config):
     """获取学习率调度器"""
     scheduler_type = config['training']['lr_scheduler'].lower()
@@ -56,59 +70,243 @@ def get_lr_scheduler(optimizer, config):
     else:
         raise ValueError(f"不支持的调度器类型: {scheduler_type}")
 
-def main():
-    # 解析参数和配置
-    args = parse_args()
-    config = load_config(args.config)
+def get_amp_settings(config, device):
+    """
+    混合精度设置
     
-    # 创建保存目录
-    os.makedirs(config['checkpoints']['save_dir'], exist_ok=True)
-    os.makedirs(config['visualization']['save_path'], exist_ok=True)
+    Returns:
+        use_amp: 是否启用autocast
+        amp_dtype: autocast数据类型 (CPU默认bfloat16, CUDA默认float16)
+        use_scaler: 是否需要GradScaler (仅float16需要损失缩放)
+    """
+    use_amp = config['training'].get('amp', False)
+    default_dtype = 'float16' if device.type == 'cuda' else 'bfloat16'
+    amp_dtype = getattr(torch, config['training'].get('amp_dtype', default_dtype))
+    # 只在启用混合精度时检查 (amp关闭时amp_dtype不起作用)
+    if use_amp and device.type == 'cpu' and amp_dtype != torch.bfloat16:
+        raise ValueError('CPU上的autocast只支持bfloat16')
+    use_scaler = use_amp and amp_dtype == torch.float16
+    return use_amp, amp_dtype, use_scaler
+
+def get_resolution_stages(config):
+    """
+    渐进式分辨率计划 (training.progressive_resolution), 例如1500x1500的输入:
+        progressive_resolution:
+          - {epochs: 10, downsample: 4, batch_size: 32}   # 375x375
+          - {epochs: 10, downsample: 2, batch_size: 8}    # 750x750
+          - {downsample: 1}                               # 1500x1500, 剩余的epoch
+    最后一个阶段覆盖剩余的所有epoch; 未指定batch_size时使用data.batch_size
     
-    # 设置设备
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f'使用设备: {device}')
+    Returns:
+        [(结束epoch, 下采样倍数, 批大小), ...], 未配置时只有全分辨率一个阶段
+    """
+    schedule = config['training'].get('progressive_resolution') or [{}]
+    stages, end_epoch = [], 0
+    for i, stage in enumerate(schedule):
+        if i + 1 < len(schedule):
+            end_epoch += stage['epochs']
+        else:
+            end_epoch = float('inf')
+        stages.append((end_epoch, stage.get('downsample', 1), stage.get('batch_size', config['data']['batch_size'])))
+    return stages
+
+def peak_memory_mb(device):
+    """进程峰值内存 (CUDA为显存峰值, CPU为RSS峰值)"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / (1024 * 1024)
+    return peak_rss_mb()
+
+def compute_loss(criterion, outputs, masks, extras):
+    """
+    计算损失
     
-    # 创建数据集
-    train_transform = get_training_augmentation(config)
-    val_transform = get_validation_augmentation(config)
+    Returns:
+        loss: 损失张量
+        components: CombinedLoss的各损失组件 (detached张量), 其他损失为空字典
+    """
+    valid_mask = extras.get('valid')
+    if isinstance(criterion, CombinedLoss):
+        # CombinedLoss返回多个损失
+        return criterion(outputs, masks, valid_mask=valid_mask, dist_map=extras.get('dist'))
+    elif isinstance(criterion, (DiceLoss, TverskyLoss)):
+        return criterion(outputs, masks, valid_mask=valid_mask), {}
+    # 简单损失函数
+    return criterion(outputs, masks), {}
+
+def build_datasets(config):
+    """创建训练集和验证集 (autotune.py的探测也使用这里的设置, 与训练一致)"""
+    # 是否使用晶圆有效区域掩码 (晶圆外像素不参与损失计算)
+    use_valid_mask = config['data'].get('use_valid_mask', False)
+    
+    # 边界损失需要带符号距离图, 每个样本只计算一次并缓存在数据集目录下
+    use_distance_maps = config['loss'].get('boundary_weight', 0) > 0
+    
+    def distance_map_dir(split_path):
+        return os.path.join(split_path, 'distance_maps') if use_distance_maps else None
+    
+    # 解码缓存 (可由多次运行共享, 如超参数搜索的各个试验)
+    def decoded_cache_dir(split):
+        cache_root = config['data'].get('decoded_cache_dir')
+        return os.path.join(cache_root, split) if cache_root else None
     
     train_dataset = SegmentationDataset(
         img_dir=os.path.join(config['data']['train_path'], 'images'),
         mask_dir=os.path.join(config['data']['train_path'], 'masks'),
-        transform=train_transform
+        transform=get_training_augmentation(config),
+        return_valid_mask=use_valid_mask,
+        distance_map_dir=distance_map_dir(config['data']['train_path']),
+        decoded_cache_dir=decoded_cache_dir('train')
     )
     
     val_dataset = SegmentationDataset(
         img_dir=os.path.join(config['data']['val_path'], 'images'),
         mask_dir=os.path.join(config['data']['val_path'], 'masks'),
-        transform=val_transform
+        transform=get_validation_augmentation(config),
+        return_valid_mask=use_valid_mask,
+        distance_map_dir=distance_map_dir(config['data']['val_path']),
+        decoded_cache_dir=decoded_cache_dir('val')
     )
+    return train_dataset, val_dataset
+
+def unpack_batch(batch, device):
+    """拆分批次为 (images, masks, extras), extras包含有效区域掩码等额外目标"""
+    images = batch[0].to(device)
+    masks = batch[1].to(device)
+    extras = {k: v.to(device) for k, v in batch[2].items()} if len(batch) > 2 else {}
+    return images, masks, extras
+
+def main():
+    # 解析参数和配置
+    args = parse_args()
+    config, overlay_path = load_config(args.config, args.overlay)
     
-    # 创建数据加载器
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=config['data']['batch_size'],
-        shuffle=True,
-        num_workers=4,
-        pin_memory=True,
-        drop_last=True
-    )
+    # 分布式训练 (torchrun启动时WORLD_SIZE>1, 否则为单进程), 例如:
+    #   单节点: torchrun --standalone --nproc_per_node=4 main.py --config ...
+    #   多节点: torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 --rdzv_endpoint=host:29500 main.py --config ...
+    rank, world_size, local_rank = init_distributed(config['training'].get('dist_backend', 'gloo'))
+    is_main = is_main_process()
+    distributed = world_size > 1
+    # 只有rank 0输出日志
+    log = print if is_main else (lambda *args, **kwargs: None)
+    
+    # 每个进程不同的随机种子 (数据增强互不相同)
+    seed = config['training'].get('seed', 42)
+    set_rank_seed(seed, rank,
+                  deterministic=config['training'].get('deterministic', False))
+    
+    # 创建保存目录
+    if is_main:
+        os.makedirs(config['checkpoints']['save_dir'], exist_ok=True)
+        os.makedirs(config['visualization']['save_path'], exist_ok=True)
+    
+    # 设置设备
+    if torch.cuda.is_available():
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+        # 同一节点上的进程平分CPU核心, 避免线程超额订阅
+        if distributed:
+            torch.set_num_threads(config['training'].get('num_threads') or threads_per_process())
+    log(f'使用设备: {device}, 进程数: {world_size}, 每进程线程数: {torch.get_num_threads()}')
+    if overlay_path:
+        log(f'已应用覆盖配置: {overlay_path}')
+    
+    # 性能分析: 只在rank 0上对训练的前若干步采样 (wait/warmup/active可配置)
+    profiler = create_profiler(args, config, default_dir='profiles/train') if is_main else StepProfiler()
+    if profiler.enabled and profiler.profile_data:
+        # 在主进程中加载数据, 数据集读取与数据增强才会出现在trace中
+        config['data']['num_workers'] = 0
+    
+    # 创建数据集
+    train_dataset, val_dataset = build_datasets(config)
+    use_distance_maps = train_dataset.distance_map_dir is not None
+    
+    # 创建数据加载器 (分布式时每个进程只读取自己的分片, batch_size为每进程批大小)
+    # 训练顺序只由(seed, epoch)决定, 可从epoch中间的任意批次继续
+    # 验证集分片时DistributedSampler会补齐重复样本, 使各进程批次数一致
+    # 难例采样: 按各样本最近的训练损失抽取下一个epoch (每个样本保留最低概率floor/N)
+    hard_example_config = config['data'].get('hard_example_sampling', {})
+    hard_example_sampling = hard_example_config.get('enabled', False)
+    if hard_example_sampling:
+        train_sampler = LossWeightedSampler(
+            train_dataset,
+            floor=hard_example_config.get('floor', 0.2),
+            momentum=hard_example_config.get('momentum', 0.5),
+            seed=seed,
+            drop_last=True
+        )
+    else:
+        train_sampler = ResumableSampler(train_dataset, shuffle=True, seed=seed, drop_last=True)
+    val_sampler = DistributedSampler(val_dataset, shuffle=False) if distributed else None
+    
+    # 训练加载器在分辨率阶段切换时重建 (worker中的数据集副本需要新的下采样倍数);
+    # 同一阶段内worker常驻, 不在每个epoch重新启动
+    def build_train_loader(batch_size):
+        num_workers = config['data'].get('num_workers', 4)
+        return DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=train_sampler,
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=True,
+            worker_init_fn=worker_init_fn,
+            persistent_workers=num_workers > 0
+        )
     
     val_loader = DataLoader(
         val_dataset,
         batch_size=config['data']['batch_size'],
         shuffle=False,
-        num_workers=4,
-        pin_memory=True
+        sampler=val_sampler,
+        num_workers=config['data'].get('num_workers', 4),
+        pin_memory=True,
+        worker_init_fn=worker_init_fn
     )
     
+    # 验证设置: 每val_every_n_epochs个epoch做一次完整验证, 其余epoch可只在固定子集上快速验证
+    val_config = config.get('validation', {})
+    val_every_n_epochs = config['training'].get('val_every_n_epochs', 1)
+    val_subset_fraction = val_config.get('subset_fraction', 0)
+    val_batch_size = val_config.get('batch_size', config['data']['batch_size'])
+    # 可视化按完整验证的次数计: 每visualization.every_n_validations次完整验证保存一次 (与val_every_n_epochs无关)
+    visualize_every = config['visualization'].get('every_n_validations', 5)
+    
+    # 验证预处理是确定性的: 可只解码一次, 存为连续张量 (内存或内存映射)
+    val_cache = None
+    if val_config.get('cache', 'none') != 'none':
+        val_shard = list(range(rank, len(val_dataset), world_size))
+        cache_key = json.dumps({
+            'files': val_dataset.img_files,
+            'data': {k: config['data'].get(k) for k in ('img_size', 'channels', 'use_valid_mask')},
+            # 验证变换只做归一化, 其余增强参数不影响缓存内容
+            'normalize': {k: config['augmentation'].get(k) for k in ('use_normalize', 'normalize_mean', 'normalize_std')},
+            'distance_maps': use_distance_maps,
+            'shard': [rank, world_size],
+        }, sort_keys=True)
+        val_cache = CachedValidationSet.build(
+            val_dataset,
+            indices=val_shard,
+            max_memory_mb=val_config.get('max_memory_mb', 4096),
+            cache_dir=val_config.get('cache_dir', os.path.join(config['data']['val_path'], 'cache')),
+            cache_key=cache_key,
+            num_workers=config['data'].get('num_workers', 4),
+            mode=val_config['cache']
+        )
+        log(f'验证集已缓存: {len(val_cache)} 个样本/进程 (模式: {val_config["cache"]})')
+    val_subset = None
+    if val_subset_fraction > 0:
+        if val_cache is None:
+            raise ValueError('validation.subset_fraction需要启用validation.cache')
+        val_subset = val_cache.subset_indices(val_subset_fraction, seed=seed)
+    
     # 创建模型
-    model = UNet(config).to(device)
+    model = create_model(config).to(device)
     
     # 总参数数量
     total_params = sum(p.numel() for p in model.parameters())
-    print(f'模型总参数: {total_params:,}')
+    log(f'模型总参数: {total_params:,}')
     
     # 创建损失函数和优化器
     criterion = get_loss_function(config)
@@ -118,220 +316,486 @@ def main():
         weight_decay=config['training']['weight_decay']
     )
     
-    # 学习率调度器
+    # 学习率调度器 (按epoch更新, 不受梯度累积影响)
     scheduler = get_lr_scheduler(optimizer, config)
     
-    # TensorBoard
-    writer = SummaryWriter(log_dir='runs/experiment')
+    # 混合精度与梯度累积
+    use_amp, amp_dtype, use_scaler = get_amp_settings(config, device)
+    scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+    accumulation_steps = config['training'].get('accumulation_steps', 1)
+    log(f'混合精度: {amp_dtype if use_amp else "关闭"}, 梯度累积: {accumulation_steps} 步')
+    
+    # 渐进式分辨率: 前期在下采样的图上用大批次训练, 之后逐步提高到全分辨率 (验证始终为全分辨率)
+    resolution_stages = get_resolution_stages(config)
+    if len(resolution_stages) > 1:
+        log('渐进式分辨率: ' + ', '.join(
+            f'epoch <= {min(end, config["training"]["epochs"])}: 1/{factor}, batch {bs}'
+            for end, factor, bs in resolution_stages))
+    
+    # 每次运行使用独立的运行目录 (JSONL事件日志与TensorBoard), 只在rank 0上写入
+    run_logger, writer = None, None
+    if is_main:
+        logging_config = config.get('logging', {})
+        run_dir = logging_config.get('run_dir')
+        if run_dir:
+            os.makedirs(run_dir, exist_ok=True)
+        else:
+            run_name = os.path.splitext(os.path.basename(args.config))[0]
+            run_dir = make_run_dir(logging_config.get('root', 'runs'), name=run_name)
+        run_logger = RunLogger(run_dir)
+        run_logger.log('run_start', **run_start_fields(config, world_size, device))
+        writer = SummaryWriter(log_dir=os.path.join(run_dir, 'tensorboard'))
+        log(f'运行目录: {run_dir}')
+    
+    # 后台检查点写入 (原子写入, 周期性检查点只保留最近keep_last个)
+    # keep_last只作用于save_every产生的checkpoint_epoch_*.pth; latest_model.pth, best_model.pth
+    # 和epoch内快照latest_step.pth都是单个文件原地覆盖, 不会累积
+    checkpoint_writer = AsyncCheckpointWriter(
+        config['checkpoints']['save_dir'],
+        keep_last=config['checkpoints'].get('keep_last', 3)
+    ) if is_main else None
+    save_every = config['checkpoints'].get('save_every', 0)
+    if save_every <= 0 and 'keep_last' in config['checkpoints']:
+        log('警告: checkpoints.save_every为0, 不保存周期性检查点, keep_last不起作用')
+    # epoch内快照: 每save_every_steps个优化器步写一次latest_step.pth (0为关闭)
+    save_every_steps = config['checkpoints'].get('save_every_steps', 0)
+    
+    # 后台可视化进程 (作图不占用验证时间)
+    visualizer = VisualizationWorker() if is_main else None
+    
+    # 损失在设备上累加, 只在每log_interval步刷新进度条时同步
+    log_interval = args.log_interval or config['training'].get('log_interval', 20)
+    # 每log_interval步记录一次各阶段耗时 (数据等待/前向/反向/优化器)、吞吐量与RSS
+    step_timer = StepTimer(interval=log_interval)
     
     # 初始化训练状态
     start_epoch = 0
+    start_batch = 0  # 恢复时在start_epoch内已完成的批次数
+    resume_epoch_state = None
     best_val_metric = 0 if config['checkpoints']['mode'] == 'max' else float('inf')
     early_stopping_counter = 0
     
     # 如果继续训练
     if args.resume:
-        checkpoint = torch.load(args.resume)
+        checkpoint = torch.load(args.resume, map_location=device)
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-        start_epoch = checkpoint['epoch'] + 1
+        if 'scaler_state_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if 'scheduler_state_dict' in checkpoint:
+            scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        early_stopping_counter = checkpoint.get('early_stopping_counter', 0)
         best_val_metric = checkpoint['best_val_metric']
-        print(f'从 epoch {start_epoch} 恢复训练')
+        
+        # 各进程的随机数状态和epoch内累计量 (按rank保存)
+        rank_states = checkpoint.get('rank_states')
+        same_world = rank_states is not None and len(rank_states) == world_size
+        if rank_states is not None:
+            set_rng_state(rank_states[rank if same_world else 0]['rng'])
+        
+        if checkpoint.get('batch_idx') is not None and same_world:
+            # epoch内快照: 从下一个批次继续, 已读取的数据不再加载
+            start_epoch = checkpoint['epoch']
+            start_batch = checkpoint['batch_idx']
+            resume_epoch_state = rank_states[rank]
+            log(f'从 epoch {start_epoch + 1} 第 {start_batch} 个批次之后恢复训练')
+        elif checkpoint.get('batch_idx') is not None:
+            # 进程数变化时分片不同, 无法定位到原批次, 从该epoch开头重新开始
+            start_epoch = checkpoint['epoch']
+            log(f'进程数与快照不同, 从 epoch {start_epoch + 1} 开头恢复训练')
+        else:
+            start_epoch = checkpoint['epoch'] + 1
+            log(f'从 epoch {start_epoch} 恢复训练')
+        
+        # 难例采样的损失表 (各进程相同); 从epoch中间恢复时同时恢复该rank已累计的损失
+        if hard_example_sampling and rank_states is not None and rank_states[0].get('sampler') is not None:
+            train_sampler.load_state_dict(rank_states[rank if same_world else 0]['sampler'], device,
+                                          partial=resume_epoch_state is not None)
+    
+    # DDP在构造时从rank 0广播参数, 各进程从同一模型出发
+    raw_model = model
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
+    
+    # 权重的指数滑动平均 (在DDP广播之后创建, 各进程一致); 用于验证和导出
+    ema = None
+    ema_decay = config['training'].get('ema_decay', 0)
+    if ema_decay > 0:
+        ema = ModelEMA(raw_model, decay=ema_decay, warmup=config['training'].get('ema_warmup', True))
+        if args.resume and checkpoint.get('ema_state_dict') is not None:
+            ema.load_state_dict(checkpoint['ema_state_dict'], checkpoint.get('ema_num_updates', 0))
+        log(f'EMA: decay={ema_decay}')
+    eval_model = ema.module if ema is not None else raw_model
+    
+    def make_checkpoint(epoch, batch_idx=None, epoch_state=None):
+        """
+        构建检查点 (所有进程都要调用, 其中收集各rank的随机数状态)
+        batch_idx不为None时为epoch内快照, epoch_state为该rank的epoch内累计量
+        """
+        rank_state = {'rng': get_rng_state()}
+        if hard_example_sampling:
+            rank_state['sampler'] = train_sampler.state_dict()
+        if epoch_state is not None:
+            rank_state.update({k: v.cpu() if torch.is_tensor(v) else v for k, v in epoch_state.items()})
+        return {
+            'epoch': epoch,
+            'batch_idx': batch_idx,
+            'model_state_dict': raw_model.state_dict(),
+            'ema_state_dict': ema.state_dict() if ema is not None else None,
+            'ema_num_updates': ema.num_updates if ema is not None else 0,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'early_stopping_counter': early_stopping_counter,
+            'best_val_metric': best_val_metric,
+            'rank_states': all_gather_object(rank_state),
+            'config': config
+        }
+    
+    def run_validation(epoch, indices=None, visualize=False):
+        """
+        在验证集 (或缓存中的固定子集indices) 上评估, 返回所有进程汇总后的 (val_loss, val_metrics)
+        """
+        eval_model.eval()
+        val_loss_sum = torch.zeros((), device=device)
+        val_count = torch.zeros((), device=device)
+        val_metric_acc = MetricAccumulator(config['evaluation']['metrics'], device=device)
+        
+        if val_cache is not None:
+            # 缓存的张量直接按大批次切片, 无需加载和预处理
+            batches = val_cache.iter_batches(val_batch_size, device, indices)
+            num_val_batches = val_cache.num_batches(val_batch_size, indices)
+        else:
+            batches = (unpack_batch(batch, device) for batch in val_loader)
+            num_val_batches = len(val_loader)
+        
+        with torch.inference_mode():
+            val_pbar = tqdm(batches, desc='验证', total=num_val_batches, disable=not is_main)
+            for batch_idx, (images, masks, extras) in enumerate(val_pbar):
+                # 前向传播 (推理模式, 关闭DropBlock; 启用EMA时评估EMA权重)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = eval_model(images, training=False)
+                outputs = outputs.float()
+                
+                # 计算损失 (按样本数加权, 批大小不同时平均值不变)
+                loss, _ = compute_loss(criterion, outputs, masks, extras)
+                val_loss_sum += loss * images.size(0)
+                val_count += images.size(0)
+                if (batch_idx + 1) % log_interval == 0:
+                    val_pbar.set_postfix({'loss': f'{(val_loss_sum / val_count).item():.4f}'})
+                
+                # 累加验证指标计数
+                val_metric_acc.update(torch.sigmoid(outputs), masks)
+                
+                # 保存部分预测结果用于可视化 (只提交选中样本的CPU副本, 作图在后台进程完成)
+                if is_main and visualize and batch_idx == 0:
+                    visualizer.submit(
+                        images,
+                        masks,
+                        torch.sigmoid(outputs),
+                        save_dir=config['visualization']['save_path'],
+                        epoch=epoch,
+                        num_examples=config['visualization']['num_examples']
+                    )
+        
+        # 汇总所有进程, 各进程得到相同的指标, 调度器和早停保持一致
+        val_loss = (all_reduce_sum(val_loss_sum) / all_reduce_sum(val_count)).item()
+        val_metrics = val_metric_acc.all_reduce().compute()
+        return val_loss, val_metrics
     
     # 训练循环
+    train_start = time.time()
+    last_epoch, last_val_metrics, stopped_early = start_epoch - 1, {}, False
+    current_stage, train_loader = None, None
+    profiler.start()
     for epoch in range(start_epoch, config['training']['epochs']):
-        print(f'Epoch {epoch+1}/{config["training"]["epochs"]}')
+        log(f'Epoch {epoch+1}/{config["training"]["epochs"]}')
         epoch_start_time = time.time()
         
+        # 进入新的分辨率阶段时更新下采样倍数并重建训练加载器
+        stage = next(i for i, (end_epoch, _, _) in enumerate(resolution_stages) if epoch < end_epoch)
+        if stage != current_stage:
+            current_stage = stage
+            _, downsample, train_batch_size = resolution_stages[stage]
+            train_dataset.downsample = downsample
+            train_loader = None  # 先释放旧的常驻worker
+            train_loader = build_train_loader(train_batch_size)
+            batches_per_epoch = train_sampler.num_samples // train_batch_size
+            log(f'分辨率阶段 {stage + 1}/{len(resolution_stages)}: 下采样 {downsample}x, 每进程批大小 {train_batch_size}, '
+                f'等效批大小 {train_batch_size * accumulation_steps * world_size}')
+            if run_logger is not None:
+                run_logger.log('resolution_stage', epoch=epoch, stage=stage, downsample=downsample,
+                               batch_size=train_batch_size)
+        
+        # 每个epoch不同的打乱顺序; 恢复的epoch跳过已完成的批次 (快照与恢复处于同一阶段, 批大小相同)
+        train_sampler.set_epoch(epoch)
+        if epoch != start_epoch:
+            start_batch, resume_epoch_state = 0, None
+        train_sampler.set_start_index(start_batch * train_batch_size)
+        
         # 训练阶段
         model.train()
-        train_loss = 0
-        loss_components = {'bce': 0, 'dice': 0, 'focal': 0, 'tversky': 0}
-        train_metrics = {metric: 0 for metric in config['evaluation']['metrics']}
+        train_loss_sum = torch.zeros((), device=device)
+        loss_components = {}  # 各损失组件保持为设备上的张量, epoch结束时再同步
+        train_metric_acc = MetricAccumulator(config['evaluation']['metrics'], device=device)
+        if resume_epoch_state is not None:
+            train_loss_sum += resume_epoch_state['train_loss_sum'].to(device)
+            loss_components = {k: v.to(device) for k, v in resume_epoch_state['loss_components'].items()}
+            train_metric_acc.counts += resume_epoch_state['metric_counts'].to(device)
+        
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        train_start_time = time.time()
+        num_batches = batches_per_epoch
+        optimizer.zero_grad(set_to_none=True)
         
-        # 使用tqdm显示训练进度
-        train_pbar = tqdm(train_loader, desc='训练')
-        for batch_idx, (images, masks) in enumerate(train_pbar):
-            images = images.to(device)
-            masks = masks.to(device)
+        # 使用tqdm显示训练进度 (batch_idx为epoch内的绝对位置)
+        train_pbar = tqdm(train_loader, desc='训练', disable=not is_main, initial=start_batch, total=num_batches)
+        step_timer.reset()
+        for batch_idx, batch in enumerate(train_pbar, start=start_batch):
+            images, masks, extras = unpack_batch(batch, device)
+            step_timer.mark('data')
             
-            # 前向传播
-            outputs = model(images)
+            # 前向传播 (混合精度)
+            with profiler.region('forward'), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                outputs = model(images)
+            # 损失在float32下计算, 避免对整幅图求和时精度不足
+            outputs = outputs.float()
             
             # 计算损失
-            if isinstance(criterion, nn.Module) and hasattr(criterion, 'forward'):
-                # CombinedLoss返回多个损失
-                if hasattr(criterion, 'bce'):
-                    loss, components = criterion(outputs, masks)
-                    # 更新损失组件
-                    for k, v in components.items():
-                        loss_components[k] += v
-                else:
-                    loss = criterion(outputs, masks)
-            else:
-                # 简单损失函数
-                loss = criterion(outputs, masks)
+            with profiler.region('loss'):
+                loss, components = compute_loss(criterion, outputs, masks, extras)
+            # 更新损失组件 (不调用.item(), 避免每步同步)
+            for k, v in components.items():
+                loss_components[k] = loss_components.get(k, 0) + v
+            step_timer.mark('forward')
             
-            # 反向传播
-            optimizer.zero_grad()
-            loss.backward()
+            # 反向传播: 按本组实际的micro-batch数缩放, epoch末不足一组时同样是平均梯度
+            group_start = (batch_idx // accumulation_steps) * accumulation_steps
+            group_size = min(accumulation_steps, num_batches - group_start)
+            is_update_step = batch_idx + 1 - group_start == group_size
+            # 累积中的micro-batch不做梯度all-reduce, 只在更新步同步一次
+            sync_context = model.no_sync() if distributed and not is_update_step else contextlib.nullcontext()
+            with sync_context, profiler.region('backward'):
+                scaler.scale(loss / group_size).backward()
+            step_timer.mark('backward')
             
-            # 梯度裁剪
-            if config['training']['clip_grad_norm'] > 0:
-                torch.nn.utils.clip_grad_norm_(
-                    model.parameters(), 
-                    max_norm=config['training']['clip_grad_norm']
-                )
+            if is_update_step:
+                with profiler.region('optimizer'):
+                    # 梯度裁剪 (先反缩放, 使阈值作用于真实梯度)
+                    if config['training']['clip_grad_norm'] > 0:
+                        scaler.unscale_(optimizer)
+                        torch.nn.utils.clip_grad_norm_(
+                            model.parameters(), 
+                            max_norm=config['training']['clip_grad_norm']
+                        )
+                
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+                
+                # EMA在每次优化器更新后更新 (foreach多张量操作)
+                if ema is not None:
+                    with profiler.region('ema'):
+                        ema.update()
+            step_timer.mark('optimizer')
             
-            optimizer.step()
+            # 更新进度条 (每log_interval步同步一次)
+            train_loss_sum += loss.detach()
+            if (batch_idx + 1) % log_interval == 0:
+                train_pbar.set_postfix({'loss': f'{train_loss_sum.item() / (batch_idx + 1):.4f}'})
             
-            # 更新进度条
-            train_loss += loss.item()
-            avg_loss = train_loss / (batch_idx + 1)
-            train_pbar.set_postfix({'loss': f'{avg_loss:.4f}'})
+            # 累加训练指标计数 (保留在设备上, epoch结束时同步一次)
+            with torch.no_grad(), profiler.region('metrics'):
+                train_metric_acc.update(torch.sigmoid(outputs), masks)
             
-            # 计算训练指标
-            with torch.no_grad():
-                batch_metrics = calculate_metrics(
-                    torch.sigmoid(outputs), 
-                    masks, 
-                    config['evaluation']['metrics']
-                )
-                for k, v in batch_metrics.items():
-                    train_metrics[k] += v
-                    
-        # 计算训练平均值
-        train_loss /= len(train_loader)
-        for k in train_metrics:
-            train_metrics[k] /= len(train_loader)
+            # 难例采样: 记录本批次各样本的损失 (在设备上按样本索引累加, 不同步)
+            if hard_example_sampling:
+                with profiler.region('sampler'):
+                    train_sampler.record(batch_idx, per_sample_loss(
+                        outputs.detach(), masks, extras.get('valid'),
+                        activation=config['loss'].get('activation', 'sigmoid')))
             
-        # 记录到TensorBoard
-        writer.add_scalar('Loss/train', train_loss, epoch)
-        for k, v in train_metrics.items():
-            writer.add_scalar(f'Metrics/{k}/train', v, epoch)
-        for k, v in loss_components.items():
-            if v > 0:  # 只记录使用的损失组件
-                writer.add_scalar(f'Loss_components/{k}/train', v / len(train_loader), epoch)
+            # epoch内快照: 只在优化器更新之后保存, 不会丢失累积中的梯度
+            if (save_every_steps > 0 and is_update_step and batch_idx + 1 < num_batches
+                    and (batch_idx + 1) % (save_every_steps * accumulation_steps) == 0):
+                step_checkpoint = make_checkpoint(epoch, batch_idx + 1, {
+                    'train_loss_sum': train_loss_sum,
+                    'loss_components': loss_components,
+                    'metric_counts': train_metric_acc.counts,
+                })
+                if is_main:
+                    checkpoint_writer.save(step_checkpoint, 'latest_step.pth')
+            
+            profiler.step()
+            step_timer.mark('other')
+            step_record = step_timer.end_step(images.size(0) * world_size)
+            if run_logger is not None and step_record is not None:
+                run_logger.log('steps', epoch=epoch, batch=batch_idx + 1, **step_record)
+                    
+        # 计算训练平均值 (epoch结束时同步一次, 分布式时汇总所有进程)
+        train_loss = all_reduce_sum(train_loss_sum).item() / (num_batches * world_size)
+        train_metrics = train_metric_acc.all_reduce().compute()
         
-        # 验证阶段
-        model.eval()
-        val_loss = 0
-        val_metrics = {metric: 0 for metric in config['evaluation']['metrics']}
+        # 汇总各进程记录的样本损失, 决定下一个epoch的采样概率
+        if hard_example_sampling:
+            train_sampler.end_epoch()
+            sampler_stats = train_sampler.stats()
+            if sampler_stats:
+                log(f'难例采样: 已记录 {sampler_stats["seen_fraction"]:.0%} 的样本, 采样概率为均匀分布的 '
+                    f'{sampler_stats["min_over_uniform"]:.2f}x - {sampler_stats["max_over_uniform"]:.2f}x')
+                if is_main:
+                    for k, v in sampler_stats.items():
+                        writer.add_scalar(f'Sampler/{k}', v, epoch)
         
-        with torch.no_grad():
-            val_pbar = tqdm(val_loader, desc='验证')
-            for batch_idx, (images, masks) in enumerate(val_pbar):
-                images = images.to(device)
-                masks = masks.to(device)
-                
-                # 前向传播
-                outputs = model(images)
-                
-                # 计算损失
-                if isinstance(criterion, nn.Module) and hasattr(criterion, 'forward'):
-                    # CombinedLoss返回多个损失
-                    if hasattr(criterion, 'bce'):
-                        loss, _ = criterion(outputs, masks)
-                    else:
-                        loss = criterion(outputs, masks)
-                else:
-                    # 简单损失函数
-                    loss = criterion(outputs, masks)
-                
-                val_loss += loss.item()
-                avg_loss = val_loss / (batch_idx + 1)
-                val_pbar.set_postfix({'loss': f'{avg_loss:.4f}'})
-                
-                # 计算验证指标
-                batch_metrics = calculate_metrics(
-                    torch.sigmoid(outputs), 
-                    masks, 
-                    config['evaluation']['metrics']
-                )
-                for k, v in batch_metrics.items():
-                    val_metrics[k] += v
-                
-                # 保存部分预测结果用于可视化
-                if batch_idx == 0 and epoch % 5 == 0:
-                    visualize_predictions(
-                        images.cpu(),
-                        masks.cpu(),
-                        torch.sigmoid(outputs).cpu(),
-                        save_dir=config['visualization']['save_path'],
-                        epoch=epoch,
-                        num_examples=min(config['visualization']['num_examples'], images.size(0))
-                    )
-        
-        # 计算验证平均值
-        val_loss /= len(val_loader)
-        for k in val_metrics:
-            val_metrics[k] /= len(val_loader)
+        # 训练吞吐量 (所有进程合计, 只统计本次运行的批次)、平均步耗时与峰值内存
+        train_time = time.time() - train_start_time
+        run_batches = max(num_batches - start_batch, 1)
+        train_throughput = run_batches * train_batch_size * world_size / train_time
+        train_step_time = train_time / run_batches
+        train_peak_memory = peak_memory_mb(device)
+        ema_update_ms = ema.pop_update_ms() if ema is not None else 0.0
             
         # 记录到TensorBoard
-        writer.add_scalar('Loss/val', val_loss, epoch)
-        for k, v in val_metrics.items():
-            writer.add_scalar(f'Metrics/{k}/val', v, epoch)
+        if is_main:
+            writer.add_scalar('Loss/train', train_loss, epoch)
+            writer.add_scalar('Perf/train_samples_per_s', train_throughput, epoch)
+            writer.add_scalar('Perf/train_step_time_s', train_step_time, epoch)
+            writer.add_scalar('Perf/peak_memory_mb', train_peak_memory, epoch)
+            if ema is not None:
+                writer.add_scalar('Perf/ema_update_ms', ema_update_ms, epoch)
+            for k, v in train_metrics.items():
+                writer.add_scalar(f'Metrics/{k}/train', v, epoch)
+            for k, v in loss_components.items():  # 只包含权重非零的损失组件 (rank 0的值)
+                writer.add_scalar(f'Loss_components/{k}/train', v.item() / num_batches, epoch)
+        
+        # 验证阶段: 完整验证、子集快速验证或跳过
+        run_full_val = (epoch + 1) % val_every_n_epochs == 0 or epoch + 1 == config['training']['epochs']
+        val_loss, val_metrics = None, {}
+        if run_full_val:
+            # 第几次完整验证 (从0开始, 只由epoch决定, 恢复训练后保持一致)
+            full_val_index = -(-(epoch + 1) // val_every_n_epochs) - 1
+            val_loss, val_metrics = run_validation(epoch, visualize=full_val_index % visualize_every == 0)
+        elif val_subset is not None:
+            val_loss, val_metrics = run_validation(epoch, indices=val_subset)
         
-        # 更新学习率
+        # 记录到TensorBoard (子集验证单独记录, 不与完整验证混在一条曲线上)
+        if is_main and val_loss is not None:
+            tag = 'val' if run_full_val else 'val_subset'
+            writer.add_scalar(f'Loss/{tag}', val_loss, epoch)
+            for k, v in val_metrics.items():
+                writer.add_scalar(f'Metrics/{k}/{tag}', v, epoch)
+        
+        # 更新学习率 (reduce_on_plateau只在完整验证后更新)
         if config['training']['lr_scheduler'] == 'reduce_on_plateau':
-            monitor_metric = val_loss
-            if config['checkpoints']['monitor'] in val_metrics:
-                monitor_metric = val_metrics[config['checkpoints']['monitor']]
-                if config['checkpoints']['mode'] == 'max':
-                    monitor_metric = -monitor_metric  # 对于最大化指标，转换为最小化问题
-            scheduler.step(monitor_metric)
+            if run_full_val:
+                monitor_metric = val_loss
+                if config['checkpoints']['monitor'] in val_metrics:
+                    monitor_metric = val_metrics[config['checkpoints']['monitor']]
+                    if config['checkpoints']['mode'] == 'max':
+                        monitor_metric = -monitor_metric  # 对于最大化指标，转换为最小化问题
+                scheduler.step(monitor_metric)
         else:
             scheduler.step()
         
         # 打印结果
-        print(f'Epoch {epoch+1}/{config["training"]["epochs"]} 完成. 耗时: {time.time() - epoch_start_time:.2f}s')
-        print(f'训练损失: {train_loss:.4f}')
+        log(f'Epoch {epoch+1}/{config["training"]["epochs"]} 完成. 耗时: {time.time() - epoch_start_time:.2f}s')
+        log(f'训练吞吐量: {train_throughput:.2f} 样本/秒, 平均步耗时: {train_step_time * 1000:.1f} ms '
+              f'(log_interval={log_interval}), 峰值内存: {train_peak_memory:.0f} MB '
+              f'(amp={amp_dtype if use_amp else "off"}, accumulation={accumulation_steps})')
+        if ema is not None:
+            log(f'EMA更新: {ema_update_ms:.2f} ms/次 '
+                f'(约占步耗时的 {ema_update_ms / (train_step_time * 1000 * accumulation_steps):.1%})')
+        log(f'训练损失: {train_loss:.4f}')
         for k, v in train_metrics.items():
-            print(f'训练 {k}: {v:.4f}')
-        print(f'验证损失: {val_loss:.4f}')
-        for k, v in val_metrics.items():
-            print(f'验证 {k}: {v:.4f}')
-        
-        # 检查保存模型
-        current_val_metric = val_metrics[config['checkpoints']['monitor']] if config['checkpoints']['monitor'] in val_metrics else val_loss
+            log(f'训练 {k}: {v:.4f}')
+        if val_loss is not None:
+            val_name = '验证' if run_full_val else f'验证(子集 {len(val_subset)} 个样本/进程)'
+            log(f'{val_name}损失: {val_loss:.4f}')
+            for k, v in val_metrics.items():
+                log(f'{val_name} {k}: {v:.4f}')
         
-        # 根据模式确定是否保存
+        # 检查保存模型 (只根据完整验证; 早停计数仍以epoch为单位, 每次未改善的完整验证
+        # 计入val_every_n_epochs个epoch, training.early_stopping的含义与验证频率无关)
         is_best = False
-        if config['checkpoints']['mode'] == 'max' and current_val_metric > best_val_metric:
-            best_val_metric = current_val_metric
-            is_best = True
-            early_stopping_counter = 0
-        elif config['checkpoints']['mode'] == 'min' and current_val_metric < best_val_metric:
-            best_val_metric = current_val_metric
-            is_best = True
-            early_stopping_counter = 0
-        else:
-            early_stopping_counter += 1
+        if run_full_val:
+            current_val_metric = val_metrics[config['checkpoints']['monitor']] if config['checkpoints']['monitor'] in val_metrics else val_loss
+            
+            # 根据模式确定是否保存
+            if config['checkpoints']['mode'] == 'max' and current_val_metric > best_val_metric:
+                best_val_metric = current_val_metric
+                is_best = True
+                early_stopping_counter = 0
+            elif config['checkpoints']['mode'] == 'min' and current_val_metric < best_val_metric:
+                best_val_metric = current_val_metric
+                is_best = True
+                early_stopping_counter = 0
+            else:
+                early_stopping_counter += val_every_n_epochs
         
         # 保存模型
-        checkpoint = {
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'best_val_metric': best_val_metric,
-            'config': config
-        }
+        checkpoint = make_checkpoint(epoch)
         
-        # 保存最新模型
-        torch.save(checkpoint, os.path.join(config['checkpoints']['save_dir'], 'latest_model.pth'))
-        
-        # 如果是最佳模型，单独保存
+        # 保存最新模型; 如果是最佳模型，单独保存; 按save_every保存周期性检查点
+        # 在当前线程只做一次状态快照, 写盘在后台进行, 训练不等待
+        checkpoint_files = ['latest_model.pth']
         if is_best:
-            torch.save(checkpoint, os.path.join(config['checkpoints']['save_dir'], 'best_model.pth'))
-            print(f'保存最佳模型, {config["checkpoints"]["monitor"]} = {current_val_metric:.4f}')
+            checkpoint_files.append('best_model.pth')
+            log(f'保存最佳模型, {config["checkpoints"]["monitor"]} = {current_val_metric:.4f}')
+        if save_every > 0 and (epoch + 1) % save_every == 0:
+            checkpoint_files.append(f'checkpoint_epoch_{epoch + 1:04d}.pth')
+        if is_main:
+            # epoch内快照已被本检查点取代, 写入后删除 (避免之后从旧快照恢复导致训练回退)
+            checkpoint_writer.save(checkpoint, checkpoint_files, remove=['latest_step.pth'])
+        
+        last_epoch = epoch
+        if run_full_val:
+            last_val_metrics = dict(val_metrics, loss=val_loss)
+        if run_logger is not None:
+            run_logger.log(
+                'epoch',
+                epoch=epoch,
+                epoch_time_s=time.time() - epoch_start_time,
+                lr=optimizer.param_groups[0]['lr'],
+                downsample=train_dataset.downsample,
+                batch_size=train_batch_size,
+                train=dict(train_metrics, loss=train_loss),
+                val=dict(val_metrics, loss=val_loss) if val_loss is not None else {},
+                val_subset=val_loss is not None and not run_full_val,
+                samples_per_s=train_throughput,
+                peak_memory_mb=train_peak_memory,
+                is_best=is_best
+            )
         
         # 早停
         if early_stopping_counter >= config['training']['early_stopping']:
-            print(f'{config["training"]["early_stopping"]} 个epoch没有改善，提前停止训练')
+            log(f'{early_stopping_counter} 个epoch ({early_stopping_counter // val_every_n_epochs} 次完整验证) 没有改善，提前停止训练')
+            stopped_early = True
             break
     
-    writer.close()
-    print('训练完成!')
+    # 等待所有检查点和可视化写完
+    profiler.stop()
+    if is_main:
+        checkpoint_writer.close()
+        visualizer.close()
+        writer.close()
+        run_logger.log('run_end', best_val_metric=best_val_metric, epochs_run=last_epoch + 1,
+                       stopped_early=stopped_early, train_time_s=time.time() - train_start)
+        run_logger.close()
+        
+        # 运行摘要 (供超参数搜索等工具汇总结果)
+        with open(os.path.join(config['checkpoints']['save_dir'], 'summary.json'), 'w') as f:
+            json.dump({
+                'monitor': config['checkpoints']['monitor'],
+                'mode': config['checkpoints']['mode'],
+                'best_val_metric': best_val_metric,
+                'last_val_metrics': last_val_metrics,
+                'epochs_run': last_epoch + 1,
+                'stopped_early': stopped_early,
+                'train_time_s': time.time() - train_start,
+            }, f, indent=2)
+    cleanup_distributed()
+    log('训练完成!')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,52 @@
+# utils/model_factory.py
+from models.unet import (
+    create_backbone_model,
+    create_sa_unet_model,
+    create_sa_unet_model_for_single_channel,
+    create_lite_unet_model
+)
+
+# Model types selectable through config['model']['type']
+MODEL_TYPES = ('backbone', 'sa_unet', 'sa_unet_single_channel', 'lite', 'lite_sa')
+
+
+def create_model(config, model_type=None):
+    """
+    Create a model from the configuration
+
+    Args:
+        config (dict): Configuration dictionary (uses the 'model' and 'data' sections)
+        model_type (str): Overrides config['model']['type'] when given
+
+    Returns:
+        nn.Module: Model instance
+    """
+    model_config = config['model']
+    model_type = (model_type or model_config.get('type', 'sa_unet')).lower()
+
+    kwargs = {
+        'block_size': model_config.get('block_size', 7),
+        'keep_prob': model_config.get('keep_prob', 0.9),
+        'start_neurons': model_config.get('start_neurons', 16),
+        'use_output_activation': model_config.get('use_output_activation', True),
+    }
+
+    if model_type == 'sa_unet_single_channel':
+        return create_sa_unet_model_for_single_channel(**kwargs)
+
+    h, w = config['data']['img_size']
+    input_size = (h, w, config['data']['channels'])
+
+    # Stride of the LiteUNet stem; 2 runs the screening model at half resolution
+    lite_kwargs = dict(kwargs, stem_stride=model_config.get('lite_stem_stride', 2))
+
+    if model_type == 'backbone':
+        return create_backbone_model(input_size=input_size, **kwargs)
+    elif model_type == 'sa_unet':
+        return create_sa_unet_model(input_size=input_size, **kwargs)
+    elif model_type == 'lite':
+        return create_lite_unet_model(input_size=input_size, **lite_kwargs)
+    elif model_type == 'lite_sa':
+        return create_lite_unet_model(input_size=input_size, with_attention=True, **lite_kwargs)
+    else:
+        raise ValueError(f"Unsupported model type: {model_type}. Supported types: {list(MODEL_TYPES)}")
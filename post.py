@@ -95,8 +95,10 @@ def visualize_pl_star_detection_horizontal(mask, centers, kept_lines, closed, sk
     plt.show()
 
 
-centers, lines, closed, skel = detect_pl_stars_debug(mask)
-visualize_pl_star_detection_horizontal(mask, centers, lines, closed, skel, title="Perfect PL Star")
+if __name__ == "__main__":
+    # 演示: mask为交互式会话中准备好的二值掩码, 作为模块导入时不执行
+    centers, lines, closed, skel = detect_pl_stars_debug(mask)
+    visualize_pl_star_detection_horizontal(mask, centers, lines, closed, skel, title="Perfect PL Star")
 
 
 
@@ -0,0 +1,119 @@
+# utils/profiling.py
+import os
+import contextlib
+import torch
+from torch.profiler import profile, schedule, record_function, ProfilerActivity
+
+
+def add_profiler_args(parser):
+    """CLI switches shared by main.py and test.py (unset values fall back to config['profiling'])"""
+    parser.add_argument('--profile', action='store_true', help='Profile a window of steps with torch.profiler')
+    parser.add_argument('--profile-wait', type=int, default=None, help='Steps skipped before profiling starts')
+    parser.add_argument('--profile-warmup', type=int, default=None, help='Traced but discarded steps (warms up the profiler)')
+    parser.add_argument('--profile-active', type=int, default=None, help='Recorded steps')
+    parser.add_argument('--profile-top-k', type=int, default=None, help='Rows in the operator table')
+    parser.add_argument('--profile-dir', type=str, default=None, help='Where the trace and table are written')
+    parser.add_argument('--profile-data', action='store_true',
+                        help='Load data in the main process (num_workers=0) so dataset and augmentation ops are traced')
+    return parser
+
+
+def create_profiler(args, config, default_dir):
+    """Build a StepProfiler from CLI arguments, falling back to config['profiling']"""
+    settings = config.get('profiling', {})
+
+    def pick(name, default):
+        value = getattr(args, f'profile_{name}', None)
+        return value if value is not None else settings.get(name, default)
+
+    return StepProfiler(
+        enabled=args.profile or settings.get('enabled', False),
+        output_dir=pick('dir', default_dir),
+        wait=pick('wait', 1),
+        warmup=pick('warmup', 2),
+        active=pick('active', 5),
+        top_k=pick('top_k', 25),
+        profile_data=args.profile_data or settings.get('data', False),
+    )
+
+
+class StepProfiler:
+    """
+    torch.profiler over a fixed window of steps
+
+    Skips `wait` steps, traces `warmup` steps without keeping them, then records
+    `active` steps with operator-level CPU (and CUDA) time and memory. When the
+    window closes it writes a Chrome trace (open in chrome://tracing or Perfetto)
+    and a top-k operator table, then stops. When disabled every method is a no-op.
+    """
+    def __init__(self, enabled=False, output_dir='profiles', wait=1, warmup=2, active=5, top_k=25, profile_data=False):
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self.total_steps = wait + warmup + active
+        self.top_k = top_k
+        self.profile_data = profile_data
+        self.step_num = 0
+        self.profiler = None
+        if enabled:
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self.profiler = profile(
+                activities=activities,
+                schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=self._export,
+                record_shapes=True,
+                profile_memory=True
+            )
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @property
+    def active(self):
+        """True while the profiling window is still open"""
+        return self.profiler is not None
+
+    def step(self):
+        """Mark the end of one training/inference step"""
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.step_num += 1
+        if self.step_num >= self.total_steps:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            profiler, self.profiler = self.profiler, None
+            profiler.stop()
+
+    def region(self, name):
+        """Label a block of code in the trace"""
+        return record_function(name) if self.profiler is not None else contextlib.nullcontext()
+
+    def _export(self, prof):
+        os.makedirs(self.output_dir, exist_ok=True)
+        trace_path = os.path.join(self.output_dir, 'trace.json')
+        prof.export_chrome_trace(trace_path)
+
+        averages = prof.key_averages()
+        sort_key = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        time_table = averages.table(sort_by=sort_key, row_limit=self.top_k)
+        memory_table = averages.table(sort_by='self_cpu_memory_usage', row_limit=self.top_k)
+        table_path = os.path.join(self.output_dir, 'top_ops.txt')
+        with open(table_path, 'w') as f:
+            f.write(f'Top {self.top_k} operators by {sort_key}\n{time_table}\n\n')
+            f.write(f'Top {self.top_k} operators by self_cpu_memory_usage\n{memory_table}\n')
+
+        print(time_table)
+        print(f'Profiler trace written to {trace_path}, operator tables to {table_path}')
@@ -0,0 +1,75 @@
+# utils/resources.py
+import os
+import sys
+import resource
+import traceback
+import multiprocessing as mp
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is in KiB on Linux and bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Resident set size now (falls back to the peak where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def doubling_counts(include_zero=False):
+    """1, 2, 4, ... up to the core count (worker/process counts to probe), optionally led by 0"""
+    cores = os.cpu_count() or 1
+    counts = [0, 1] if include_zero else [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    return counts
+
+
+def _isolated_worker(fn, arg, conn):
+    try:
+        try:
+            message = ('ok', fn(arg))
+        except Exception:
+            message = ('error', traceback.format_exc())
+        conn.send(message)
+    finally:
+        conn.close()
+
+
+def run_isolated(fn, arg):
+    """
+    Run fn(arg) in a fresh spawned process
+
+    Measurements such as peak RSS then belong to this call only, and a process
+    killed by the kernel (e.g. the OOM killer) is reported instead of hanging
+    the caller the way a dead Pool worker does.
+
+    Returns:
+        (result, None) on success, (None, error message) if fn raised (the
+        message carries the child's formatted traceback) or the process died
+    """
+    ctx = mp.get_context('spawn')
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_isolated_worker, args=(fn, arg, sender))
+    process.start()
+    sender.close()
+    try:
+        status, payload = receiver.recv()
+    except EOFError:
+        status, payload = None, None
+    finally:
+        receiver.close()
+    process.join()
+    if status == 'ok':
+        return payload, None
+    if status == 'error':
+        return None, f'exception in isolated process:\n{payload.rstrip()}'
+    if process.exitcode is not None and process.exitcode < 0:
+        return None, f'process killed by signal {-process.exitcode} (out of memory?)'
+    return None, f'process exited with code {process.exitcode}'
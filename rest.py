@@ -3,10 +3,15 @@ import cv2
 import numpy as np
 import torch
 from torch.utils.data import Dataset
+from torch.profiler import record_function
 from scipy.io import loadmat
+from scipy.ndimage import distance_transform_edt
+
+from utils.transforms import preserves_distances
 
 class SegmentationDataset(Dataset):
-    def __init__(self, img_dir, mask_dir, transform=None):
+    def __init__(self, img_dir, mask_dir, transform=None, return_valid_mask=False, distance_map_dir=None,
+                 decoded_cache_dir=None, downsample=1):
         """
         初始化分割数据集，支持多种文件格式
         
@@ -14,10 +19,27 @@ class SegmentationDataset(Dataset):
             img_dir: 输入图像目录（支持.png, .jpg, .jpeg, .mat文件）
             mask_dir: 掩码图像目录（支持.png, .jpg, .jpeg, .mat文件）
             transform: 数据增强转换
+            return_valid_mask: 是否额外返回晶圆有效区域掩码 extras['valid']
+            distance_map_dir: 带符号距离图缓存目录, 设置后额外返回 extras['dist'] (当前分辨率下的像素距离);
+                数据增强会改变距离时 (弹性/网格/光学畸变等) 在增强后的掩码上重新计算, 不读缓存
+            decoded_cache_dir: 解码缓存目录, 解码后的图像和掩码存为.npy, 可在多次运行间共享
+            downsample: 整数下采样倍数 (渐进式分辨率训练), 图像按区域平均, 掩码按最大池化
+            
+        启用任一额外目标时返回 (img, mask, extras), 否则返回 (img, mask)
         """
         self.img_dir = img_dir
         self.mask_dir = mask_dir
         self.transform = transform
+        self.return_valid_mask = return_valid_mask
+        self.distance_map_dir = distance_map_dir
+        if distance_map_dir is not None:
+            os.makedirs(distance_map_dir, exist_ok=True)
+        # 只有翻转等保距变换时, 缓存的距离图可以随掩码一起变换
+        self.recompute_distance_map = transform is not None and not preserves_distances(transform)
+        self.decoded_cache_dir = decoded_cache_dir
+        if decoded_cache_dir is not None:
+            os.makedirs(decoded_cache_dir, exist_ok=True)
+        self.downsample = downsample
         
         # 获取所有支持的图像文件名
         self.img_files = []
@@ -36,6 +58,106 @@ class SegmentationDataset(Dataset):
     def __getitem__(self, idx):
         # 获取文件名
         file_name = self.img_files[idx]
+        
+        # 加载解码后的图像和掩码 (设置了解码缓存时直接读取缓存)
+        if self.decoded_cache_dir is not None:
+            img, mask = self.load_decoded(file_name)
+        else:
+            img, mask = self.load_raw(file_name)
+        
+        # 渐进式分辨率: 在计算有效区域掩码之前下采样, 部分落在晶圆外的块 (NaN) 保持无效
+        if self.downsample > 1:
+            img = downsample_image(img, self.downsample)
+            mask = downsample_mask(mask, self.downsample)
+        
+        # 额外目标: 与掩码一起做几何变换的逐像素图
+        extras = {}
+        
+        # 晶圆外区域在.mat中为NaN, 在导出图像中为0
+        if self.return_valid_mask:
+            extras['valid'] = get_valid_mask(img)
+        if np.issubdtype(img.dtype, np.floating):
+            img = np.nan_to_num(img, nan=0.0)
+        
+        # 距离图在当前分辨率的掩码上计算, 只在第一次访问时计算, 之后从缓存读取
+        if self.distance_map_dir is not None and not self.recompute_distance_map:
+            extras['dist'] = self.load_distance_map(file_name, mask)
+            
+        # 数据增强
+        if self.transform:
+            # 确保图像有正确的格式供albumentations处理
+            if len(img.shape) == 2:
+                img_for_transform = np.expand_dims(img, axis=2)  # [H,W] -> [H,W,1]
+            else:
+                img_for_transform = img
+                
+            # 额外目标作为mask参与几何变换 (最近邻插值), 保证与变换后的掩码对齐;
+            # 没有额外目标时不传masks, 保持原来的调用方式
+            targets = {'image': img_for_transform, 'mask': mask}
+            if extras:
+                targets['masks'] = list(extras.values())
+            with record_function('SegmentationDataset.transform'):
+                transformed = self.transform(**targets)
+            img = transformed['image']
+            mask = transformed['mask']
+            if extras:
+                extras = dict(zip(extras.keys(), transformed['masks']))
+            
+            # 如果是灰度图像，可能会被转换成[H,W,1]，需要转回[H,W]
+            if img.shape[2] == 1:
+                img = img[:,:,0]
+        
+        # 缩放/畸变后缓存的像素距离不再成立, 在增强后的掩码上重新计算
+        if self.distance_map_dir is not None and self.recompute_distance_map:
+            extras['dist'] = compute_signed_distance_map(mask)
+                
+        # 转换为PyTorch张量
+        # 对于灰度图，确保维度为[1,H,W]
+        if len(img.shape) == 2:
+            img = torch.from_numpy(img).float().unsqueeze(0)
+        else:
+            img = torch.from_numpy(img.transpose(2, 0, 1)).float()
+            
+        # 对掩码进行同样处理
+        mask = torch.from_numpy(mask).float().unsqueeze(0)  # [H,W] -> [1,H,W]
+        
+        # 归一化到[0,1]范围（如果需要）
+        if img.max() > 1.0:
+            img = img / 255.0
+        if mask.max() > 1.0:
+            mask = mask / 255.0
+        
+        if extras:
+            # [H,W] -> [1,H,W]
+            if 'valid' in extras:
+                extras['valid'] = torch.from_numpy(np.ascontiguousarray(extras['valid'])).bool().unsqueeze(0)
+            if 'dist' in extras:
+                extras['dist'] = torch.from_numpy(np.ascontiguousarray(extras['dist'])).float().unsqueeze(0)
+            return img, mask, extras
+        return img, mask
+    
+    def find_mask_path(self, file_name):
+        """确定图像对应的掩码文件路径"""
+        if file_name.lower().endswith('.mat'):
+            if file_name.endswith('_PLStar.mat'):
+                # 将 _PLStar.mat 替换为 _Mask.mat 得到对应的掩码文件名
+                base_name = file_name[:-11]  # 去掉 _PLStar.mat
+                return os.path.join(self.mask_dir, base_name + '_Mask.mat')
+            # 如果不是特定命名模式，则尝试使用同名文件
+            return os.path.join(self.mask_dir, file_name)
+        
+        # 尝试查找具有相同基本名称但可能有不同扩展名的掩码文件, 返回第一个存在的
+        base_name = os.path.splitext(file_name)[0]
+        for ext in ['.png', '.jpg', '.jpeg', '.mat']:
+            candidate = os.path.join(self.mask_dir, base_name + ext)
+            if os.path.exists(candidate):
+                return candidate
+        
+        # 如果找不到对应的掩码文件，尝试查找相同文件名的掩码
+        return os.path.join(self.mask_dir, file_name)
+    
+    def load_raw(self, file_name):
+        """从原始文件加载并解码图像和掩码"""
         file_ext = os.path.splitext(file_name)[1].lower()
         
         # 加载图像数据
@@ -47,41 +169,15 @@ class SegmentationDataset(Dataset):
             img_data = loadmat(img_path)
             img = img_data['modifiedMap']
             
-            # 确定掩码文件路径
-            if file_name.endswith('_PLStar.mat'):
-                # 将 _PLStar.mat 替换为 _Mask.mat 得到对应的掩码文件名
-                base_name = file_name[:-11]  # 去掉 _PLStar.mat
-                mask_file = base_name + '_Mask.mat'
-                mask_path = os.path.join(self.mask_dir, mask_file)
-            else:
-                # 如果不是特定命名模式，则尝试使用同名文件
-                mask_path = os.path.join(self.mask_dir, file_name)
-            
+            mask_path = self.find_mask_path(file_name)
             mask_data = loadmat(mask_path)
             mask = mask_data['maskMap']
         else:
             # 加载图像文件
             img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)  # 默认读取为灰度图
             
-            # 构建掩码文件名
-            # 尝试查找具有相同基本名称但可能有不同扩展名的掩码文件
-            base_name = os.path.splitext(file_name)[0]
-            mask_candidates = [
-                os.path.join(self.mask_dir, base_name + ext)
-                for ext in ['.png', '.jpg', '.jpeg', '.mat']
-            ]
+            mask_path = self.find_mask_path(file_name)
             
-            # 找到第一个存在的掩码文件
-            mask_path = None
-            for candidate in mask_candidates:
-                if os.path.exists(candidate):
-                    mask_path = candidate
-                    break
-                    
-            if mask_path is None:
-                # 如果找不到对应的掩码文件，尝试查找相同文件名的掩码
-                mask_path = os.path.join(self.mask_dir, file_name)
-                
             # 根据掩码文件扩展名加载
             mask_ext = os.path.splitext(mask_path)[1].lower()
             if mask_ext == '.mat':
@@ -105,40 +201,93 @@ class SegmentationDataset(Dataset):
         # 确保掩码是灰度图
         if len(mask.shape) == 3:
             mask = mask[:,:,0]
-            
-        # 数据增强
-        if self.transform:
-            # 确保图像有正确的格式供albumentations处理
-            if len(img.shape) == 2:
-                img_for_transform = np.expand_dims(img, axis=2)  # [H,W] -> [H,W,1]
-            else:
-                img_for_transform = img
-                
-            transformed = self.transform(image=img_for_transform, mask=mask)
-            img = transformed['image']
-            mask = transformed['mask']
-            
-            # 如果是灰度图像，可能会被转换成[H,W,1]，需要转回[H,W]
-            if img.shape[2] == 1:
-                img = img[:,:,0]
-                
-        # 转换为PyTorch张量
-        # 对于灰度图，确保维度为[1,H,W]
-        if len(img.shape) == 2:
-            img = torch.from_numpy(img).float().unsqueeze(0)
-        else:
-            img = torch.from_numpy(img.transpose(2, 0, 1)).float()
-            
-        # 对掩码进行同样处理
-        mask = torch.from_numpy(mask).float().unsqueeze(0)  # [H,W] -> [1,H,W]
         
-        # 归一化到[0,1]范围（如果需要）
-        if img.max() > 1.0:
-            img = img / 255.0
-        if mask.max() > 1.0:
-            mask = mask / 255.0
+        return img, mask
+    
+    def load_decoded(self, file_name):
+        """
+        读取解码缓存 (.npy, 内存映射), 不存在时解码并原子写入缓存
+        
+        多个训练进程共享同一缓存目录时, 解码只做一次, 读取通过页缓存共享
+        """
+        base_name = file_name[:-11] if file_name.endswith('_PLStar.mat') else os.path.splitext(file_name)[0]
+        img_path = os.path.join(self.decoded_cache_dir, base_name + '_img.npy')
+        mask_path = os.path.join(self.decoded_cache_dir, base_name + '_mask.npy')
         
+        if os.path.exists(img_path) and os.path.exists(mask_path):
+            # 拷贝一份, 后续处理 (nan_to_num等) 不修改缓存
+            return np.array(np.load(img_path, mmap_mode='r')), np.array(np.load(mask_path, mmap_mode='r'))
+        
+        img, mask = self.load_raw(file_name)
+        # 掩码后写, 两者都存在即表示缓存完整
+        for array, path in ((img, img_path), (mask, mask_path)):
+            tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
         return img, mask
+    
+    def load_distance_map(self, file_name, mask):
+        """
+        读取缓存的带符号距离图, 不存在时计算并原子写入缓存
+        
+        缓存键包含掩码文件的修改时间和大小以及掩码的分辨率, 掩码更新或换了
+        下采样倍数时不会读到过期的距离图
+        """
+        base_name = file_name[:-11] if file_name.endswith('_PLStar.mat') else os.path.splitext(file_name)[0]
+        stat = os.stat(self.find_mask_path(file_name))
+        key = f'{mask.shape[0]}x{mask.shape[1]}_{stat.st_mtime_ns}_{stat.st_size}'
+        cache_path = os.path.join(self.distance_map_dir, f'{base_name}_{key}_SDM.npy')
+        
+        if os.path.exists(cache_path):
+            return np.load(cache_path).astype(np.float32)
+        
+        sdm = compute_signed_distance_map(mask)
+        # 多个worker可能同时计算同一样本, 先写临时文件再重命名
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, sdm.astype(np.float16))
+        os.replace(tmp_path, cache_path)
+        return sdm
+
+
+def compute_signed_distance_map(mask):
+    """
+    计算掩码的带符号距离图 (像素单位): 目标外为到目标的距离(正), 目标内为到背景的距离(负)
+    不含目标的掩码返回全零
+    """
+    binary = mask > (127 if mask.max() > 1 else 0.5)
+    if not binary.any():
+        return np.zeros(mask.shape, dtype=np.float32)
+    outside = distance_transform_edt(~binary)
+    inside = distance_transform_edt(binary)
+    return (outside - inside).astype(np.float32)
+
+
+def downsample_image(img, factor):
+    """
+    区域平均下采样到 ceil(H/factor) x ceil(W/factor)
+    NaN会传播到所在的块, 跨越晶圆边界的块仍被视为无效区域
+    """
+    h, w = img.shape[:2]
+    size = (-(-w // factor), -(-h // factor))  # cv2为(宽, 高)
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def downsample_mask(mask, factor):
+    """
+    最大池化下采样 (补零到factor的整数倍), 只有1像素宽的细臂在低分辨率下也不会消失
+    输出尺寸与downsample_image一致
+    """
+    h, w = mask.shape[:2]
+    padded = np.zeros((-(-h // factor) * factor, -(-w // factor) * factor), dtype=mask.dtype)
+    padded[:h, :w] = mask
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor).max(axis=(1, 3))
+
+
+def get_valid_mask(img):
+    """晶圆有效区域掩码: 去掉NaN及值为0的晶圆外像素"""
+    if img.ndim == 3:
+        img = img[:, :, 0]
+    return (np.isfinite(img) & (img != 0)).astype(np.uint8)
 
 
 
@@ -294,7 +443,6 @@ def get_loss_function(config):
 # utils/metrics.py
 import torch
 import numpy as np
-from sklearn.metrics import precision_score, recall_score, accuracy_score
 
 def dice_coefficient(y_pred, y_true, smooth=1e-7):
     """计算Dice系数"""
@@ -325,41 +473,174 @@ def iou_score(y_pred, y_true, smooth=1e-7):
     union = y_pred.sum() + y_true.sum() - intersection
     return (intersection + smooth) / (union + smooth)
 
+def confusion_counts(y_pred, y_true, threshold=0.5):
+    """
+    在设备上一次性计算混淆矩阵计数
+    
+    Returns:
+        torch.Tensor: int64张量 [TP, FP, FN, TN], 与输入在同一设备上
+    """
+    y_pred = y_pred > threshold
+    y_true = y_true > 0.5
+    tp = (y_pred & y_true).sum()
+    fp = y_pred.sum() - tp
+    fn = y_true.sum() - tp
+    tn = y_true.numel() - tp - fp - fn
+    return torch.stack([tp, fp, fn, tn])
+
+def metrics_from_counts(counts, metrics_list, smooth=1e-7):
+    """
+    由混淆矩阵计数计算指标 (Dice/IoU平滑方式与dice_coefficient/iou_score一致,
+    precision/recall在分母为0时返回1, 与sklearn的zero_division=1一致)
+    
+    Args:
+        counts: [TP, FP, FN, TN], 张量或序列
+        metrics_list: 需要计算的指标名称列表
+    """
+    if torch.is_tensor(counts):
+        counts = counts.tolist()  # 一次同步
+    tp, fp, fn, tn = [float(c) for c in counts]
+    results = {}
+    for metric in metrics_list:
+        if metric == 'dice':
+            results['dice'] = (2. * tp + smooth) / (2. * tp + fp + fn + smooth)
+        elif metric == 'iou':
+            results['iou'] = (tp + smooth) / (tp + fp + fn + smooth)
+        elif metric == 'precision':
+            results['precision'] = tp / (tp + fp) if tp + fp > 0 else 1.0
+        elif metric == 'recall':
+            results['recall'] = tp / (tp + fn) if tp + fn > 0 else 1.0
+        elif metric == 'accuracy':
+            results['accuracy'] = (tp + tn) / max(tp + fp + fn + tn, 1.0)
+    return results
+
 def precision(y_pred, y_true):
     """计算精确率"""
-    y_pred = (y_pred > 0.5).float().cpu().numpy().flatten()
-    y_true = y_true.cpu().numpy().flatten()
-    return precision_score(y_true, y_pred, zero_division=1)
+    return metrics_from_counts(confusion_counts(y_pred, y_true), ['precision'])['precision']
 
 def recall(y_pred, y_true):
     """计算召回率"""
-    y_pred = (y_pred > 0.5).float().cpu().numpy().flatten()
-    y_true = y_true.cpu().numpy().flatten()
-    return recall_score(y_true, y_pred, zero_division=1)
+    return metrics_from_counts(confusion_counts(y_pred, y_true), ['recall'])['recall']
 
 def accuracy(y_pred, y_true):
     """计算准确率"""
-    y_pred = (y_pred > 0.5).float().cpu().numpy().flatten()
-    y_true = y_true.cpu().numpy().flatten()
-    return accuracy_score(y_true, y_pred)
+    return metrics_from_counts(confusion_counts(y_pred, y_true), ['accuracy'])['accuracy']
 
 def calculate_metrics(y_pred, y_true, metrics_list):
     """计算多个评估指标"""
-    results = {}
+    return metrics_from_counts(confusion_counts(y_pred, y_true), metrics_list)
+
+class MetricAccumulator:
+    """
+    流式混淆矩阵指标累加器
     
-    for metric in metrics_list:
-        if metric == 'dice':
-            results['dice'] = dice_coefficient(y_pred, y_true).item()
-        elif metric == 'iou':
-            results['iou'] = iou_score(y_pred, y_true).item()
-        elif metric == 'precision':
-            results['precision'] = precision(y_pred, y_true)
-        elif metric == 'recall':
-            results['recall'] = recall(y_pred, y_true)
-        elif metric == 'accuracy':
-            results['accuracy'] = accuracy(y_pred, y_true)
+    TP/FP/FN/TN计数以张量形式保存在模型所在设备上, 每个批次只做一次向量化更新,
+    不产生主机同步; compute()时才同步一次。整个epoch的像素汇总后再计算指标
+    (micro平均), 不再是逐批次指标的平均。
+    """
+    def __init__(self, metrics_list, threshold=0.5, device=None):
+        self.metrics_list = list(metrics_list)
+        self.threshold = threshold
+        self.counts = torch.zeros(4, dtype=torch.int64, device=device)
     
-    return results
+    def reset(self):
+        self.counts.zero_()
+    
+    @torch.no_grad()
+    def update(self, y_pred, y_true):
+        """累加一个批次的计数"""
+        self.counts += confusion_counts(y_pred, y_true, self.threshold)
+    
+    def all_reduce(self):
+        """在分布式训练中汇总所有进程的计数"""
+        import torch.distributed as dist
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.counts, op=dist.ReduceOp.SUM)
+        return self
+    
+    def compute(self):
+        """返回指标字典 (一次主机同步)"""
+        return metrics_from_counts(self.counts, self.metrics_list)
+
+class ProbabilityHistogram:
+    """
+    按类别统计预测概率直方图, 一次推理即可得到所有阈值下的指标
+    
+    hist[0]为背景像素的概率直方图, hist[1]为目标像素的概率直方图。阈值取
+    bin边界 k/num_bins, 像素概率落在第k个bin及以上时视为预测为正。
+    直方图只是计数, 可以直接相加, 因此可跨进程合并 (merge/all_reduce/save/load)。
+    """
+    def __init__(self, num_bins=1024, device=None):
+        self.num_bins = num_bins
+        self.hist = torch.zeros(2, num_bins, dtype=torch.int64, device=device)
+    
+    def reset(self):
+        self.hist.zero_()
+    
+    @torch.no_grad()
+    def update(self, y_pred, y_true, valid_mask=None):
+        """累加一个批次 (y_pred为概率)"""
+        bins = (y_pred.detach() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        index = bins + self.num_bins * (y_true > 0.5).long()
+        if valid_mask is not None:
+            index = index[valid_mask]
+        self.hist += torch.bincount(index.flatten(), minlength=2 * self.num_bins).view(2, self.num_bins)
+    
+    def merge(self, other):
+        """合并另一个直方图 (例如其他进程的结果)"""
+        if other.num_bins != self.num_bins:
+            raise ValueError(f"直方图bin数不一致: {self.num_bins} vs {other.num_bins}")
+        self.hist += other.hist.to(self.hist.device)
+        return self
+    
+    def all_reduce(self):
+        """在分布式训练/评估中汇总所有进程的直方图"""
+        import torch.distributed as dist
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.hist, op=dist.ReduceOp.SUM)
+        return self
+    
+    def save(self, path):
+        np.save(path, self.hist.cpu().numpy())
+    
+    @classmethod
+    def load(cls, path, device=None):
+        hist = np.load(path)
+        obj = cls(num_bins=hist.shape[1], device=device)
+        obj.hist.copy_(torch.from_numpy(hist))
+        return obj
+    
+    def curves(self, smooth=1e-7):
+        """
+        所有阈值下的指标曲线
+        
+        Returns:
+            dict: thresholds及对应的tp/fp/fn/tn, precision, recall, dice, iou (numpy数组, 长度num_bins)
+        """
+        hist = self.hist.cpu().numpy().astype(np.float64)  # 一次同步
+        # 阈值k处的预测为正的像素数 = 第k个bin及以上的计数 (后缀和)
+        fp = np.cumsum(hist[0][::-1])[::-1]
+        tp = np.cumsum(hist[1][::-1])[::-1]
+        fn = hist[1].sum() - tp
+        tn = hist[0].sum() - fp
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+            recall = np.where(tp + fn > 0, tp / (tp + fn), 1.0)
+        return {
+            'thresholds': np.arange(self.num_bins) / self.num_bins,
+            'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+            'precision': precision,
+            'recall': recall,
+            'dice': (2. * tp + smooth) / (2. * tp + fp + fn + smooth),
+            'iou': (tp + smooth) / (tp + fp + fn + smooth),
+        }
+    
+    def best_threshold(self, metric='dice'):
+        """返回使指定指标最大的阈值及该指标值"""
+        curves = self.curves()
+        best = int(np.argmax(curves[metric]))
+        return float(curves['thresholds'][best]), float(curves[metric][best])
 
 
 
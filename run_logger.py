@@ -0,0 +1,143 @@
+# utils/run_logger.py
+import os
+import json
+import time
+import socket
+import torch
+
+from utils.resources import current_rss_mb
+
+
+def make_run_dir(root='runs', name=None):
+    """Create a fresh run directory: <root>/<YYYYmmdd-HHMMSS>_<name>[_N]"""
+    stem = time.strftime('%Y%m%d-%H%M%S') + (f'_{name}' if name else '')
+    run_dir = os.path.join(root, stem)
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(run_dir)
+            return run_dir
+        except FileExistsError:
+            suffix += 1
+            run_dir = os.path.join(root, f'{stem}_{suffix}')
+
+
+class RunLogger:
+    """
+    Append-only JSONL event log for one run (<run_dir>/events.jsonl)
+
+    Events are kept in memory and written in blocks of `flush_every` (or every
+    `flush_interval` seconds), so logging costs one json.dumps per event.
+    """
+    def __init__(self, run_dir, flush_every=50, flush_interval=30.0):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, 'events.jsonl')
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.time()
+        self.file = open(self.path, 'a', buffering=1 << 16)
+
+    def log(self, event, **fields):
+        now = time.time()
+        self.buffer.append(json.dumps({'time': now, 'event': event, **fields}, default=float))
+        if len(self.buffer) >= self.flush_every or now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class StepTimer:
+    """
+    Per-phase wall time of training steps, reported every `interval` steps
+
+    Call mark(phase) at the end of each phase; the time since the previous mark is
+    charged to that phase, so the first mark of a step ('data') covers waiting for
+    the DataLoader. On CUDA the phases are host-side times unless the step syncs.
+    """
+    def __init__(self, interval=20):
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.steps = 0
+        self.samples = 0
+        self.window_start = self.last_mark = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last_mark
+        self.last_mark = now
+
+    def end_step(self, batch_size):
+        """Returns a record every `interval` steps, otherwise None"""
+        self.steps += 1
+        self.samples += batch_size
+        if self.steps < self.interval:
+            return None
+        elapsed = time.perf_counter() - self.window_start
+        record = {f'{phase}_ms': total / self.steps * 1000 for phase, total in self.phases.items()}
+        record.update({
+            'steps': self.steps,
+            'samples_per_s': self.samples / elapsed,
+            'rss_mb': current_rss_mb(),
+        })
+        self.reset()
+        return record
+
+
+def run_start_fields(config, world_size, device):
+    return {
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'world_size': world_size,
+        'device': str(device),
+        'torch_version': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'config': config,
+    }
+
+
+def load_events(run_dir):
+    events = []
+    with open(os.path.join(run_dir, 'events.jsonl'), 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def summarize_events(events):
+    """Mean step timings and throughput, peak RSS and final/best validation metrics"""
+    steps = [e for e in events if e['event'] == 'steps']
+    epochs = [e for e in events if e['event'] == 'epoch']
+    summary = {'epochs': len(epochs), 'logged_steps': sum(e['steps'] for e in steps)}
+
+    if steps:
+        total = summary['logged_steps']
+        for key in sorted({k for e in steps for k in e if k.endswith('_ms')}):
+            summary[key] = sum(e.get(key, 0.0) * e['steps'] for e in steps) / total
+        summary['samples_per_s'] = sum(e['samples_per_s'] * e['steps'] for e in steps) / total
+        summary['peak_rss_mb'] = max(e['rss_mb'] for e in steps)
+
+    if epochs:
+        last = epochs[-1]
+        for key, value in last.get('val', {}).items():
+            summary[f'val_{key}'] = value
+        summary['epoch_time_s'] = sum(e.get('epoch_time_s', 0.0) for e in epochs) / len(epochs)
+
+    end = [e for e in events if e['event'] == 'run_end']
+    if end:
+        summary['best_val_metric'] = end[-1].get('best_val_metric')
+        summary['stopped_early'] = end[-1].get('stopped_early')
+    return summary
@@ -0,0 +1,194 @@
+# utils/samplers.py
+import math
+import torch
+from torch.utils.data import Sampler
+
+from utils.distributed import get_rank, get_world_size, all_reduce_sum
+
+
+class ResumableSampler(Sampler):
+    """
+    Epoch-seeded sampler that can start part-way through an epoch
+
+    The order depends only on (seed, epoch), so a resumed run sees exactly the
+    same sequence. Indices are sharded across ranks the same way as
+    DistributedSampler, and skipped indices are never yielded, so consumed
+    samples are not loaded again.
+    """
+    def __init__(self, dataset, shuffle=True, seed=0, drop_last=True, num_replicas=None, rank=None):
+        """
+        Args:
+            dataset: Dataset to sample from
+            shuffle (bool): Shuffle every epoch
+            seed (int): Base seed for the per-epoch permutation (must match across ranks)
+            drop_last (bool): Drop the tail so every rank gets the same number of samples,
+                otherwise pad by repeating indices
+            num_replicas (int): Number of ranks (default: process group world size)
+            rank (int): This rank (default: process group rank)
+        """
+        self.dataset_size = len(dataset)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+
+        if drop_last:
+            self.num_samples = self.dataset_size // self.num_replicas
+        else:
+            self.num_samples = math.ceil(self.dataset_size / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """Skip the first `start_index` samples of this rank's shard (applies until changed)"""
+        self.start_index = start_index
+
+    def epoch_indices(self):
+        """This rank's full shard for the current epoch"""
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.dataset_size, generator=generator).tolist()
+        else:
+            indices = list(range(self.dataset_size))
+
+        if self.drop_last:
+            indices = indices[:self.total_size]
+        else:
+            padding = self.total_size - len(indices)
+            indices += (indices * math.ceil(padding / max(len(indices), 1)))[:padding]
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.epoch_indices()[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+class LossWeightedSampler(ResumableSampler):
+    """
+    Hard-example sampler: draws each epoch with probability tied to recent loss
+
+    The training loop reports per-sample losses with record(); the sampler knows
+    which dataset indices made up each batch (it produced the order, and the
+    DataLoader keeps it with any number of workers), so bookkeeping is two
+    index_add_ calls on the training device and no worker is involved. At the end
+    of an epoch the sums are all-reduced, folded into a running average per
+    sample, and the next epoch is drawn with replacement from
+
+        p = (1 - floor) * loss / sum(loss) + floor / N
+
+    so every sample keeps at least floor / N of the probability mass. All ranks
+    hold the same table and draw the same sequence from (seed, epoch), which is
+    then sharded like ResumableSampler. Until every sample has a loss, unseen
+    samples are weighted with the largest loss seen so far; the first epoch is a
+    plain permutation.
+    """
+    def __init__(self, dataset, floor=0.2, momentum=0.5, seed=0, drop_last=True, num_replicas=None, rank=None):
+        """
+        Args:
+            dataset: Dataset to sample from
+            floor (float): Share of the probability mass spread uniformly over all samples
+            momentum (float): Weight of the previous loss estimate when a sample is seen again
+            seed (int): Base seed for the per-epoch draw (must match across ranks)
+            drop_last, num_replicas, rank: As in ResumableSampler
+        """
+        super().__init__(dataset, shuffle=True, seed=seed, drop_last=drop_last,
+                         num_replicas=num_replicas, rank=rank)
+        self.floor = floor
+        self.momentum = momentum
+        self.losses = torch.zeros(self.dataset_size, dtype=torch.float64)
+        self.seen = torch.zeros(self.dataset_size, dtype=torch.bool)
+        self.loss_sum = None   # this epoch's per-sample sums/counts, on the training device
+        self.loss_count = None
+        self._cached = (None, None)  # (epoch, shard indices)
+
+    def probabilities(self):
+        if not self.seen.any():
+            return None
+        losses = torch.where(self.seen, self.losses, self.losses[self.seen].max()).clamp_min(0)
+        total = losses.sum()
+        if total <= 0:
+            return None
+        return (1 - self.floor) * losses / total + self.floor / self.dataset_size
+
+    def epoch_indices(self):
+        epoch, indices = self._cached
+        if epoch == self.epoch:
+            return indices
+        probabilities = self.probabilities()
+        if probabilities is None:
+            indices = super().epoch_indices()
+        else:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            drawn = torch.multinomial(probabilities, self.total_size, replacement=True, generator=generator)
+            indices = drawn[self.rank:self.total_size:self.num_replicas].tolist()
+        self._cached = (self.epoch, indices)
+        return indices
+
+    def batch_indices(self, batch_idx, batch_size):
+        """Dataset indices of batch `batch_idx` (absolute position within the epoch)"""
+        return self.epoch_indices()[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+
+    def record(self, batch_idx, losses):
+        """Accumulate per-sample losses ([B] tensor) of batch `batch_idx`; no host sync"""
+        losses = losses.detach().to(torch.float64)
+        if self.loss_sum is None or self.loss_sum.device != losses.device:
+            self.loss_sum = torch.zeros(self.dataset_size, dtype=torch.float64, device=losses.device)
+            self.loss_count = torch.zeros(self.dataset_size, dtype=torch.float64, device=losses.device)
+        indices = torch.tensor(self.batch_indices(batch_idx, losses.numel()), device=losses.device)
+        self.loss_sum.index_add_(0, indices, losses)
+        self.loss_count.index_add_(0, indices, torch.ones_like(losses))
+
+    def end_epoch(self):
+        """Merge this epoch's losses from all ranks into the table (every rank must call it)"""
+        if self.loss_sum is None:
+            return
+        loss_sum = all_reduce_sum(self.loss_sum).cpu()
+        loss_count = all_reduce_sum(self.loss_count).cpu()
+        self.loss_sum, self.loss_count = None, None
+
+        observed = loss_count > 0
+        mean = loss_sum[observed] / loss_count[observed]
+        previous = self.losses[observed]
+        self.losses[observed] = torch.where(self.seen[observed], self.momentum * previous + (1 - self.momentum) * mean, mean)
+        self.seen |= observed
+        self._cached = (None, None)
+
+    def stats(self):
+        """Spread of the sampling distribution (for logging)"""
+        probabilities = self.probabilities()
+        if probabilities is None:
+            return {}
+        return {
+            'seen_fraction': self.seen.float().mean().item(),
+            'max_over_uniform': (probabilities.max() * self.dataset_size).item(),
+            'min_over_uniform': (probabilities.min() * self.dataset_size).item(),
+        }
+
+    def state_dict(self):
+        """Loss table and this rank's partial epoch sums (for in-epoch snapshots)"""
+        return {
+            'losses': self.losses.clone(),
+            'seen': self.seen.clone(),
+            'loss_sum': self.loss_sum.cpu() if self.loss_sum is not None else None,
+            'loss_count': self.loss_count.cpu() if self.loss_count is not None else None,
+        }
+
+    def load_state_dict(self, state_dict, device=None, partial=True):
+        """partial=False drops the epoch sums (when the interrupted epoch is restarted)"""
+        self.losses = state_dict['losses'].clone()
+        self.seen = state_dict['seen'].clone()
+        self.loss_sum, self.loss_count = None, None
+        if partial and state_dict.get('loss_sum') is not None:
+            self.loss_sum = state_dict['loss_sum'].to(device)
+            self.loss_count = state_dict['loss_count'].to(device)
+        self._cached = (None, None)
@@ -0,0 +1,155 @@
+# scaling_benchmark.py
+import os
+import json
+import time
+import socket
+import argparse
+import platform
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from benchmark import FACTORIES
+from utils.distributed import threads_per_process
+from utils.resources import doubling_counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Data-parallel (gloo) training throughput for 1..N processes')
+    parser.add_argument('--variant', type=str, default='sa_unet', choices=list(FACTORIES), help='Factory function to benchmark')
+    parser.add_argument('--size', type=int, default=512, help='Square input size')
+    parser.add_argument('--batch-size', type=int, default=2, help='Per-process batch size')
+    parser.add_argument('--in-channels', type=int, default=1, help='Input channels (single-channel variant is always 1)')
+    parser.add_argument('--start-neurons', type=int, default=16, help='start_neurons passed to the factory')
+    parser.add_argument('--processes', type=int, nargs='+', default=None,
+                        help='Process counts to run (default: powers of two up to the core count)')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed steps')
+    parser.add_argument('--steps', type=int, default=10, help='Timed steps')
+    parser.add_argument('--output', type=str, default='scaling_results.json', help='Where to write results')
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def train_steps(args, rank, world_size):
+    """Time DDP training steps on synthetic data; returns the median step time (s) across ranks"""
+    torch.manual_seed(0)
+    in_channels = 1 if args.variant == 'sa_unet_single_channel' else args.in_channels
+    kwargs = {'start_neurons': args.start_neurons, 'use_output_activation': False}
+    if args.variant != 'sa_unet_single_channel':
+        kwargs['input_size'] = (args.size, args.size, in_channels)
+    model = FACTORIES[args.variant](**kwargs)
+    if world_size > 1:
+        model = DistributedDataParallel(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    torch.manual_seed(rank)
+    x = torch.randn(args.batch_size, in_channels, args.size, args.size)
+    y = (torch.rand(args.batch_size, 1, args.size, args.size) > 0.95).float()
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    times = []
+    for i in range(args.warmup + args.steps):
+        if world_size > 1:
+            dist.barrier()
+        start = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        loss = criterion(model(x), y)
+        loss.backward()  # gradients are all-reduced here under DDP
+        optimizer.step()
+        if i >= args.warmup:
+            times.append(time.perf_counter() - start)
+
+    # The slowest rank sets the pace
+    step_time = torch.tensor(float(np.median(times)))
+    if world_size > 1:
+        dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+    return step_time.item()
+
+
+def _worker(rank, world_size, port, args, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    os.environ['LOCAL_WORLD_SIZE'] = str(world_size)
+    torch.set_num_threads(threads_per_process())
+    if world_size > 1:
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    step_time = train_steps(args, rank, world_size)
+    if rank == 0:
+        results.put(step_time)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def run_local(args, world_size):
+    """Spawn world_size processes on this machine, cores split evenly between them"""
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    mp.start_processes(_worker, args=(world_size, free_port(), args, results),
+                       nprocs=world_size, join=True, start_method='spawn')
+    return results.get()
+
+
+def summarize(world_size, step_time, batch_size, reference=None):
+    throughput = world_size * batch_size / step_time
+    result = {
+        'processes': world_size,
+        'threads_per_process': max(1, (os.cpu_count() or 1) // world_size),
+        'step_time_ms': step_time * 1000,
+        'samples_per_s': throughput,
+    }
+    if reference is not None:
+        result['speedup'] = throughput / reference
+        result['efficiency'] = result['speedup'] / world_size
+    return result
+
+
+def main():
+    args = parse_args()
+
+    # Under torchrun (one or several nodes) measure the launched world only
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        torch.set_num_threads(threads_per_process())
+        dist.init_process_group('gloo')
+        world_size = dist.get_world_size()
+        step_time = train_steps(args, dist.get_rank(), world_size)
+        if dist.get_rank() == 0:
+            result = summarize(world_size, step_time, args.batch_size)
+            print(f'{world_size} processes: {result["step_time_ms"]:.1f} ms/step, {result["samples_per_s"]:.2f} samples/s')
+        dist.destroy_process_group()
+        return
+
+    results = []
+    reference = None
+    print(f'{"procs":>6}{"threads":>9}{"ms/step":>10}{"samples/s":>12}{"speedup":>9}{"eff":>7}')
+    for world_size in args.processes or doubling_counts():
+        step_time = run_local(args, world_size)
+        result = summarize(world_size, step_time, args.batch_size, reference)
+        if reference is None:
+            reference = result['samples_per_s']
+            result['speedup'], result['efficiency'] = 1.0, 1.0
+        results.append(result)
+        print(f'{world_size:>6}{result["threads_per_process"]:>9}{result["step_time_ms"]:>10.1f}'
+              f'{result["samples_per_s"]:>12.2f}{result["speedup"]:>9.2f}{result["efficiency"]:>7.2f}')
+
+    report = {
+        'torch_version': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,47 @@ def set_seed(seed=42, deterministic=True):
         torch.backends.cudnn.deterministic = False
         torch.backends.cudnn.benchmark = True
 
+def set_rank_seed(seed=42, rank=0, deterministic=True):
+    """
+    分布式训练中为每个进程设置不同的随机种子
+    
+    各rank的数据增强随机性互不相同, 但整体仍可重现
+    (模型初始参数由DDP从rank 0广播, 不受影响)
+    
+    Args:
+        seed (int): 基础随机种子
+        rank (int): 进程编号
+        deterministic (bool): 是否使用确定性算法
+    """
+    set_seed(seed + rank, deterministic=deterministic)
+    return seed + rank
+
+def get_rng_state():
+    """
+    获取当前进程所有随机数生成器的状态, 用于保存到检查点
+    """
+    # numpy状态中的数组转为列表, 检查点中只保留基本类型和张量
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    """
+    从检查点恢复随机数生成器的状态
+    """
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
 def worker_init_fn(worker_id):
     """
     DataLoader工作进程的随机种子初始化函数
@@ -0,0 +1,223 @@
+# sweep.py
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import subprocess
+import multiprocessing as mp
+
+import yaml
+
+from utils.config_utils import load_config, merge_config
+from utils.dataset import SegmentationDataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Grid/random hyperparameter sweep with trials pinned to disjoint cores')
+    parser.add_argument('--sweep', type=str, required=True, help='Sweep spec (YAML)')
+    parser.add_argument('--train-script', type=str, default='main.py', help='Training script run for each trial')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the expanded trials')
+    return parser.parse_args()
+
+
+def set_dotted(config, dotted_key, value):
+    """set_dotted(c, 'loss.dice_weight', 0.3) sets c['loss']['dice_weight']"""
+    node = config
+    keys = dotted_key.split('.')
+    for key in keys[:-1]:
+        node = node.setdefault(key, {})
+    node[keys[-1]] = value
+
+
+def sample_value(spec, rng):
+    """A list is sampled uniformly; {min, max[, log, int]} is a continuous range"""
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    low, high = spec['min'], spec['max']
+    if spec.get('log', False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    return int(round(value)) if spec.get('int', False) else value
+
+
+def expand_trials(sweep):
+    """List of {dotted_key: value} overrides"""
+    parameters = sweep['parameters']
+    if sweep.get('method', 'grid') == 'grid':
+        for key, spec in parameters.items():
+            if not isinstance(spec, list):
+                raise ValueError(f'Grid search needs a list of values for {key}')
+        keys = list(parameters)
+        return [dict(zip(keys, values)) for values in itertools.product(*(parameters[k] for k in keys))]
+
+    rng = random.Random(sweep.get('seed', 0))
+    return [{key: sample_value(spec, rng) for key, spec in parameters.items()}
+            for _ in range(sweep['num_trials'])]
+
+
+def core_slots(cores_per_trial, max_parallel=None):
+    """Disjoint groups of the cores this process may run on"""
+    cores = sorted(os.sched_getaffinity(0))
+    num_slots = max(1, len(cores) // cores_per_trial)
+    if max_parallel:
+        num_slots = min(num_slots, max_parallel)
+    return [cores[i * cores_per_trial:(i + 1) * cores_per_trial] for i in range(num_slots)]
+
+
+_decode_datasets = {}
+
+
+def _init_decoder(datasets):
+    _decode_datasets.update(datasets)
+
+
+def _decode(item):
+    split, file_name = item
+    _decode_datasets[split].load_decoded(file_name)
+
+
+def warm_decoded_cache(config, cache_dir, num_workers):
+    """Decode every train/val sample once into the shared cache before trials start"""
+    datasets = {
+        split: SegmentationDataset(
+            img_dir=os.path.join(config['data'][f'{split}_path'], 'images'),
+            mask_dir=os.path.join(config['data'][f'{split}_path'], 'masks'),
+            decoded_cache_dir=os.path.join(cache_dir, split)
+        )
+        for split in ('train', 'val')
+    }
+    items = [(split, f) for split, dataset in datasets.items() for f in dataset.img_files]
+    with mp.Pool(processes=num_workers, initializer=_init_decoder, initargs=(datasets,)) as pool:
+        pool.map(_decode, items, chunksize=max(1, len(items) // (4 * num_workers)))
+    print(f'Decoded cache ready: {len(items)} samples in {cache_dir}')
+
+
+def trial_config(base_config, overrides, trial_dir, cache_dir, sweep):
+    config = merge_config(base_config, sweep.get('fixed', {}))
+    for key, value in overrides.items():
+        set_dotted(config, key, value)
+    # Per-trial outputs; decoded data and the validation cache are shared
+    config['checkpoints']['save_dir'] = os.path.join(trial_dir, 'checkpoints')
+    config['visualization']['save_path'] = os.path.join(trial_dir, 'visualizations')
+    config.setdefault('logging', {})['run_dir'] = os.path.join(trial_dir, 'run')
+    config['data']['decoded_cache_dir'] = cache_dir
+    validation = config.setdefault('validation', {})
+    if validation.get('cache', 'none') != 'none':
+        validation['cache'] = 'mmap'
+        validation['cache_dir'] = os.path.join(cache_dir, 'val_tensors')
+    return config
+
+
+def launch(trial, cores, train_script):
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+    log_file = open(os.path.join(trial['dir'], 'train.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, train_script, '--config', trial['config_path'], '--overlay', ''],
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+        env=env,
+        # Pin before exec so the trial and its DataLoader workers stay on these cores
+        preexec_fn=lambda: os.sched_setaffinity(0, cores)
+    )
+    return process, log_file
+
+
+def collect_result(trial, returncode):
+    row = {'trial': trial['name'], **trial['overrides'], 'returncode': returncode}
+    summary_path = os.path.join(trial['dir'], 'checkpoints', 'summary.json')
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r') as f:
+            summary = json.load(f)
+        row.update({
+            'best_val_metric': summary['best_val_metric'],
+            'epochs_run': summary['epochs_run'],
+            'stopped_early': summary['stopped_early'],
+            'train_time_s': round(summary['train_time_s'], 1),
+        })
+        row.update({f'last_{k}': v for k, v in summary['last_val_metrics'].items()})
+    return row
+
+
+def write_table(rows, output_dir, mode):
+    ok = [r for r in rows if 'best_val_metric' in r]
+    failed = [r for r in rows if 'best_val_metric' not in r]
+    ok.sort(key=lambda r: r['best_val_metric'], reverse=(mode == 'max'))
+    rows = ok + failed
+
+    columns = []
+    for row in rows:
+        columns.extend(k for k in row if k not in columns)
+    with open(os.path.join(output_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    def fmt(value):
+        return f'{value:.4g}' if isinstance(value, float) else str(value)
+
+    widths = {c: max(len(c), *(len(fmt(r.get(c, ''))) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print('  '.join(fmt(row.get(c, '')).ljust(widths[c]) for c in columns))
+
+
+def main():
+    args = parse_args()
+    with open(args.sweep, 'r') as f:
+        sweep = yaml.safe_load(f)
+
+    base_config, _ = load_config(sweep['base_config'], sweep.get('overlay'))
+    output_dir = sweep.get('output_dir', os.path.join('sweeps', os.path.splitext(os.path.basename(args.sweep))[0]))
+    cache_dir = sweep.get('cache_dir', os.path.join(output_dir, 'decoded_cache'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    trials = []
+    for i, overrides in enumerate(expand_trials(sweep)):
+        name = f'trial_{i:03d}'
+        trial_dir = os.path.join(output_dir, name)
+        trials.append({'name': name, 'dir': trial_dir, 'overrides': overrides,
+                       'config_path': os.path.join(trial_dir, 'config.yaml')})
+        print(f'{name}: {overrides}')
+    if args.dry_run:
+        return
+
+    for trial in trials:
+        os.makedirs(trial['dir'], exist_ok=True)
+        with open(trial['config_path'], 'w') as f:
+            yaml.safe_dump(trial_config(base_config, trial['overrides'], trial['dir'], cache_dir, sweep), f)
+
+    slots = core_slots(sweep.get('cores_per_trial', 4), sweep.get('max_parallel'))
+    print(f'{len(trials)} trials on {len(slots)} slots of {len(slots[0])} cores')
+    warm_decoded_cache(base_config, cache_dir, num_workers=sum(len(s) for s in slots))
+
+    # Trials early-stop through training.early_stopping; a freed slot starts the next trial
+    pending = list(trials)
+    running = {}  # slot index -> (trial, process, log file)
+    rows = []
+    while pending or running:
+        for slot in range(len(slots)):
+            if slot not in running and pending:
+                trial = pending.pop(0)
+                process, log_file = launch(trial, slots[slot], args.train_script)
+                running[slot] = (trial, process, log_file)
+                print(f'Started {trial["name"]} on cores {slots[slot]}')
+        for slot, (trial, process, log_file) in list(running.items()):
+            if process.poll() is not None:
+                log_file.close()
+                del running[slot]
+                rows.append(collect_result(trial, process.returncode))
+                print(f'Finished {trial["name"]} (exit code {process.returncode})')
+        time.sleep(1)
+
+    write_table(rows, output_dir, base_config['checkpoints']['mode'])
+    print(f'Results written to {os.path.join(output_dir, "results.csv")}')
+
+
+if __name__ == '__main__':
+    main()
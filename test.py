@@ -1,22 +1,48 @@
 # inference.py
 import os
+import time
+import queue
 import argparse
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import cv2
 import torch
 import numpy as np
+from scipy.io import loadmat
 from tqdm import tqdm
 
 from utils.model_factory import create_model
+from utils.dataset import get_valid_mask
+from utils.transforms import get_test_augmentation
+from utils.cascade import CascadeSegmenter
+from utils.profiling import add_profiler_args, create_profiler
+from utils.checkpoint import export_state_dict
 
 def parse_args():
     parser = argparse.ArgumentParser(description='U-Net推理脚本')
     parser.add_argument('--config', type=str, default='configs/config.yaml', help='配置文件路径')
     parser.add_argument('--checkpoint', type=str, required=True, help='模型检查点路径')
-    parser.add_argument('--input', type=str, required=True, help='输入图像目录或单个图像')
+    parser.add_argument('--input', type=str, required=True, help='输入图像目录或单个图像 (也支持.mat/.npy浮点雾度图)')
     parser.add_argument('--output', type=str, default='results/predictions', help='输出目录')
     parser.add_argument('--threshold', type=float, default=0.5, help='分割阈值')
     parser.add_argument('--overlay', action='store_true', help='是否叠加显示预测结果')
+    # 级联推理: 低分辨率筛查 + 全分辨率确认
+    parser.add_argument('--cascade', action='store_true', help='是否使用两级级联推理')
+    parser.add_argument('--screen-checkpoint', type=str, default=None, help='筛查模型检查点路径')
+    parser.add_argument('--screen-size', type=int, nargs=2, default=[375, 375], help='筛查分辨率 H W')
+    parser.add_argument('--screen-threshold', type=float, default=0.5, help='晶圆级筛查阈值')
+    parser.add_argument('--region-threshold', type=float, default=0.3, help='热图区域阈值')
+    parser.add_argument('--tile-size', type=int, default=256, help='全分辨率确认的切块大小')
+    # 流水线模式: 读取线程池 -> 有界队列 -> 批量推理 -> 写入线程池
+    parser.add_argument('--pipeline', action='store_true', help='使用流水线批量推理')
+    parser.add_argument('--batch-size', type=int, default=8, help='流水线模式的推理批大小')
+    parser.add_argument('--read-workers', type=int, default=4, help='读取/预处理线程数')
+    parser.add_argument('--write-workers', type=int, default=4, help='编码/写入线程数')
+    parser.add_argument('--queue-size', type=int, default=None, help='预处理队列长度 (默认为2个批次)')
+    # 性能分析 (--profile)
+    add_profiler_args(parser)
     return parser.parse_args()
 
 def preprocess_image(image, config):
@@ -53,11 +79,87 @@ def preprocess_image(image, config):
         
     return image.unsqueeze(0)  # 添加批次维度 [1,C,H,W]
 
+# 浮点雾度图输入 (与训练数据相同, 不经过8位图像)
+FLOAT_MAP_EXTENSIONS = ('.mat', '.npy')
+MAT_KEYS = ('modifiedMap', 'dw_image')
+
+def is_float_map(image_path):
+    return image_path.lower().endswith(FLOAT_MAP_EXTENSIONS)
+
+def read_float_map(image_path):
+    """
+    读取浮点雾度图 (.mat中的modifiedMap/dw_image, 或.npy), 晶圆外区域保留为NaN
+    
+    Returns:
+        image: float32雾度图 [H,W]
+        original_image: 按有效区域拉伸到0-255的8位图像 (仅用于叠加显示)
+    """
+    if image_path.lower().endswith('.mat'):
+        data = loadmat(image_path)
+        key = next((k for k in MAT_KEYS if k in data), None)
+        if key is None:
+            raise KeyError(f'{image_path} 中没有 {" / ".join(MAT_KEYS)}')
+        image = data[key]
+    else:
+        image = np.load(image_path)
+    image = np.asarray(image, dtype=np.float32)
+    if image.ndim == 3:
+        image = image[:, :, 0]
+    
+    finite = np.isfinite(image)
+    original_image = np.zeros(image.shape, dtype=np.uint8)
+    if finite.any():
+        low, high = image[finite].min(), image[finite].max()
+        original_image[finite] = np.clip((image[finite] - low) / max(high - low, 1e-12) * 255, 0, 255).astype(np.uint8)
+    return image, original_image
+
+def preprocess_float_map(image, config, transform):
+    """
+    按训练时的方式预处理浮点雾度图 (见SegmentationDataset)
+    
+    Returns:
+        input_tensor: [1,C,H,W]
+        valid_mask: 模型分辨率下的晶圆有效区域掩码 [H,W] (bool)
+    """
+    h, w = config['data']['img_size']
+    # 区域平均缩放时NaN传播到所在的块, 有效区域掩码在缩放之后计算
+    if image.shape[:2] != (h, w):
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+    valid_mask = get_valid_mask(image).astype(bool)
+    image = np.nan_to_num(image, nan=0.0)
+    
+    # 与训练相同的归一化 (验证/测试变换), 以及相同的[0,1]缩放规则
+    if transform is not None:
+        image = transform(image=image[:, :, None])['image'][:, :, 0]
+    input_tensor = torch.from_numpy(np.ascontiguousarray(image)).float().unsqueeze(0)
+    if input_tensor.max() > 1.0:
+        input_tensor = input_tensor / 255.0
+    input_tensor = input_tensor.expand(config['data']['channels'], -1, -1).contiguous()
+    return input_tensor.unsqueeze(0), valid_mask
+
+def load_input(image_path, config, transform):
+    """
+    读取并预处理一张输入 (图像文件或浮点雾度图)
+    
+    Returns:
+        input_tensor: [1,C,H,W]
+        original_image: 用于叠加显示的原始图像
+        valid_mask: 晶圆有效区域掩码 (模型分辨率), 图像文件为None
+    """
+    if is_float_map(image_path):
+        image, original_image = read_float_map(image_path)
+        input_tensor, valid_mask = preprocess_float_map(image, config, transform)
+        return input_tensor, original_image, valid_mask
+    image, original_image = read_image(image_path, config)
+    return preprocess_image(image, config), original_image, None
+
 def postprocess_prediction(prediction, original_height, original_width, threshold=0.5):
     """后处理预测结果"""
     pred_mask = (prediction > threshold).astype(np.uint8) * 255
-    
-    # 调整回原始大小
+    return resize_mask(pred_mask, original_height, original_width)
+
+def resize_mask(pred_mask, original_height, original_width):
+    """将二值掩码调整回原始大小 (最近邻插值)"""
     if pred_mask.shape[:2] != (original_height, original_width):
         pred_mask = cv2.resize(
             pred_mask, 
@@ -67,6 +169,32 @@ def postprocess_prediction(prediction, original_height, original_width, threshol
     
     return pred_mask
 
+def read_image(image_path, config):
+    """
+    读取图像
+    
+    Returns:
+        image: 送入预处理的图像 (RGB或灰度)
+        original_image: 原始图像 (用于叠加显示)
+    """
+    if config['data']['channels'] == 1:
+        # 单通道读取
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if image is None:  # 某些格式可能需要特殊处理
+            image = cv2.imread(image_path)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image, image.copy()  # 保存原始图像用于可视化
+    # RGB读取
+    image = cv2.imread(image_path)
+    original_image = image.copy()
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), original_image
+
+def write_outputs(pred_mask, original_image, base_name, output_dir, overlay=False):
+    """保存掩码 (以及叠加显示)"""
+    cv2.imwrite(os.path.join(output_dir, f'{base_name}_mask.png'), pred_mask)
+    if overlay:
+        cv2.imwrite(os.path.join(output_dir, f'{base_name}_overlay.png'), create_overlay(original_image, pred_mask))
+
 def create_overlay(image, mask, alpha=0.5, color=(0, 255, 0)):
     """创建叠加可视化"""
     # 确保图像是彩色的
@@ -79,6 +207,187 @@ def create_overlay(image, mask, alpha=0.5, color=(0, 255, 0)):
     overlay = cv2.addWeighted(image, 1, mask_rgb, alpha, 0)
     return overlay
 
+# 读取线程中的异常, 连同原始异常对象一起交给主线程
+ReadFailure = namedtuple('ReadFailure', ['image_path', 'error'])
+
+class StageTimer:
+    """流水线各阶段的累计耗时与处理数量 (线程安全)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = {}
+        self.count = {}
+    
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + seconds
+            self.count[stage] = self.count.get(stage, 0) + count
+
+class MaskBufferPool:
+    """
+    预分配的输出掩码缓冲区 [batch_size, H, W] (uint8), 循环使用
+    一个批次的所有样本写入完成后归还; 没有空闲缓冲区时推理等待写入 (反压)
+    """
+    def __init__(self, num_slots, batch_size, height, width):
+        self.buffers = [np.empty((batch_size, height, width), dtype=np.uint8) for _ in range(num_slots)]
+        self.pending = [0] * num_slots
+        self.lock = threading.Lock()
+        self.free = queue.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+    
+    def acquire(self, count):
+        slot = self.free.get()
+        self.pending[slot] = count
+        return slot
+    
+    def release(self, slot):
+        with self.lock:
+            self.pending[slot] -= 1
+            done = self.pending[slot] == 0
+        if done:
+            self.free.put(slot)
+
+def run_pipeline(args, config, model, cascade, device, image_paths, image_files, profiler, transform):
+    """
+    流水线批量推理: 读取线程解码并预处理 -> 有界队列 -> 主线程拼成批次推理
+    -> 写入线程调整大小、编码并保存, 各阶段同时进行
+    
+    Returns:
+        num_confirmed: 通过级联筛查的晶圆数 (非级联模式为0)
+    """
+    h, w = config['data']['img_size']
+    batch_size = args.batch_size
+    timer = StageTimer()
+    
+    # 读取阶段: 任务队列预先放入所有图像, 每个线程结束时放入一个None
+    tasks = queue.Queue()
+    for item in zip(image_paths, image_files):
+        tasks.put(item)
+    for _ in range(args.read_workers):
+        tasks.put(None)
+    # 有界队列: 推理跟不上时读取线程等待, 内存中最多queue_size张预处理好的图像
+    ready = queue.Queue(maxsize=args.queue_size or 2 * batch_size)
+    # 主线程出错退出时通知读取线程停止 (等待队列空位时也会检查)
+    stop = threading.Event()
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def reader():
+        while not stop.is_set():
+            task = tasks.get()
+            if task is None:
+                put(None)
+                return
+            image_path, image_file = task
+            start = time.perf_counter()
+            try:
+                input_tensor, original_image, valid_mask = load_input(image_path, config, transform)
+            except Exception as e:
+                put(ReadFailure(image_path, e))
+                return
+            timer.add('read', time.perf_counter() - start)
+            put((image_file, input_tensor[0], original_image, valid_mask))
+    
+    readers = [threading.Thread(target=reader, daemon=True) for _ in range(args.read_workers)]
+    for thread in readers:
+        thread.start()
+    
+    # 预分配的输入批次 (CUDA上为锁页内存, 异步拷贝到显存) 与输出掩码缓冲区
+    pin_memory = device.type == 'cuda'
+    input_buffer = torch.empty((batch_size, config['data']['channels'], h, w), pin_memory=pin_memory)
+    mask_pool = MaskBufferPool(num_slots=3, batch_size=batch_size, height=h, width=w)
+    writer_pool = ThreadPoolExecutor(max_workers=args.write_workers)
+    futures = []
+    
+    def write(slot, i, original_image, valid_mask, image_file):
+        start = time.perf_counter()
+        try:
+            pred_mask = mask_pool.buffers[slot][i]
+            if valid_mask is not None:
+                pred_mask[~valid_mask] = 0  # 晶圆外区域不输出缺陷
+            pred_mask = resize_mask(pred_mask, *original_image.shape[:2])
+            write_outputs(pred_mask, original_image, os.path.splitext(image_file)[0], args.output, overlay=args.overlay)
+        finally:
+            mask_pool.release(slot)
+        timer.add('write', time.perf_counter() - start)
+    
+    def run_batch(batch_items):
+        n = len(batch_items)
+        start = time.perf_counter()
+        confirmed = 0
+        with profiler.region('inference'):
+            images = input_buffer[:n].to(device, non_blocking=pin_memory)
+            if cascade is not None:
+                output, scores, _ = cascade(images)
+                confirmed = int((scores >= args.screen_threshold).sum().item())
+            else:
+                output = model(images, training=False)
+                if not config['model']['use_output_activation']:
+                    output = torch.sigmoid(output)
+            # 在设备上二值化, 只拷回uint8掩码
+            pred = (output[:, 0] > args.threshold).to(torch.uint8).mul_(255)
+        timer.add('model', time.perf_counter() - start, count=n)
+        
+        # 拷回主机 (同步), 之后输入缓冲区即可用于下一批次
+        wait_start = time.perf_counter()
+        slot = mask_pool.acquire(n)
+        timer.add('wait_write', time.perf_counter() - wait_start, count=0)
+        start = time.perf_counter()
+        torch.from_numpy(mask_pool.buffers[slot][:n]).copy_(pred)
+        timer.add('model', time.perf_counter() - start, count=0)
+        
+        for i, (image_file, _, original_image, valid_mask) in enumerate(batch_items):
+            futures.append(writer_pool.submit(write, slot, i, original_image, valid_mask, image_file))
+        profiler.step()
+        return confirmed
+    
+    # 推理阶段 (主线程): 从队列取样本填入输入批次, 满一批或读取结束时推理
+    num_confirmed, finished_readers, batch_items = 0, 0, []
+    pbar = tqdm(total=len(image_paths), desc='推理')
+    wall_start = time.perf_counter()
+    try:
+        while finished_readers < args.read_workers:
+            wait_start = time.perf_counter()
+            item = ready.get()
+            timer.add('wait_read', time.perf_counter() - wait_start, count=0)
+            if item is None:
+                finished_readers += 1
+            elif isinstance(item, ReadFailure):
+                raise RuntimeError(f'读取 {item.image_path} 失败') from item.error
+            else:
+                input_buffer[len(batch_items)].copy_(item[1])
+                batch_items.append(item)
+            if len(batch_items) == batch_size or (batch_items and finished_readers == args.read_workers):
+                num_confirmed += run_batch(batch_items)
+                pbar.update(len(batch_items))
+                batch_items = []
+    finally:
+        # 正常结束或出错时都停止读取线程, 并等待已提交的写入完成 (写入线程归还所有缓冲区)
+        stop.set()
+        writer_pool.shutdown(wait=True)
+        for thread in readers:
+            thread.join()
+        pbar.close()
+    for future in futures:
+        future.result()  # 抛出写入线程中的异常
+    wall_time = time.perf_counter() - wall_start
+    
+    # 各阶段处理能力 = 处理数量 / (累计耗时 / 线程数); 最慢的阶段决定端到端吞吐量
+    print('流水线各阶段吞吐量:')
+    for stage, workers in (('read', args.read_workers), ('model', 1), ('write', args.write_workers)):
+        busy, count = timer.busy.get(stage, 0.0), timer.count.get(stage, 0)
+        rate = count / (busy / workers) if busy > 0 else 0.0
+        print(f'  {stage:<5} {workers} 线程, {count} 张, {busy / max(count, 1) * 1000:.1f} ms/张, {rate:.1f} 张/秒')
+    print(f'  推理等待输入 {timer.busy.get("wait_read", 0.0):.2f}s, 等待写入缓冲区 {timer.busy.get("wait_write", 0.0):.2f}s')
+    print(f'  端到端: {len(image_paths) / wall_time:.1f} 张/秒 (批大小 {batch_size})')
+    return num_confirmed
+
 def main():
     # 解析参数
     args = parse_args()
@@ -96,73 +405,105 @@ def main():
     # 加载模型
     model = create_model(config).to(device)
     checkpoint = torch.load(args.checkpoint, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    model.load_state_dict(export_state_dict(checkpoint))
     model.eval()
     
+    # 级联模式: 加载筛查模型
+    cascade = None
+    if args.cascade:
+        if args.screen_checkpoint is None:
+            raise ValueError('级联模式需要指定 --screen-checkpoint')
+        screen_checkpoint = torch.load(args.screen_checkpoint, map_location=device)
+        screen_config = screen_checkpoint.get('config', config)
+        screen_model = create_model(screen_config).to(device)
+        screen_model.load_state_dict(export_state_dict(screen_checkpoint))
+        screen_model.eval()
+        cascade = CascadeSegmenter(
+            screen_model,
+            model,
+            screen_size=args.screen_size,
+            screen_threshold=args.screen_threshold,
+            region_threshold=args.region_threshold,
+            tile_size=args.tile_size,
+            screen_activation=screen_config['model']['use_output_activation'],
+            full_activation=config['model']['use_output_activation']
+        )
+    num_confirmed = 0
+    
     # 确定输入是目录还是单个文件
     if os.path.isdir(args.input):
         # 处理目录中的所有图像
-        image_files = [f for f in os.listdir(args.input) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif'))]
+        image_files = [f for f in os.listdir(args.input)
+                       if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif') + FLOAT_MAP_EXTENSIONS)
+                       and not f.endswith('_Mask.mat')]  # 跳过与雾度图放在一起的标注
         image_paths = [os.path.join(args.input, f) for f in image_files]
     else:
         # 处理单个图像
         image_files = [os.path.basename(args.input)]
         image_paths = [args.input]
     
-    # 逐个处理图像
-    with torch.no_grad():
-        for image_path, image_file in tqdm(zip(image_paths, image_files), desc='推理', total=len(image_paths)):
-            # 读取图像
-            if config['data']['channels'] == 1:
-                # 单通道读取
-                image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-                original_image = image.copy()  # 保存原始图像用于可视化
-                if image is None:  # 某些格式可能需要特殊处理
-                    image = cv2.imread(image_path)
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                    original_image = image.copy()
-            else:
-                # RGB读取
-                image = cv2.imread(image_path)
-                original_image = image.copy()
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            original_height, original_width = image.shape[:2]
+    # 浮点雾度图使用与训练相同的归一化 (验证/测试变换)
+    transform = get_test_augmentation(config)
+    
+    # 性能分析: 对前若干张图像采样, 每张图像为一步
+    profiler = create_profiler(args, config, default_dir='profiles/test')
+    
+    if args.pipeline:
+        # 流水线模式: 读取、批量推理和写入同时进行
+        with torch.no_grad(), profiler:
+            num_confirmed = run_pipeline(args, config, model, cascade, device, image_paths, image_files,
+                                         profiler, transform)
+    else:
+        # 逐个处理图像
+        with torch.no_grad(), profiler:
+            for image_path, image_file in tqdm(zip(image_paths, image_files), desc='推理', total=len(image_paths)):
+                # 读取并预处理 (浮点雾度图按训练时的方式归一化)
+                with profiler.region('read'):
+                    input_tensor, original_image, valid_mask = load_input(image_path, config, transform)
             
-            # 预处理
-            input_tensor = preprocess_image(image, config)
-            input_tensor = input_tensor.to(device)
+                original_height, original_width = original_image.shape[:2]
             
-            # 推理 - 设置training=False
-            output = model(input_tensor, training=False)
+                with profiler.region('preprocess'):
+                    input_tensor = input_tensor.to(device)
             
-            # 如果模型未使用输出激活，则添加sigmoid
-            if not config['model']['use_output_activation']:
-                output = torch.sigmoid(output)
-                
-            pred = output.cpu().squeeze().numpy()
+                with profiler.region('inference'):
+                    if cascade is not None:
+                        # 级联推理 - 只有通过筛查的晶圆才运行完整模型
+                        output, scores, _ = cascade(input_tensor)
+                        num_confirmed += int((scores >= args.screen_threshold).sum().item())
+                    else:
+                        # 推理 - 设置training=False
+                        output = model(input_tensor, training=False)
+                    
+                        # 如果模型未使用输出激活，则添加sigmoid
+                        if not config['model']['use_output_activation']:
+                            output = torch.sigmoid(output)
+                    
+                    pred = output.cpu().squeeze().numpy()
+                    # 晶圆外区域不输出缺陷
+                    if valid_mask is not None:
+                        pred = np.where(valid_mask, pred, 0)
             
-            # 后处理
-            pred_mask = postprocess_prediction(
-                pred, 
-                original_height, 
-                original_width, 
-                threshold=args.threshold
-            )
+                # 后处理
+                with profiler.region('postprocess'):
+                    pred_mask = postprocess_prediction(
+                        pred, 
+                        original_height, 
+                        original_width, 
+                        threshold=args.threshold
+                    )
             
-            # 保存结果
-            base_name = os.path.splitext(image_file)[0]
+                # 保存结果
+                base_name = os.path.splitext(image_file)[0]
             
-            # 保存掩码
-            mask_path = os.path.join(args.output, f'{base_name}_mask.png')
-            cv2.imwrite(mask_path, pred_mask)
+                with profiler.region('write'):
+                    # 保存掩码 (如果需要, 同时保存叠加显示)
+                    write_outputs(pred_mask, original_image, base_name, args.output, overlay=args.overlay)
             
-            # 如果需要叠加显示
-            if args.overlay:
-                overlay = create_overlay(original_image, pred_mask)
-                overlay_path = os.path.join(args.output, f'{base_name}_overlay.png')
-                cv2.imwrite(overlay_path, overlay)
+                profiler.step()
             
+    if cascade is not None:
+        print(f'级联筛查: {num_confirmed}/{len(image_paths)} 个晶圆进入全分辨率确认')
     print(f'推理结果已保存到 {args.output}')
 
 if __name__ == '__main__':
@@ -158,6 +158,36 @@ def get_training_augmentation(config):
     return A.Compose(transforms)
 
 
+# Geometric transforms that change pixel distances (scale or warp the mask);
+# names missing from the installed albumentations version are skipped
+DISTANCE_CHANGING_TRANSFORMS = tuple(
+    getattr(A, name) for name in (
+        'ElasticTransform', 'GridDistortion', 'OpticalDistortion', 'ShiftScaleRotate',
+        'Affine', 'PiecewiseAffine', 'Perspective', 'RandomScale', 'Resize',
+        'RandomResizedCrop', 'RandomSizedCrop', 'LongestMaxSize', 'SmallestMaxSize',
+    ) if hasattr(A, name)
+)
+
+
+def preserves_distances(transform):
+    """
+    Check whether a transform keeps pixel distances unchanged
+
+    Flips and intensity transforms do, so a cached distance map can be
+    transformed together with the mask. Anything that scales or warps the
+    mask needs the distance map recomputed after augmentation.
+
+    Args:
+        transform: Albumentations transform (Compose, OneOf, ... are searched recursively)
+
+    Returns:
+        bool: True if no distance-changing transform can be applied
+    """
+    if isinstance(transform, DISTANCE_CHANGING_TRANSFORMS):
+        return False
+    return all(preserves_distances(t) for t in getattr(transform, 'transforms', []))
+
+
 def get_validation_augmentation(config):
     """
     Get validation data augmentation - only essential preprocessing
@@ -318,6 +318,220 @@ def create_sa_unet_model_for_single_channel(block_size=7, keep_prob=0.9,
     )
 
 
+class DepthwiseSeparableConv2d(nn.Module):
+    """
+    Depthwise convolution followed by a pointwise 1x1 convolution
+    """
+    def __init__(self, in_channels, out_channels, kernel_size=3, padding=1, stride=1):
+        super(DepthwiseSeparableConv2d, self).__init__()
+        self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size, stride=stride, padding=padding,
+                                   groups=in_channels, bias=False)
+        self.pointwise = nn.Conv2d(in_channels, out_channels, 1)
+
+    def forward(self, x):
+        return self.pointwise(self.depthwise(x))
+
+
+class LiteUNet(nn.Module):
+    """
+    Lightweight U-Net for first-pass screening.
+    Same topology and forward signature as UNet, but every 3x3 convolution is
+    depthwise-separable and ConvTranspose2d is replaced by resize-then-conv.
+    With stem_stride=2 the first convolution is strided, so the whole network
+    runs at half resolution and the logits are resized back to the input size.
+    """
+    def __init__(self, in_channels=3, out_channels=1, block_size=7, keep_prob=0.9,
+                 start_neurons=16, with_attention=False, use_output_activation=True,
+                 stem_stride=2):
+        super(LiteUNet, self).__init__()
+        self.with_attention = with_attention
+        self.use_output_activation = use_output_activation
+        self.stem_stride = stem_stride
+
+        # Encoder path
+        # First layer (strided stem: the per-pixel BatchNorm/ReLU/pool traffic at
+        # full resolution dominates CPU latency, not the convolution FLOPs)
+        self.enc1_1 = DepthwiseSeparableConv2d(in_channels, start_neurons, stride=stem_stride)
+        self.drop1_1 = DropBlock2D(block_size, keep_prob)
+        self.bn1_1 = nn.BatchNorm2d(start_neurons)
+        self.enc1_2 = DepthwiseSeparableConv2d(start_neurons, start_neurons)
+        self.drop1_2 = DropBlock2D(block_size, keep_prob)
+        self.bn1_2 = nn.BatchNorm2d(start_neurons)
+        self.pool1 = nn.MaxPool2d(2)
+
+        # Second layer
+        self.enc2_1 = DepthwiseSeparableConv2d(start_neurons, start_neurons*2)
+        self.drop2_1 = DropBlock2D(block_size, keep_prob)
+        self.bn2_1 = nn.BatchNorm2d(start_neurons*2)
+        self.enc2_2 = DepthwiseSeparableConv2d(start_neurons*2, start_neurons*2)
+        self.drop2_2 = DropBlock2D(block_size, keep_prob)
+        self.bn2_2 = nn.BatchNorm2d(start_neurons*2)
+        self.pool2 = nn.MaxPool2d(2)
+
+        # Third layer
+        self.enc3_1 = DepthwiseSeparableConv2d(start_neurons*2, start_neurons*4)
+        self.drop3_1 = DropBlock2D(block_size, keep_prob)
+        self.bn3_1 = nn.BatchNorm2d(start_neurons*4)
+        self.enc3_2 = DepthwiseSeparableConv2d(start_neurons*4, start_neurons*4)
+        self.drop3_2 = DropBlock2D(block_size, keep_prob)
+        self.bn3_2 = nn.BatchNorm2d(start_neurons*4)
+        self.pool3 = nn.MaxPool2d(2)
+
+        # Bottleneck
+        self.bottleneck_1 = DepthwiseSeparableConv2d(start_neurons*4, start_neurons*8)
+        self.drop_bottleneck_1 = DropBlock2D(block_size, keep_prob)
+        self.bn_bottleneck_1 = nn.BatchNorm2d(start_neurons*8)
+
+        # Spatial attention mechanism (only used when with_attention=True)
+        if with_attention:
+            self.spatial_attention = SpatialAttention(kernel_size=7)
+
+        self.bottleneck_2 = DepthwiseSeparableConv2d(start_neurons*8, start_neurons*8)
+        self.drop_bottleneck_2 = DropBlock2D(block_size, keep_prob)
+        self.bn_bottleneck_2 = nn.BatchNorm2d(start_neurons*8)
+
+        # Decoder path
+        # Third layer
+        self.upconv3 = nn.Conv2d(start_neurons*8, start_neurons*4, 1)
+        self.dec3_1 = DepthwiseSeparableConv2d(start_neurons*8, start_neurons*4)  # *8 due to concatenation
+        self.drop_dec3_1 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec3_1 = nn.BatchNorm2d(start_neurons*4)
+        self.dec3_2 = DepthwiseSeparableConv2d(start_neurons*4, start_neurons*4)
+        self.drop_dec3_2 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec3_2 = nn.BatchNorm2d(start_neurons*4)
+
+        # Second layer
+        self.upconv2 = nn.Conv2d(start_neurons*4, start_neurons*2, 1)
+        self.dec2_1 = DepthwiseSeparableConv2d(start_neurons*4, start_neurons*2)  # *4 due to concatenation
+        self.drop_dec2_1 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec2_1 = nn.BatchNorm2d(start_neurons*2)
+        self.dec2_2 = DepthwiseSeparableConv2d(start_neurons*2, start_neurons*2)
+        self.drop_dec2_2 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec2_2 = nn.BatchNorm2d(start_neurons*2)
+
+        # First layer
+        self.upconv1 = nn.Conv2d(start_neurons*2, start_neurons, 1)
+        self.dec1_1 = DepthwiseSeparableConv2d(start_neurons*2, start_neurons)  # *2 due to concatenation
+        self.drop_dec1_1 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec1_1 = nn.BatchNorm2d(start_neurons)
+        self.dec1_2 = DepthwiseSeparableConv2d(start_neurons, start_neurons)
+        self.drop_dec1_2 = DropBlock2D(block_size, keep_prob)
+        self.bn_dec1_2 = nn.BatchNorm2d(start_neurons)
+
+        # Output layer
+        self.output = nn.Conv2d(start_neurons, out_channels, 1)
+        self.sigmoid = nn.Sigmoid()
+
+    def upsample(self, x, conv, target_size):
+        """Project channels with the 1x1 convolution, then resize to the skip connection size"""
+        # A 1x1 convolution commutes with bilinear resizing, so it is applied
+        # before the resize where there are 4x fewer pixels to convolve
+        x = conv(x)
+        return F.interpolate(x, size=target_size, mode='bilinear', align_corners=False)
+
+    def forward(self, x, training=True):
+        # Encoder
+        # First layer
+        enc1 = self.enc1_1(x)
+        enc1 = self.drop1_1(enc1, training)
+        enc1 = F.relu(self.bn1_1(enc1))
+        enc1 = self.enc1_2(enc1)
+        enc1 = self.drop1_2(enc1, training)
+        enc1 = F.relu(self.bn1_2(enc1))
+        pool1 = self.pool1(enc1)
+
+        # Second layer
+        enc2 = self.enc2_1(pool1)
+        enc2 = self.drop2_1(enc2, training)
+        enc2 = F.relu(self.bn2_1(enc2))
+        enc2 = self.enc2_2(enc2)
+        enc2 = self.drop2_2(enc2, training)
+        enc2 = F.relu(self.bn2_2(enc2))
+        pool2 = self.pool2(enc2)
+
+        # Third layer
+        enc3 = self.enc3_1(pool2)
+        enc3 = self.drop3_1(enc3, training)
+        enc3 = F.relu(self.bn3_1(enc3))
+        enc3 = self.enc3_2(enc3)
+        enc3 = self.drop3_2(enc3, training)
+        enc3 = F.relu(self.bn3_2(enc3))
+        pool3 = self.pool3(enc3)
+
+        # Bottleneck
+        bottleneck = self.bottleneck_1(pool3)
+        bottleneck = self.drop_bottleneck_1(bottleneck, training)
+        bottleneck = F.relu(self.bn_bottleneck_1(bottleneck))
+
+        # Apply spatial attention mechanism if specified
+        if self.with_attention:
+            bottleneck = self.spatial_attention(bottleneck)
+
+        bottleneck = self.bottleneck_2(bottleneck)
+        bottleneck = self.drop_bottleneck_2(bottleneck, training)
+        bottleneck = F.relu(self.bn_bottleneck_2(bottleneck))
+
+        # Decoder (resizing to the skip size makes check_size unnecessary)
+        # Third layer
+        up3 = self.upsample(bottleneck, self.upconv3, enc3.size()[2:])
+        merge3 = torch.cat([up3, enc3], dim=1)
+        dec3 = self.dec3_1(merge3)
+        dec3 = self.drop_dec3_1(dec3, training)
+        dec3 = F.relu(self.bn_dec3_1(dec3))
+        dec3 = self.dec3_2(dec3)
+        dec3 = self.drop_dec3_2(dec3, training)
+        dec3 = F.relu(self.bn_dec3_2(dec3))
+
+        # Second layer
+        up2 = self.upsample(dec3, self.upconv2, enc2.size()[2:])
+        merge2 = torch.cat([up2, enc2], dim=1)
+        dec2 = self.dec2_1(merge2)
+        dec2 = self.drop_dec2_1(dec2, training)
+        dec2 = F.relu(self.bn_dec2_1(dec2))
+        dec2 = self.dec2_2(dec2)
+        dec2 = self.drop_dec2_2(dec2, training)
+        dec2 = F.relu(self.bn_dec2_2(dec2))
+
+        # First layer
+        up1 = self.upsample(dec2, self.upconv1, enc1.size()[2:])
+        merge1 = torch.cat([up1, enc1], dim=1)
+        dec1 = self.dec1_1(merge1)
+        dec1 = self.drop_dec1_1(dec1, training)
+        dec1 = F.relu(self.bn_dec1_1(dec1))
+        dec1 = self.dec1_2(dec1)
+        dec1 = self.drop_dec1_2(dec1, training)
+        dec1 = F.relu(self.bn_dec1_2(dec1))
+
+        # Output
+        out = self.output(dec1)
+
+        # Resize the logits back to the input size after a strided stem
+        if out.size()[2:] != x.size()[2:]:
+            out = F.interpolate(out, size=x.size()[2:], mode='bilinear', align_corners=False)
+
+        # Apply activation function only if specified
+        if self.use_output_activation:
+            out = self.sigmoid(out)
+
+        return out
+
+
+def create_lite_unet_model(input_size=(512, 512, 3), block_size=7, keep_prob=0.9,
+                           start_neurons=16, use_output_activation=True, with_attention=False,
+                           stem_stride=2):
+    """Create lightweight depthwise-separable U-Net model for fast screening"""
+    return LiteUNet(
+        in_channels=input_size[2],
+        out_channels=1,
+        block_size=block_size,
+        keep_prob=keep_prob,
+        start_neurons=start_neurons,
+        with_attention=with_attention,
+        use_output_activation=use_output_activation,
+        stem_stride=stem_stride
+    )
+
+
 if __name__ == "__main__":
     # Test model
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
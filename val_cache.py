@@ -0,0 +1,126 @@
+# utils/val_cache.py
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+class CachedValidationSet:
+    """
+    Validation split decoded and transformed once into contiguous tensors
+
+    Validation preprocessing is deterministic, so every sample field (image,
+    mask and any extras) is stored in one [N, ...] tensor per field, either in
+    memory or memory-mapped from .npy files when it exceeds the memory budget.
+    Batches are then plain slices, with no per-epoch loading or augmentation.
+    """
+    def __init__(self, fields, extra_keys):
+        self.fields = fields          # list of [N, ...] tensors: image, mask, extras...
+        self.extra_keys = extra_keys  # names of the extras, in field order after the mask
+
+    def __len__(self):
+        return self.fields[0].size(0)
+
+    @classmethod
+    def build(cls, dataset, indices=None, max_memory_mb=4096, cache_dir=None, cache_key='',
+              num_workers=4, mode='auto'):
+        """
+        Decode (a shard of) `dataset` once
+
+        Args:
+            dataset: Validation dataset (returns (img, mask) or (img, mask, extras))
+            indices (list): Samples to cache (e.g. this rank's shard), default all
+            max_memory_mb (float): Above this size the cache is memory-mapped (mode='auto')
+            cache_dir (str): Directory for memory-mapped files
+            cache_key (str): Identifies the preprocessing; a memory-mapped cache with the
+                same key is reused across runs instead of rebuilt
+            num_workers (int): DataLoader workers used for the single decoding pass
+            mode (str): 'memory', 'mmap' or 'auto'
+        """
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        num_samples = len(dataset)
+
+        first = dataset[0]
+        extra_keys = list(first[2].keys()) if len(first) > 2 else []
+        templates = [first[0], first[1]] + [first[2][k] for k in extra_keys]
+        total_mb = sum(t.numel() * t.element_size() for t in templates) * num_samples / (1024 * 1024)
+
+        use_mmap = mode == 'mmap' or (mode == 'auto' and total_mb > max_memory_mb)
+        if use_mmap and cache_dir is None:
+            raise ValueError('Memory-mapped validation cache needs a cache_dir')
+
+        if not use_mmap:
+            fields = [torch.empty((num_samples,) + tuple(t.shape), dtype=t.dtype) for t in templates]
+            cls._fill(fields, dataset, extra_keys, num_workers)
+            return cls(fields, extra_keys)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        key = hashlib.sha1(f'{cache_key}|{num_samples}'.encode()).hexdigest()[:16]
+        meta_path = os.path.join(cache_dir, f'val_cache_{key}.json')
+        paths = [os.path.join(cache_dir, f'val_cache_{key}_{i}.npy') for i in range(len(templates))]
+
+        # Runs sharing cache_dir (e.g. concurrent sweep trials) build one at a time; the
+        # first builds and the others reuse its files. Arrays are written to per-process
+        # temporary files and renamed into place, and the meta file comes last, so a
+        # mapped cache file is never truncated or rewritten underneath a reader.
+        with open(os.path.join(cache_dir, f'val_cache_{key}.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(meta_path):
+                tmp_paths = [f'{p}.{os.getpid()}.tmp.npy' for p in paths]
+                arrays = [
+                    np.lib.format.open_memmap(p, mode='w+', dtype=t.numpy().dtype, shape=(num_samples,) + tuple(t.shape))
+                    for p, t in zip(tmp_paths, templates)
+                ]
+                cls._fill([torch.from_numpy(a) for a in arrays], dataset, extra_keys, num_workers)
+                for array in arrays:
+                    array.flush()
+                del arrays
+                for tmp_path, path in zip(tmp_paths, paths):
+                    os.replace(tmp_path, path)
+                tmp_meta = f'{meta_path}.{os.getpid()}.tmp'
+                with open(tmp_meta, 'w') as f:
+                    json.dump({'cache_key': cache_key, 'num_samples': num_samples, 'extra_keys': extra_keys}, f)
+                os.replace(tmp_meta, meta_path)
+
+        fields = [torch.from_numpy(np.load(p, mmap_mode='c')) for p in paths]
+        return cls(fields, extra_keys)
+
+    @staticmethod
+    def _fill(fields, dataset, extra_keys, num_workers):
+        """Decode `dataset` once into the preallocated [N, ...] fields"""
+        loader = DataLoader(dataset, batch_size=16, shuffle=False, num_workers=num_workers)
+        offset = 0
+        for batch in loader:
+            parts = [batch[0], batch[1]] + [batch[2][k] for k in extra_keys]
+            n = parts[0].size(0)
+            for field, part in zip(fields, parts):
+                field[offset:offset + n] = part
+            offset += n
+
+    def subset_indices(self, fraction, seed=0):
+        """Fixed random subset, so fast validations on different epochs stay comparable"""
+        num = max(1, int(round(len(self) * fraction)))
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        return torch.randperm(len(self), generator=generator)[:num].sort().values
+
+    def num_batches(self, batch_size, indices=None):
+        num = len(self) if indices is None else len(indices)
+        return (num + batch_size - 1) // batch_size
+
+    def iter_batches(self, batch_size, device, indices=None):
+        """Yield (images, masks, extras); without `indices` batches are zero-copy slices"""
+        num = len(self) if indices is None else len(indices)
+        non_blocking = device.type == 'cuda'
+        for start in range(0, num, batch_size):
+            if indices is None:
+                parts = [field[start:start + batch_size] for field in self.fields]
+            else:
+                batch_indices = indices[start:start + batch_size]
+                parts = [field[batch_indices] for field in self.fields]
+            parts = [p.to(device, non_blocking=non_blocking) for p in parts]
+            yield parts[0], parts[1], dict(zip(self.extra_keys, parts[2:]))
@@ -1,5 +1,7 @@
 # utils/visualization.py
 import os
+import queue
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
@@ -58,3 +60,61 @@ def visualize_predictions(images, masks, predictions, save_dir, epoch, num_examp
     plt.tight_layout()
     plt.savefig(os.path.join(save_dir, f'predictions_epoch_{epoch}.png'))
     plt.close()
+
+
+def _visualization_worker(request_queue):
+    """后台进程: 使用非交互式后端逐个渲染可视化请求"""
+    plt.switch_backend('Agg')
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        try:
+            visualize_predictions(**request)
+        except Exception as e:  # 可视化失败不影响训练
+            print(f'可视化失败 (epoch {request.get("epoch")}): {e}')
+
+
+class VisualizationWorker:
+    """
+    后台可视化进程
+    
+    训练进程只把选中样本的CPU副本放入队列, 作图和savefig在独立进程中完成,
+    验证耗时不再受可视化epoch影响
+    """
+    def __init__(self, max_pending=2):
+        """
+        Args:
+            max_pending (int): 队列中最多等待的请求数, 队列满时丢弃新请求而不阻塞训练
+        """
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=max_pending)
+        self.process = ctx.Process(target=_visualization_worker, args=(self.queue,), daemon=True)
+        self.process.start()
+    
+    def submit(self, images, masks, predictions, save_dir, epoch, num_examples=4, channels=1):
+        """提交一个可视化请求 (只复制前num_examples个样本到CPU)"""
+        num_examples = min(num_examples, images.size(0))
+        
+        def to_cpu(tensor):
+            # clone避免把整个批次的存储发送给后台进程
+            return tensor[:num_examples].detach().float().cpu().clone()
+        
+        request = {
+            'images': to_cpu(images),
+            'masks': to_cpu(masks),
+            'predictions': to_cpu(predictions),
+            'save_dir': save_dir,
+            'epoch': epoch,
+            'num_examples': num_examples,
+            'channels': channels,
+        }
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            print(f'可视化队列已满, 跳过 epoch {epoch} 的可视化')
+    
+    def close(self):
+        """等待已提交的请求完成并结束后台进程"""
+        self.queue.put(None)
+        self.process.join()